@@ -19,6 +19,13 @@ from torch.utils.data import DataLoader
 
 from datasets import seq_collate_dict, load_dataset
 from models import *
+from metrics import SSTAccuracy, CCC
+from corpus_store import RaggedStore, open_sst_split, generateBatchStore
+from checkpoint import load_model_weights, read_checkpoint
+from precision import autocast
+from shards import add_shard_args, shard_dir, shard_batches, launch_shards, save_shard, \
+    load_shards
+from attn_store import add_store_args, write_attn_stores, merge_attn_stores
 from random import shuffle
 import random
 from operator import itemgetter
@@ -40,16 +47,6 @@ logging.basicConfig(
     ])
 logger = logging.getLogger()
 
-def eval_ccc(y_true, y_pred):
-    """Computes concordance correlation coefficient."""
-    true_mean = np.mean(y_true)
-    true_var = np.var(y_true)
-    pred_mean = np.mean(y_pred)
-    pred_var = np.var(y_pred)
-    covar = np.cov(y_true, y_pred, bias=True)[0][1]
-    ccc = 2*covar / (true_var + pred_var +  (pred_mean-true_mean) ** 2)
-    return ccc
-
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for i in range(0, len(l), n):
@@ -126,7 +123,6 @@ def evaluateOnEval(input_data, input_target, lengths, token_lengths, model, crit
     actuals = []
     data_num = 0
     loss, ccc = 0.0, []
-    count = 0
     index = 0
     total_vid_count = len(input_data[list(input_data.keys())[0]])
     for (data, target, mask, lengths, token_lengths) in generateTrainBatch(input_data,
@@ -154,14 +150,8 @@ def evaluateOnEval(input_data, input_target, lengths, token_lengths, model, crit
         loss += criterion(output, target)
         # Keep track of total number of time-points
         data_num += sum(lengths)
-        # Compute correlation and CCC of predictions against ratings
-        output = torch.squeeze(torch.squeeze(output, dim=2), dim=0).cpu().detach().numpy()
-        target = torch.squeeze(torch.squeeze(target, dim=2), dim=0).cpu().detach().numpy()
-        if count == 0:
-            # print(output)
-            # print(target)
-            count += 1
-        curr_ccc = eval_ccc(output, target)
+        # Compute CCC of predictions against ratings
+        curr_ccc = CCC().update(output, target).compute()
         ccc.append(curr_ccc)
         index += 1
     # Average losses and print
@@ -519,6 +509,11 @@ def sortSST(data_chunk, length_chunk, tensor=True):
     return data_sort
 
 def generateBatchSST(input_data, input_target, seq_ids, args, batch_size=1):
+    if isinstance(input_data, RaggedStore):
+        yield from generateBatchStore(input_data, input_target, args, batch_size,
+                                      shuffle_batches=False, return_ids=True,
+                                      index=[input_data.index_of(_id) for _id in seq_ids])
+        return
     # select batch sentence id
     index = [i for i in range(0, len(seq_ids))]
     shuffle_chunks = [i for i in chunks(index, batch_size)] # contains array index
@@ -543,33 +538,6 @@ def generateBatchSST(input_data, input_target, seq_ids, args, batch_size=1):
             mask[i,:seq_len[i]] = 1
         yield sort_feature, sort_targets, seq_len, mask, sort_chunk_ids
 
-def oneHotVector(sort_targets):
-    n_class = 5
-    batch_size = sort_targets.shape[0]
-    target = torch.zeros((batch_size, int(n_class)), dtype=torch.float).to(args.device)
-    for i in range(batch_size):
-        target[i][int(sort_targets[i]) - 1] = 1.0
-    return target
-
-def calculate_accuracy(predict, actual):
-    _, predicted = torch.max(predict, dim=-1)
-    multiclass = 0
-    for i in range(predict.shape[0]):
-        if int(predicted[i]) == int(actual[i]) - 1:
-            multiclass += 1
-
-    binary = 0
-    binary_total = 0 # will not count nuetural cases
-    for i in range(predict.shape[0]):
-        if int(actual[i]) != 3:
-            binary_total += 1
-            if int(actual[i]) < 3 and int(predicted[i]) < 2:
-                binary += 1
-            elif int(actual[i]) > 3 and int(predicted[i]) > 2:
-                binary += 1
-
-    return multiclass, binary, binary_total
-
 def stringOut(sort_targets, output):
     _, predicted = torch.max(output, dim=-1)
     ret = []
@@ -619,7 +587,11 @@ def extract_attn_weight(args):
     # Loading the data
     print("Loading SST data ...")
     data_folder = args.data_dir
-    test_data = pickle.load( open( data_folder + "id_embed_test.p", "rb" ) )
+    if args.sst_store is not None:
+        # memory-mapped float32 store written by corpus_store.py
+        test_data = open_sst_split(args.sst_store, 'test')
+    else:
+        test_data = pickle.load( open( data_folder + "id_embed_test.p", "rb" ) )
     test_target = pickle.load( open( data_folder + "id_rating_test.p", "rb" ) )
     assert(len(test_data) == len(test_target))
     print("Verified SST data ...")
@@ -633,24 +605,25 @@ def extract_attn_weight(args):
     # loss function define
     criterion = nn.BCELoss(reduction='sum')
     # construct model
-    model = TransformerLinearAttn(mods=args.modalities, dims=mod_dimension, device=args.device)
-    # load model
     model_path = args.model_path
-    checkpoint = load_checkpoint(model_path, args.device)
-    model.load_state_dict(checkpoint['model'])
+    arch, checkpoint = read_checkpoint(model_path, args.device)
+    model = TransformerLinearAttn(mods=args.modalities, dims=mod_dimension, device=args.device,
+                                  arch=arch)
+    # load model
+    load_model_weights(model_path, model, args.device, checkpoint)
 
     loss = 0.0
     best_multi_acur = -1.0
     best_binary_acur = -1.0
     args.batch_size = 500
-    multiclass_correct = 0
-    binary_correct = 0
-    multiclass_instance = 0
-    binary_instance = 0
+    accuracy = SSTAccuracy()
     weights = []
     ctx_weights = []
     seq_ids = [k for k in test_data.keys()]
+    # this shard's batches, the same ones as in a single process run
+    seq_ids, batch_index = shard_batches(seq_ids, args.batch_size, args.num_shards, args.shard_id)
     sort_seq_ids = []
+    batch_seq_ids = []
     back_out_method = 'nlap'
 
     model.eval()
@@ -666,26 +639,22 @@ def extract_attn_weight(args):
             mask = mask.to(args.device)
             sort_feature = sort_feature.to(args.device)
             sort_targets = sort_targets.to(args.device)
-            # Run forward pass.
-            output = model(sort_feature, seq_len, mask)
+            with autocast(args.bf16):
+                # Run forward pass.
+                output = model(sort_feature, seq_len, mask)
+                # Weights and collect outputs
+                weight, ctx_weight = model.backward_tf_attn(sort_feature, seq_len, mask)
             # produce readable string encoded results
             stringout = stringOut(sort_targets, output)
-            # Weights and collect outputs
-            weight = None
-            weight, ctx_weight = model.backward_tf_attn(sort_feature, seq_len, mask)
             for i in range(weight.shape[0]):
                 weights.append(weight[i])
                 ctx_weights.append(ctx_weight[i])
                 stringOuts.append(stringout[i])
             sort_seq_ids.extend(sort_chunk_ids)
-            multiclass, binary, binary_total = calculate_accuracy(output, sort_targets)
-            multiclass_correct += multiclass
-            multiclass_instance += len(seq_len)
-            binary_correct += binary
-            binary_instance += binary_total
-
-    multi_accu = multiclass_correct*1.0/multiclass_instance
-    binary_accu = binary_correct*1.0/binary_instance
+            batch_seq_ids.append(list(sort_chunk_ids))
+            accuracy.update(output, sort_targets)
+
+    multi_accu, binary_accu = accuracy.compute()
     logger.info('Test Set Performance\tmulti_acc: {:0.3f} \tbinary_acc: {:0.3f} \t'.\
         format(multi_accu, binary_accu))
 
@@ -701,11 +670,28 @@ def extract_attn_weight(args):
         ctx_attn = ctx_weights[i]
         # adjust the weights length based on sentence length
         s = test_sentence[i]
-        id_tf_attns[sort_seq_ids[i]] = tf_attn[:,:,:len(s),:len(s)].tolist()
-        id_ctx_attns[sort_seq_ids[i]] = ctx_attn[:len(s)].tolist()
-
-    pickle.dump( id_tf_attns, open(args,out_dir + "/id_tf_attns_sst.p", "wb") )
-    pickle.dump( id_ctx_attns, open(out_dir + "/id_ctx_attns_sst.p", "wb") )
+        id_tf_attns[sort_seq_ids[i]] = tf_attn[:,:,:len(s),:len(s)]
+        id_ctx_attns[sort_seq_ids[i]] = ctx_attn[:len(s)]
+
+    # attention stores, read with attn_store.AttnStore
+    out_dir = args.out_dir
+    if args.num_shards > 1:
+        # the batch positions give the order of a single process run
+        save_shard(args.out_dir, args.num_shards, args.shard_id,
+                   {"shard.p": {'batches': list(zip(batch_index, batch_seq_ids))}})
+        out_dir = shard_dir(args.out_dir, args.num_shards, args.shard_id)
+    write_attn_stores(out_dir, ["id_tf_attns_sst", "id_ctx_attns_sst"],
+                      id_tf_attns, id_ctx_attns, args)
+
+def merge_attn_weight(args):
+    """Merges the shards of extract_attn_weight into the outputs of a single process run."""
+    shards = load_shards(args.out_dir, args.num_shards, "shard.p")
+    sort_seq_ids = [_id for _, ids in
+                    sorted(b for shard in shards for b in shard['batches']) for _id in ids]
+    for name in ["id_tf_attns_sst", "id_ctx_attns_sst"]:
+        merge_attn_stores([shard_dir(args.out_dir, args.num_shards, k) + "/" + name
+                           for k in range(args.num_shards)],
+                          args.out_dir + "/" + name, sort_seq_ids)
 
 def load_token_dict_sst(args):
     data_folder = args.data_dir
@@ -764,9 +750,23 @@ if __name__ == "__main__":
                         help='path to the saved model (end with .pth)')
     parser.add_argument('--out_dir', type=str, default="../save_lap/",
                         help='the directory to save all the results')
+    parser.add_argument('--sst_store', type=str, default=None,
+                        help='directory of SST stores made by corpus_store.py (default: load pickles)')
+    parser.add_argument('--bf16', action='store_true',
+                        help='run the model under bfloat16 autocast on the CPU')
+    add_store_args(parser)
+    add_shard_args(parser)
     args = parser.parse_args()
 
     # These helper script should be combined with others.
     # These are only for SST analysis
-    extract_attn_weight(args)
-    load_token_dict_sst(args)
\ No newline at end of file
+    if args.launch and args.num_shards > 1:
+        launch_shards(extract_attn_weight, args, args.num_shards)
+        merge_attn_weight(args)
+    elif args.merge:
+        merge_attn_weight(args)
+    else:
+        extract_attn_weight(args)
+    # the token ratings cover the whole corpus, written once with the merge
+    if args.num_shards == 1 or args.launch or args.merge:
+        load_token_dict_sst(args)
\ No newline at end of file
@@ -19,9 +19,23 @@ from torch.utils.data import DataLoader
 
 from datasets import seq_collate_dict, load_dataset
 from models import *
+from metrics import SSTAccuracy, CCC
+from corpus_store import RaggedStore, open_sst_split, generateBatchStore
+from checkpoint import load_model_weights, read_checkpoint
+from precision import autocast
+from shards import add_shard_args, shard_name, shard_dir, shard_batches, launch_shards, \
+    save_shard, load_shards, merge_dicts
+from extract_progress import ExtractionProgress, add_progress_args, extraction_fingerprint
+from attn_store import add_store_args, write_attn_stores, merge_attn_stores
+from word_stats import WordAggregator
+from segment_ops import pack_segments, split_segments, segment_softmax, segment_absmax
+from pipeline import add_pipeline_args, run_pipeline, utilization_report
+from saliency import input_gradients, per_output_gradients, gradient_saliency, \
+    token_attributions, add_attribution_args, attribution_settings
 from random import shuffle
 from operator import itemgetter
 import pprint
+import pickle
 from numpy import newaxis as na
 
 from string import punctuation
@@ -39,16 +53,6 @@ logger = logging.getLogger()
 def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
 
-def eval_ccc(y_true, y_pred):
-    """Computes concordance correlation coefficient."""
-    true_mean = np.mean(y_true)
-    true_var = np.var(y_true)
-    pred_mean = np.mean(y_pred)
-    pred_var = np.var(y_pred)
-    covar = np.cov(y_true, y_pred, bias=True)[0][1]
-    ccc = 2*covar / (true_var + pred_var +  (pred_mean-true_mean) ** 2)
-    return ccc
-
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for i in range(0, len(l), n):
@@ -75,12 +79,15 @@ def generateInputChunkHelper(data_chunk, length_chunk, tensor=True):
 '''
 yielding training batch for the training process
 '''
-def generateTrainBatch(input_data, input_target, input_length, token_lengths, args, batch_size=25):
+def generateTrainBatch(input_data, input_target, input_length, token_lengths, args, batch_size=25,
+                       shuffle_batches=None, return_index=False):
     # TODO: support input_data as a dictionary
     # get chunk
     input_size = len(input_data[list(input_data.keys())[0]]) # all values have same size
     index = [i for i in range(0, input_size)]
-    if batch_size != 1:
+    if shuffle_batches is None:
+        shuffle_batches = batch_size != 1
+    if shuffle_batches:
         shuffle(index)
     shuffle_chunks = [i for i in chunks(index, batch_size)]
     for chunk in shuffle_chunks:
@@ -108,6 +115,9 @@ def generateTrainBatch(input_data, input_target, input_length, token_lengths, ar
         # token length generating
         token_length_sort = \
             generateInputChunkHelper(token_length_chunk, length_chunk, tensor=False)
+        # video positions in the same (stable) order
+        index_sort = \
+            generateInputChunkHelper(chunk, length_chunk, tensor=False)
 
         # mask generation for the whole batch
         lstm_masks = torch.zeros(target_sort.size()[0], target_sort.size()[1], 1, dtype=torch.float)
@@ -116,68 +126,97 @@ def generateTrainBatch(input_data, input_target, input_length, token_lengths, ar
             lstm_masks[i,:length_chunk[i]] = 1
 
         # yielding for each batch
-        yield (yield_input_data, torch.unsqueeze(target_sort, dim=2), lstm_masks, length_chunk, token_length_sort)
-
-def evaluateOnEval(input_data, input_target, lengths, token_lengths, model, criterion, args, fig_path=None):
-    model.eval()
-    predictions = []
-    weights_total = []
-    gs_total = []
-    tf_attns_total = []
-    ctx_attns_total = []
-    actuals = []
-    data_num = 0
-    loss, ccc = 0.0, []
-    count = 0
-    index = 0
-    total_vid_count = len(input_data[list(input_data.keys())[0]])
-    for (data, target, mask, lengths, token_lengths) in generateTrainBatch(input_data,
-                                                            input_target,
-                                                            lengths,
-                                                            token_lengths, 
-                                                            args,
-                                                            batch_size=1):
-        print("Video #: " + str(index+1) + "/" + str(total_vid_count))
-        # send to device
-        mask = mask.to(args.device)
-        # send all data to the device
-        for mod in list(data.keys()):
-            data[mod] = data[mod].to(args.device)
-            data[mod] = Variable(data[mod], requires_grad=True)
-        target = target.to(args.device)
-        # Run forward pass
-        output = model.forward(data, lengths, token_lengths, mask)
+        if return_index:
+            yield (yield_input_data, torch.unsqueeze(target_sort, dim=2), lstm_masks, length_chunk,
+                   token_length_sort, index_sort)
+        else:
+            yield (yield_input_data, torch.unsqueeze(target_sort, dim=2), lstm_masks, length_chunk,
+                   token_length_sort)
+
+def evaluateBatch(batch, model, args, check_gradients=False):
+    '''
+    Runs the forward, NLAP, tf_attn and gradient passes over a batch of
+    generateTrainBatch (with return_index) and splits the results back per
+    video. Returns (video position, results) pairs. Every video gets the
+    same results as when it is run on its own, up to rounding: its outputs
+    are trimmed to its windows and its attention and gradients to its
+    longest window. check_gradients also logs how far the gradients of the
+    single windows, summed, are from the gradient of their sum.
+    '''
+    data, target, mask, lengths, token_lengths, index = batch
+    # send to device
+    mask = mask.to(args.device)
+    # send all data to the device
+    for mod in list(data.keys()):
+        data[mod] = data[mod].to(args.device)
+    target = target.to(args.device)
+
+    def forward(linguistic):
+        # any number of copies of the batch, stacked
+        copies = len(linguistic) // len(lengths)
+        with autocast(args.bf16):
+            return model.forward(dict(data, linguistic=linguistic), lengths * copies,
+                                 token_lengths * copies, mask.repeat(copies, 1, 1))
+
+    # Run forward pass, with the gradient w.r.t. inputs, the videos of a
+    # batch do not interact so every one gets its own gradient
+    output, grad = input_gradients(forward, data['linguistic'])
+    grad_sa = gradient_saliency(grad)
+    if check_gradients:
+        _, window_grads = per_output_gradients(forward, data['linguistic'])
+        logger.info('Batching check: per window gradients, max difference of their sum {:.2e}'.
+                    format(float((window_grads.sum(dim=0) - grad).abs().max())))
+    with torch.no_grad(), autocast(args.bf16):
         # Also get the weight
         weights = model.backward_nlap(data, lengths, token_lengths, mask)
         tf_weights, ctx_weights = model.backward_tf_attn(data, lengths, token_lengths, mask)
-        tf_attns_total.append(tf_weights)
-        ctx_attns_total.append(ctx_weights)
-        weights_total.append(weights)
-
-        # get gradient w.r.t. inputs here
-        output.backward(torch.ones_like(output))
-        grad_sa = (data[mod].grad**2).sum(dim=-1).squeeze(dim=0)
-        gs_total.append(grad_sa) 
-
-        predictions.append(output.reshape(-1).tolist())
-        actuals.append(target.reshape(-1).tolist())
-        # Compute loss
-        loss += criterion(output, target)
-        # Keep track of total number of time-points
-        data_num += sum(lengths)
-        # Compute correlation and CCC of predictions against ratings
-        output = torch.squeeze(torch.squeeze(output, dim=2), dim=0).cpu().detach().numpy()
-        target = torch.squeeze(torch.squeeze(target, dim=2), dim=0).cpu().detach().numpy()
-        if count == 0:
-            # print(output)
-            # print(target)
-            count += 1
-        curr_ccc = eval_ccc(output, target)
-        ccc.append(curr_ccc)
-        index += 1
-    # Average losses and print
-    loss /= data_num
-    return ccc, predictions, actuals, weights_total, tf_attns_total, ctx_attns_total, gs_total
+    # token scores of the attribution baselines
+    attributions = token_attributions(forward, data['linguistic'], args)
+
+    # split the batch back per video, windows are flattened as batch*len
+    max_len = max(lengths)
+    results = []
+    for b, (vid, l) in enumerate(zip(index, lengths)):
+        max_token = max(token_lengths[b][:l])
+        windows = slice(b*max_len, b*max_len + l)
+        results.append((vid, (
+            # Compute CCC of predictions against ratings
+            CCC().update(output[b:b+1, :l], target[b:b+1, :l]).compute(),
+            output[b, :l].reshape(-1).tolist(),
+            target[b, :l].reshape(-1).tolist(),
+            weights[windows, :max_token],
+            tf_weights[windows, :, :, :max_token, :max_token],
+            ctx_weights[windows, :max_token],
+            grad_sa[b, :l, :max_token]) +
+            tuple(score[b, :l, :max_token] for score in attributions)))
+    return results
+
+def checkBatching(eval_inputs, model, args):
+    '''
+    Runs the first args.check_batching videos one at a time and then in
+    batches of args.eval_batch_size, and logs the largest difference of
+    every result between the two runs, over the videos.
+    '''
+    videos = list(range(min(args.check_batching, len(eval_inputs[2]))))
+    def run(batch_size, check_gradients=False):
+        results = []
+        for start in range(0, len(videos), batch_size):
+            batch = videos[start:start + batch_size]
+            prepared = next(generateTrainBatch(*selectVideos(batch, *eval_inputs), args,
+                                               batch_size=len(batch), shuffle_batches=False,
+                                               return_index=True))
+            results += [r for _, r in sorted(evaluateBatch(prepared, model, args, check_gradients),
+                                             key=itemgetter(0))]
+        return results
+    single = run(1)
+    batched = run(args.eval_batch_size, check_gradients=True)
+    # output, weights, tf and ctx attention, gs and the attribution scores
+    names = ['output', 'weights', 'tf_attn', 'ctx_attn', 'gs'] + list(args.attributions)
+    fields = [1, 3, 4, 5, 6] + list(range(7, 7 + len(args.attributions)))
+    diffs = [max(float((torch.as_tensor(a[f]).float() - torch.as_tensor(b[f]).float()).abs().max())
+                 for a, b in zip(single, batched)) for f in fields]
+    logger.info('Batching check on {} videos, max difference from one video at a time: {}'.format(
+        len(videos), ', '.join('{} {:.2e}'.format(n, d) for n, d in zip(names, diffs))))
 
 def plot_predictions(dataset, predictions, metric, args, fig_path=None):
     """Plots predictions against ratings for representative fits."""
@@ -476,6 +515,21 @@ def softmax(x_in, axis=None):
     y = np.exp(x)
     return y / y.sum(axis=axis, keepdims=True)
 
+def selectVideos(videos, input_padded, ratings_padded, seq_lens, token_lens):
+    """The padded inputs, ratings and lengths of the videos at the given positions."""
+    input_padded = {mod: [input_padded[mod][v] for v in videos] for mod in input_padded}
+    return (input_padded, [ratings_padded[v] for v in videos], [seq_lens[v] for v in videos],
+            [token_lens[v] for v in videos])
+
+def normalizeSegments(padded, lengths, normalize=segment_softmax):
+    '''
+    Normalizes the first lengths[i] scores of every row of padded (a tensor,
+    rows x len) in one call, softmax by default. Returns the flat scores,
+    in float64 as softmax gives them, and the offsets of the rows.
+    '''
+    flat, offsets = pack_segments(padded.cpu().double().numpy(), lengths)
+    return normalize(flat, offsets), offsets
+
 def normalize_w(x):
     if max(x) == min(x):
         return [sum(x)*1.0/len(x) for w in x]
@@ -503,12 +557,12 @@ def SEND(args):
     mod_dimension = {'linguistic' : 300}
     window_size = {'linguistic' : 5, 'ratings' : 5, 'linguistic_text' : 5}
 
-    # loss function define
-    criterion = nn.MSELoss(reduction='sum')
     # construct model and params setting
     eval_dir = "Test"
     model_path = args.model_path
-    model = TransformerLSTMAttn(mods=args.modalities, dims=mod_dimension, device=args.device)
+    arch, checkpoint = read_checkpoint(model_path, args.device)
+    model = TransformerLSTMAttn(mods=args.modalities, dims=mod_dimension, device=args.device,
+                                arch=arch)
     # Setting the optimizer
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=1e-4)
 
@@ -551,19 +605,57 @@ def SEND(args):
     ratings_padded_eval = padRating(ratings_eval, max(seq_lens_eval))
 
     # load model
-    checkpoint = load_checkpoint(model_path, args.device)
-    model.load_state_dict(checkpoint['model'])
-
-    # evalution
+    load_model_weights(model_path, model, args.device, checkpoint)
+
+    # this shard's batches of videos, the same ones as in a single process run
+    videos, _ = shard_batches(list(range(len(seq_ids))), args.eval_batch_size,
+                              args.num_shards, args.shard_id)
+    seq_ids = [seq_ids[v] for v in videos]
+    saved_text = [saved_text[v] for v in videos]
+    eval_inputs = selectVideos(videos, input_padded_eval, ratings_padded_eval, seq_lens_eval,
+                               token_lens_eval)
+    # results saved by earlier runs of the same checkpoint
+    progress = ExtractionProgress(args.out_dir,
+                                  extraction_fingerprint(model_path, "SEND", args.bf16,
+                                                         *attribution_settings(args)),
+                                  shard_name(args.num_shards, args.shard_id), args.restart)
+
+    # evalution of the batches without saved results: batches are assembled
+    # on a loader thread and saved on a writer thread while the model runs
+    batches = [[v for v in range(start, min(start + args.eval_batch_size, len(seq_ids)))
+                if seq_ids[v] not in progress]
+               for start in range(0, len(seq_ids), args.eval_batch_size)]
+    batches = [batch for batch in batches if len(batch) > 0]
+    model.eval()
+    if args.check_batching > 0:
+        checkBatching(eval_inputs, model, args)
+
+    def load():
+        for batch in batches:
+            yield batch, next(generateTrainBatch(*selectVideos(batch, *eval_inputs), args,
+                                                 batch_size=len(batch), shuffle_batches=False,
+                                                 return_index=True))
+
+    def compute(item):
+        batch, prepared = item
+        return batch, evaluateBatch(prepared, model, args)
+
+    def write(item):
+        batch, results = item
+        progress.save({seq_ids[batch[vid]]: result for vid, result in results})
+        logger.info("Videos: {}/{}".format(batch[-1] + 1, len(seq_ids)))
+
+    logger.info(utilization_report(*run_pipeline(load(), compute, write, args.pipeline_depth)))
+    results = progress.load(seq_ids)
     ccc, pred, actuals, weights_total, tf_attns_total, ctx_attns_total, gs_total = \
-        evaluateOnEval(input_padded_eval, ratings_padded_eval, seq_lens_eval, token_lens_eval,
-                        model, criterion, args)
+        [list(r) for r in zip(*[r[:7] for r in results])]
+    # the token scores of the attribution baselines, after the gs ones
+    attributions_total = [r[7:] for r in results]
     stats = {'ccc': np.mean(ccc), 'ccc_std': np.std(ccc)}
     logger.info('Evaluation\tCCC(std): {:2.5f}({:2.5f})'.\
         format(stats['ccc'], stats['ccc_std']))
 
     # get top ccc
-    seq_ids = getSeqList(eval_data.seq_ids)
     seq_ccc = list(zip(seq_ids, ccc))
     seq_ccc = sorted(seq_ccc,key=lambda x:(-x[1],x[0]))
 
@@ -579,10 +671,6 @@ def SEND(args):
 
     # print out the word weight mappings
     print("Writing to files...")
-    post_file = "_send.csv"
-    word_level_w = dict()
-    word_level_gs = dict()
-    word_level_c = dict()
 
     # save id to weights mapping for other plots
     weights_plot = dict()
@@ -594,6 +682,7 @@ def SEND(args):
     ctx_attns_plot = dict()
 
     seq_ccc_plot = dict()
+    words = WordAggregator(('score', 'gs') + tuple(args.attributions))
 
     for i in range(len(seq_ccc)):
         actual_r = actuals[seq_index[i]]
@@ -631,15 +720,21 @@ def SEND(args):
         for iii in range(len(actual_r)):
             labels_plot[seq_id].append((actual_r[iii], pred_r[iii]))
 
+        # softmax of the scores of every window, over the video at once
+        words_v = [[w.strip().strip(punctuation).lower() for w in word_t] for word_t in word]
+        lengths = [len(word_t) for word_t in words_v]
+        norm_w = split_segments(*normalizeSegments(weights, lengths))
+        norm_gs = split_segments(*normalizeSegments(gs, lengths))
+        # the attributions are signed, scaled by their largest magnitude instead
+        norm_attributions = [split_segments(*normalizeSegments(score, lengths, segment_absmax))
+                             for score in attributions_total[seq_index[i]]]
+
         for t in range(len(saved_text[seq_index[i]])):
             row = [(t+1)*5.0, actual_r[t], pred_r[t]]
-            word_t = [w.strip().strip(punctuation).lower() for w in word[t]]
-
-            word_w = weights[t].tolist()[:len(word_t)]
-            word_gs = gs[t].tolist()[:len(word_t)]
+            word_t = words_v[t]
 
-            norm_word_w_t = softmax(word_w).tolist()
-            norm_word_gs_t = softmax(word_gs).tolist()
+            norm_word_w_t = norm_w[t].tolist()
+            norm_word_gs_t = norm_gs[t].tolist()
             # norm_word_w_t = normalize_lap(word_w)
             # print(norm_word_w_t)
 
@@ -655,58 +750,62 @@ def SEND(args):
             weights_plot[seq_id].append(norm_word_w_t)
             sentence_plot[seq_id].append(word_t)
             gs_plot[seq_id].append(norm_word_gs_t)
+            # keyed by the order of a single process run, best CCC first
+            words.add(word_t, [norm_word_w_t, norm_word_gs_t] +
+                      [norm[t].tolist() for norm in norm_attributions], key=(-ccc, seq_id, t))
+
+            tf_attns_plot[seq_id].append(tf_attn[t,:,:,:len(word_t),:len(word_t)])
+            ctx_attns_plot[seq_id].append(ctx_attn[t,:len(word_t)])
+
+    outputs = {"seq_weights_test_send.p": weights_plot,
+               "seq_gs_test_send.p": gs_plot,
+               "seq_labels_test_send.p": labels_plot,
+               "seq_sentences_test_send.p": sentence_plot,
+               "seq_ccc_test_send.p": seq_ccc_plot}
+    # attention stores, read with attn_store.AttnStore
+    attn_names = ["seq_tf_attns_test_send", "seq_ctx_attns_test_send"]
+    if args.num_shards > 1:
+        save_shard(args.out_dir, args.num_shards, args.shard_id,
+                   dict(outputs, **{"words_send.p": words}))
+        write_attn_stores(shard_dir(args.out_dir, args.num_shards, args.shard_id), attn_names,
+                          tf_attns_plot, ctx_attns_plot, args)
+        return None
+    writeSEND(args.out_dir, outputs, words)
+    write_attn_stores(args.out_dir, attn_names, tf_attns_plot, ctx_attns_plot, args)
+    return None
 
-            tf_attns_plot[seq_id].append(tf_attn[t,:,:,:len(word_t),:len(word_t)].tolist())
-            ctx_attns_plot[seq_id].append(ctx_attn[t,:len(word_t)].tolist())
-
-            for i in range(len(word_t)):
-                # normalize by the length as well
-                w_i = 1.0 * norm_word_w_t[i]
-                gs_i = 1.0 * norm_word_gs_t[i]
-                w_s = word_t[i]
-                if w_s not in word_level_w.keys():
-                    word_level_w[w_s] = [w_i]
-                    word_level_gs[w_s] = [gs_i]
-                else:
-                    word_level_w[w_s].append(w_i)
-                    word_level_gs[w_s].append(gs_i)
-                if w_s not in word_level_c.keys():
-                    word_level_c[w_s] = 1
-                else:
-                    word_level_c[w_s] = word_level_c[w_s] + 1
-
-    output_file = args.out_dir + "/words_" + eval_dir + post_file
-    word_level_w = [(k, v) for k, v in word_level_w.items()] 
-    
-    with open(output_file, mode='w') as csv_file:
-        file_writer = csv.writer(csv_file, delimiter=',')
-        header = ["word", "count", "sum", "avg", "std", "sum_gs", "avg_gs", "std_gs"]
-        file_writer.writerow(header)
-        for kv in word_level_w:
-            var = 0.0
-            var_gs = 0.0
-            kv_gs = word_level_gs[kv[0]]
-            if len(kv[1]) > 1:
-                var = statistics.stdev(kv[1])
-                var_gs = statistics.stdev(kv_gs)
-            row = [kv[0], word_level_c[kv[0]], sum(kv[1]),
-                   sum(kv[1])*1.0/word_level_c[kv[0]], var,
-                   sum(kv_gs), sum(kv_gs)*1.0/word_level_c[kv[0]], var_gs]
-            file_writer.writerow(row)
+def writeSEND(out_dir, outputs, words):
+    '''
+    Writes the per video outputs of SEND, and the per word statistics
+    gathered in words (a WordAggregator).
+    '''
+    words.write_csv(out_dir + "/words_Test_send.csv")
 
     # save id to weight mapping
-    import pickle
-    # print(labels_plot)
-    # print(sentence_plot)
-    pickle.dump( weights_plot, open(args.out_dir + "/seq_weights_test_send.p", "wb") )
-    pickle.dump( gs_plot, open(args.out_dir + "/seq_gs_test_send.p", "wb") )
-    pickle.dump( labels_plot, open(args.out_dir + "/seq_labels_test_send.p", "wb") )
-    pickle.dump( sentence_plot, open(args.out_dir + "/seq_sentences_test_send.p", "wb") )
-    pickle.dump( tf_attns_plot, open(args.out_dir + "/seq_tf_attns_test_send.p", "wb") )
-    pickle.dump( ctx_attns_plot, open(args.out_dir + "/seq_ctx_attns_test_send.p", "wb") )
-    pickle.dump( seq_ccc_plot, open(args.out_dir + "/seq_ccc_test_send.p", "wb") )
+    for name, obj in outputs.items():
+        pickle.dump( obj, open(out_dir + "/" + name, "wb") )
 
-    return None
+def mergeSEND(args):
+    """Merges the shards of SEND into the outputs of a single process run."""
+    seq_ccc_plot = merge_dicts(load_shards(args.out_dir, args.num_shards, "seq_ccc_test_send.p"))
+    ccc = list(seq_ccc_plot.values())
+    logger.info('Evaluation\tCCC(std): {:2.5f}({:2.5f})'.\
+        format(np.mean(ccc), np.std(ccc)))
+    seq_order = [seq_id for seq_id, _ in
+                 sorted(seq_ccc_plot.items(), key=lambda x:(-x[1],x[0]))]
+    outputs = {}
+    for name in ["seq_weights_test_send.p", "seq_gs_test_send.p", "seq_labels_test_send.p",
+                 "seq_sentences_test_send.p", "seq_ccc_test_send.p"]:
+        outputs[name] = merge_dicts(load_shards(args.out_dir, args.num_shards, name), seq_order)
+    shards_words = load_shards(args.out_dir, args.num_shards, "words_send.p")
+    words = WordAggregator(shards_words[0].score_names)
+    for shard_words in shards_words:
+        words.merge(shard_words)
+    writeSEND(args.out_dir, outputs, words)
+    for name in ["seq_tf_attns_test_send", "seq_ctx_attns_test_send"]:
+        merge_attn_stores([shard_dir(args.out_dir, args.num_shards, k) + "/" + name
+                           for k in range(args.num_shards)],
+                          args.out_dir + "/" + name, seq_order)
 
 def generate_class(raw_in):
     _class = dict()
@@ -752,6 +851,11 @@ def sortSST(data_chunk, length_chunk, tensor=True):
     return data_sort
 
 def generateBatchSST(input_data, input_target, seq_ids, args, batch_size=1):
+    if isinstance(input_data, RaggedStore):
+        yield from generateBatchStore(input_data, input_target, args, batch_size,
+                                      shuffle_batches=False, return_ids=True,
+                                      index=[input_data.index_of(_id) for _id in seq_ids])
+        return
     # select batch sentence id
     index = [i for i in range(0, len(seq_ids))]
     shuffle_chunks = [i for i in chunks(index, batch_size)] # contains array index
@@ -776,33 +880,6 @@ def generateBatchSST(input_data, input_target, seq_ids, args, batch_size=1):
             mask[i,:seq_len[i]] = 1
         yield sort_feature, sort_targets, seq_len, mask, sort_chunk_ids
 
-def oneHotVector(sort_targets):
-    n_class = 5
-    batch_size = sort_targets.shape[0]
-    target = torch.zeros((batch_size, int(n_class)), dtype=torch.float).to(args.device)
-    for i in range(batch_size):
-        target[i][int(sort_targets[i]) - 1] = 1.0
-    return target
-
-def calculate_accuracy(predict, actual):
-    _, predicted = torch.max(predict, dim=-1)
-    multiclass = 0
-    for i in range(predict.shape[0]):
-        if int(predicted[i]) == int(actual[i]) - 1:
-            multiclass += 1
-
-    binary = 0
-    binary_total = 0 # will not count nuetural cases
-    for i in range(predict.shape[0]):
-        if int(actual[i]) != 3:
-            binary_total += 1
-            if int(actual[i]) < 3 and int(predicted[i]) < 2:
-                binary += 1
-            elif int(actual[i]) > 3 and int(predicted[i]) > 2:
-                binary += 1
-
-    return multiclass, binary, binary_total
-
 def stringOut(sort_targets, output):
     _, predicted = torch.max(output, dim=-1)
     ret = []
@@ -850,7 +927,11 @@ def SST(args):
     print("Loading SST data ...")
     data_folder = args.data_dir
     import pickle
-    test_data = pickle.load( open( data_folder + "id_embed_test.p", "rb" ) )
+    if args.sst_store is not None:
+        # memory-mapped float32 store written by corpus_store.py
+        test_data = open_sst_split(args.sst_store, 'test')
+    else:
+        test_data = pickle.load( open( data_folder + "id_embed_test.p", "rb" ) )
     test_target = pickle.load( open( data_folder + "id_rating_test.p", "rb" ) )
     all_sentence = pickle.load( open( data_folder + "id_sentence.p", "rb" ) )
     assert(len(test_data) == len(test_target))
@@ -874,11 +955,12 @@ def SST(args):
     # loss function define
     criterion = nn.BCELoss(reduction='sum')
     # construct model
-    model = TransformerLinearAttn(mods=args.modalities, dims=mod_dimension, device=args.device)
-    # load model
     model_path = args.model_path
-    checkpoint = load_checkpoint(model_path, args.device)
-    model.load_state_dict(checkpoint['model'])
+    arch, checkpoint = read_checkpoint(model_path, args.device)
+    model = TransformerLinearAttn(mods=args.modalities, dims=mod_dimension, device=args.device,
+                                  arch=arch)
+    # load model
+    load_model_weights(model_path, model, args.device, checkpoint)
 
     # print(count_parameters(model))
     # return
@@ -887,136 +969,170 @@ def SST(args):
     best_multi_acur = -1.0
     best_binary_acur = -1.0
     args.batch_size = 500
-    multiclass_correct = 0
-    binary_correct = 0
-    multiclass_instance = 0
-    binary_instance = 0
-    weights = []
-    gradients = []
     seq_ids = [k for k in test_data.keys()]
-    sort_seq_ids = []
+    # positions in the full test set, the same in every shard and run
+    position = {_id: i for i, _id in enumerate(seq_ids)}
+    # this shard's batches, the same ones as in a single process run
+    seq_ids, batch_index = shard_batches(seq_ids, args.batch_size, args.num_shards, args.shard_id)
+    # results saved by earlier runs of the same checkpoint
+    progress = ExtractionProgress(args.out_dir,
+                                  extraction_fingerprint(model_path, "SST", args.bf16,
+                                                         *attribution_settings(args)),
+                                  shard_name(args.num_shards, args.shard_id), args.restart)
 
     model.eval()
-    # save for output labels
-    stringOuts = []
     print("Running forward step to extract weights ...")
     # get the loss of test set
     model.zero_grad()
-    # for each epoch do the training
-    for sort_feature, sort_targets, seq_len, mask, sort_chunk_ids in \
-        generateBatchSST(test_data, test_class, seq_ids, args, batch_size=500):
+    # the batches without saved results: sentences are batched on a loader
+    # thread, normalized and saved on a writer thread while the model runs
+    pending_batches = [(k, b, progress.pending(seq_ids[k*args.batch_size:(k+1)*args.batch_size]))
+                       for k, b in enumerate(batch_index)]
+    pending_batches = [batch for batch in pending_batches if len(batch[2]) > 0]
+
+    def load():
+        for k, b, pending in pending_batches:
+            for batch in generateBatchSST(test_data, test_class, pending, args, batch_size=500):
+                yield k, b, batch
+
+    def compute(item):
+        k, b, (sort_feature, sort_targets, seq_len, mask, sort_chunk_ids) = item
         # send to device
         mask = mask.to(args.device)
         sort_feature = sort_feature.to(args.device)
         sort_targets = sort_targets.to(args.device)
-        # Run forward pass.
-        sort_feature = Variable(sort_feature, requires_grad=True)
-        output = model(sort_feature, seq_len, mask)
+
+        def forward(feature):
+            # any number of copies of the batch, stacked
+            copies = len(feature) // len(seq_len)
+            with autocast(args.bf16):
+                return model(feature, seq_len * copies, mask.repeat(copies, 1))
+
+        # Run forward pass, with the gradient w.r.t. inputs
+        output, grad = input_gradients(forward, sort_feature)
+        grad_sa = gradient_saliency(grad)
 
         # produce readable string encoded results
         stringout = stringOut(sort_targets, output)
         # Weights and collect outputs
-        weight = None
-        weight = model.backward_nlap(sort_feature, seq_len, mask)
-        for i in range(weight.shape[0]):
-            weights.append(weight[i])
-            stringOuts.append(stringout[i])
-        sort_seq_ids.extend(sort_chunk_ids)
-        multiclass, binary, binary_total = calculate_accuracy(output, sort_targets)
-        multiclass_correct += multiclass
-        multiclass_instance += len(seq_len)
-        binary_correct += binary
-        binary_instance += binary_total
-
-        # get gradient w.r.t. inputs here
-        output.backward(torch.ones_like(output))
-        grad_sa = (sort_feature.grad**2).sum(dim=-1)
-        for i in range(weight.shape[0]):
-            gradients.append(grad_sa[i])
-
-    multi_accu = multiclass_correct*1.0/multiclass_instance
-    binary_accu = binary_correct*1.0/binary_instance
+        with torch.no_grad(), autocast(args.bf16):
+            weight = model.backward_nlap(sort_feature, seq_len, mask)
+        # token scores of the attribution baselines
+        attributions = token_attributions(forward, sort_feature, args)
+        return (k, b, sort_chunk_ids, seq_len, stringout, weight, grad_sa, output.cpu(),
+                sort_targets.cpu(), attributions)
+
+    def write(result):
+        k, b, sort_chunk_ids, seq_len, stringout, weight, grad_sa, output, sort_targets, \
+            attributions = result
+        # softmax of the scores of every sentence, over the batch at once
+        lengths = [len(all_sentence[_id]) for _id in sort_chunk_ids]
+        weights = split_segments(*normalizeSegments(weight, lengths))
+        gradients = split_segments(*normalizeSegments(grad_sa, lengths))
+        # the attributions are signed, scaled by their largest magnitude instead
+        attributions = [split_segments(*normalizeSegments(score, lengths, segment_absmax))
+                        for score in attributions]
+        # a single process run sorts the sentences of a batch by length, then
+        # by position; keyed by the full test set, not the pending ids of the
+        # batch, so that runs adding new ids keep the same order
+        progress.save({_id: ((b, -seq_len[i], position[_id]), stringout[i], weights[i], gradients[i],
+                             output[i], sort_targets[i]) +
+                            tuple(score[i] for score in attributions)
+                       for i, _id in enumerate(sort_chunk_ids)})
+        logger.info("Batches: {}/{}".format(k + 1, len(batch_index)))
+
+    logger.info(utilization_report(*run_pipeline(load(), compute, write, args.pipeline_depth)))
+
+    results = dict(zip(seq_ids, progress.load(seq_ids)))
+    sort_seq_ids = sorted(seq_ids, key=lambda _id: results[_id][0])
+    batch_seq_ids = [[_id for _id in sort_seq_ids if results[_id][0][0] == b] for b in batch_index]
+    accuracy = SSTAccuracy()
+    accuracy.update(torch.stack([results[_id][4] for _id in sort_seq_ids]),
+                    torch.stack([results[_id][5] for _id in sort_seq_ids]))
+    multi_accu, binary_accu = accuracy.compute()
     logger.info('Test Set Performance\tmulti_acc: {:0.3f} \tbinary_acc: {:0.3f} \t'.\
         format(multi_accu, binary_accu))
     print("Start analyzing ...")
 
-    # weights: (b, l)
-    test_sentence = [all_sentence[_id] for _id in sort_seq_ids]
-    assert(len(test_sentence) == len(weights))
-
-    word_level_w = dict()
-    word_level_g = dict()
-    word_level_c = dict()
-
     # save id to weights mapping for other plots
     id_weights = dict()
     id_labels = dict()
     id_gradients = dict()
-
-    for i in range(len(test_sentence)):
-        w = weights[i]
-        g = gradients[i]
-        s = test_sentence[i]
-        w_r_pre = w[:len(s)].tolist()
-        g_r_pre = g[:len(s)].tolist()
-
-        w_r = None
-        w_r = softmax(w_r_pre) 
-        g_r = softmax(g_r_pre) 
-        id_weights[sort_seq_ids[i]] = w_r.tolist()
-        id_labels[sort_seq_ids[i]] = stringOuts[i]
-        id_gradients[sort_seq_ids[i]] = g_r.tolist()
-
-        # assign scores based on softmax results and sentence length
-        for i in range(len(s)):
-            w_w = w_r[i] * 1.0
-            g_w = g_r[i] * 1.0
-            w_s = s[i]
-            if w_s not in word_level_w.keys():
-                word_level_w[w_s] = [w_w]
-                word_level_g[w_s] = [g_w]
-            else:
-                word_level_w[w_s].append(w_w)   
-                word_level_g[w_s].append(g_w)      
-            if w_s not in word_level_c.keys():
-                word_level_c[w_s] = 1
-            else:
-                word_level_c[w_s] = word_level_c[w_s] + 1
-    
+    words = WordAggregator(('score', 'gs') + tuple(args.attributions))
+
+    for _id in sort_seq_ids:
+        key, stringout, w_r, g_r = results[_id][:4]
+        id_weights[_id] = w_r.tolist()
+        id_labels[_id] = stringout
+        id_gradients[_id] = g_r.tolist()
+        # the attribution baselines are saved after the outputs and targets
+        words.add(all_sentence[_id], [w_r, g_r] + list(results[_id][6:]), key=key)
+
+    outputs = {"id_gradients_test_sst.p": id_gradients,
+               "id_weights_test_sst.p": id_weights,
+               "id_labels_test_sst.p": id_labels}
+    if args.num_shards > 1:
+        # the batch positions give the order of a single process run
+        outputs["shard.p"] = {'batches': list(zip(batch_index, batch_seq_ids)),
+                              'accuracy': accuracy, 'words': words}
+        save_shard(args.out_dir, args.num_shards, args.shard_id, outputs)
+        return
+    writeSST(args.out_dir, outputs, words)
+
+def writeSST(out_dir, outputs, words):
+    '''
+    Writes the per sentence outputs of SST, and the per word statistics
+    gathered in words (a WordAggregator).
+    '''
     # save id to weight mapping
-    pickle.dump( id_gradients, open( args.out_dir + "/id_gradients_test_sst.p", "wb") )
-    pickle.dump( id_weights, open(args.out_dir + "/id_weights_test_sst.p", "wb") )
-    pickle.dump( id_labels, open(args.out_dir + "/id_labels_test_sst.p", "wb") )
+    for name, obj in outputs.items():
+        pickle.dump( obj, open(out_dir + "/" + name, "wb") )
 
     # summarize and write to a file
-    output_file = args.out_dir + "/words_Test_sst.csv"
-    word_level_w = [(k, v) for k, v in word_level_w.items()] 
-
-    with open(output_file, mode='w') as csv_file:
-        file_writer = csv.writer(csv_file, delimiter=',')
-        header = ["word", "count", "sum", "avg", "std", "sum_gs", "avg_gs", "std_gs"]
-        file_writer.writerow(header)
-
-        for kv in word_level_w:
-            kv_gs = word_level_g[kv[0]]
-            var = 0.0
-            var_gs = 0.0
-            if len(kv[1]) > 1:
-                var = statistics.stdev(kv[1])
-                var_gs = statistics.stdev(kv_gs)
-
-            row = [kv[0], word_level_c[kv[0]], sum(kv[1]),
-                   sum(kv[1])*1.0/word_level_c[kv[0]], var,
-                   sum(kv_gs), sum(kv_gs)*1.0/word_level_c[kv[0]], var_gs]
-            file_writer.writerow(row)
+    words.write_csv(out_dir + "/words_Test_sst.csv")
+
+def mergeSST(args):
+    """Merges the shards of SST into the outputs of a single process run."""
+    shards = load_shards(args.out_dir, args.num_shards, "shard.p")
+    sort_seq_ids = [_id for _, ids in
+                    sorted(b for shard in shards for b in shard['batches']) for _id in ids]
+    accuracy = SSTAccuracy()
+    words = WordAggregator(shards[0]['words'].score_names)
+    for shard in shards:
+        accuracy.merge(shard['accuracy'])
+        words.merge(shard['words'])
+    multi_accu, binary_accu = accuracy.compute()
+    logger.info('Test Set Performance\tmulti_acc: {:0.3f} \tbinary_acc: {:0.3f} \t'.\
+        format(multi_accu, binary_accu))
+    outputs = {}
+    for name in ["id_gradients_test_sst.p", "id_weights_test_sst.p", "id_labels_test_sst.p"]:
+        outputs[name] = merge_dicts(load_shards(args.out_dir, args.num_shards, name), sort_seq_ids)
+    writeSST(args.out_dir, outputs, words)
 
-def main(args):
+def extract(args):
     if args.dataset == "SST":
         SST(args)
     elif args.dataset == "SEND":
         SEND(args)
     else:
         assert(False)
+
+def merge(args):
+    if args.dataset == "SST":
+        mergeSST(args)
+    elif args.dataset == "SEND":
+        mergeSEND(args)
+    else:
+        assert(False)
+
+def main(args):
+    if args.launch and args.num_shards > 1:
+        launch_shards(extract, args, args.num_shards)
+        merge(args)
+    elif args.merge:
+        merge(args)
+    else:
+        extract(args)
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -1032,5 +1148,19 @@ if __name__ == "__main__":
                         help='path to the saved model (end with .pth)')
     parser.add_argument('--out_dir', type=str, default="../save_lap/",
                         help='the directory to save all the results')
+    parser.add_argument('--sst_store', type=str, default=None,
+                        help='directory of SST stores made by corpus_store.py (default: load pickles)')
+    parser.add_argument('--eval_batch_size', type=int, default=16,
+                        help='SEND videos per extraction step (default: 16)')
+    parser.add_argument('--check_batching', type=int, default=0, metavar='N',
+                        help='first compare the SEND results of N videos run one at a time and '
+                             'in batches, and log the largest differences (default: 0, off)')
+    parser.add_argument('--bf16', action='store_true',
+                        help='run the model under bfloat16 autocast on the CPU')
+    add_store_args(parser)
+    add_progress_args(parser)
+    add_pipeline_args(parser)
+    add_attribution_args(parser)
+    add_shard_args(parser)
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,377 @@
+"""Chunked binary store for the attention weights extracted per sentence (SST)
+or per video (SEND), in place of pickles of nested lists. The arrays are
+appended to chunk files in float16 or float32 with a JSON index of the id
+offsets, and read back lazily through memory maps. The attention rows can
+also be stored lossily (top-k, uint8 or thresholded CSR), with a report of
+the error this makes on the NLAP trace."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+import argparse
+from collections.abc import Mapping
+
+import numpy as np
+import torch
+
+INDEX = 'index.json'
+DTYPES = ('float16', 'float32')
+CODECS = ('dense', 'topk', 'uint8', 'csr')
+
+def add_store_args(parser):
+    parser.add_argument('--attn_dtype', type=str, default="float16",
+                        help='precision of the stored attention, {} (default: float16)'.format(
+                            ' or '.join(DTYPES)))
+    parser.add_argument('--attn_codec', type=str, default="dense",
+                        help='storage of the self attention rows, {} (default: dense)'.format(
+                            ', '.join(CODECS)))
+    parser.add_argument('--attn_topk', type=int, default=8,
+                        help='weights kept per attention row with --attn_codec topk (default: 8)')
+    parser.add_argument('--attn_threshold', type=float, default=1e-3,
+                        help='smallest weight kept with --attn_codec csr (default: 1e-3)')
+    return parser
+
+def store_options(args):
+    """The AttnStoreWriter options given by add_store_args."""
+    return {'dtype': args.attn_dtype, 'codec': args.attn_codec,
+            'topk': args.attn_topk, 'threshold': args.attn_threshold}
+
+def _to_numpy(value):
+    if torch.is_tensor(value):
+        return value.detach().cpu().float().numpy()
+    return np.asarray(value, dtype=np.float32)
+
+def _index_dtype(length):
+    """Smallest dtype for the positions in a row of the given length."""
+    for dtype in (np.uint8, np.uint16):
+        if length <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.int32
+
+def _encode(array, codec, dtype, topk, threshold):
+    '''
+    The arrays storing one attention array under codec. The lossy codecs
+    work on the rows of the last axis, which hold non-negative weights:
+    topk keeps the topk largest weights of every row and their positions,
+    uint8 rounds every row to 255 steps of its maximum, and csr keeps the
+    weights of at least threshold in compressed sparse rows.
+    '''
+    length = array.shape[-1]
+    if codec == 'dense':
+        return {'data': array.astype(dtype)}
+    if codec == 'topk':
+        k = min(topk, length)
+        if k == 0:
+            indices = np.zeros(array.shape[:-1] + (0,), dtype=np.int64)
+        else:
+            indices = np.argpartition(-array, k - 1, axis=-1)[..., :k]
+        return {'values': np.take_along_axis(array, indices, axis=-1).astype(dtype),
+                'indices': indices.astype(_index_dtype(length))}
+    if codec == 'uint8':
+        # quantize with the stored scale, so decoding inverts it exactly
+        scale = (np.max(array, axis=-1, keepdims=True, initial=0.0) / 255).astype(dtype)
+        safe = np.where(scale > 0, scale, 1).astype(np.float32)
+        quantized = np.clip(np.round(array / safe), 0, 255).astype(np.uint8)
+        return {'quantized': quantized, 'scale': scale}
+    rows = array.reshape(int(np.prod(array.shape[:-1])), length)
+    keep = rows >= threshold
+    indptr = np.concatenate([[0], np.cumsum(keep.sum(axis=1))]).astype(np.int64)
+    return {'indptr': indptr,
+            'indices': np.nonzero(keep)[1].astype(_index_dtype(length)),
+            'data': rows[keep].astype(dtype)}
+
+def _decode(arrays, shape, codec):
+    """Inverse of _encode, a float32 array of the given shape."""
+    if codec == 'dense':
+        return arrays['data'].astype(np.float32).reshape(shape)
+    array = np.zeros(shape, dtype=np.float32)
+    if codec == 'topk':
+        np.put_along_axis(array, arrays['indices'].astype(np.int64),
+                          arrays['values'].astype(np.float32), axis=-1)
+        return array
+    if codec == 'uint8':
+        return arrays['quantized'].astype(np.float32) * arrays['scale'].astype(np.float32)
+    rows = array.reshape(int(np.prod(shape[:-1])), shape[-1])
+    counts = np.diff(arrays['indptr'])
+    rows[np.repeat(np.arange(len(counts)), counts),
+         arrays['indices'].astype(np.int64)] = arrays['data'].astype(np.float32)
+    return array
+
+class AttnStoreWriter(object):
+    '''
+    Writes the attention of every id to chunk files of about chunk_bytes
+    each. An id holds one array, or a list of arrays (the windows of a SEND
+    video), of any shape, stored with one of CODECS (see _encode). The
+    index is written on close, so a store that is being written is never
+    read half done.
+    '''
+
+    def __init__(self, path, dtype='float16', chunk_bytes=64 << 20, codec='dense',
+                 topk=8, threshold=1e-3):
+        if dtype not in DTYPES:
+            raise ValueError('dtype must be one of {}'.format(', '.join(DTYPES)))
+        if codec not in CODECS:
+            raise ValueError('codec must be one of {}'.format(', '.join(CODECS)))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.chunk_bytes = chunk_bytes
+        self.codec = codec
+        self.params = {'topk': topk, 'threshold': threshold}
+        self.chunks = []
+        self.entries = []
+        self._file = None
+        self._size = 0
+
+    def _new_chunk(self):
+        if self._file is not None:
+            self._file.close()
+        name = 'chunk-{:05d}.bin'.format(len(self.chunks))
+        self.chunks.append(name)
+        self._file = open(os.path.join(self.path, name), 'wb')
+        self._size = 0
+
+    def _write(self, array):
+        array = np.ascontiguousarray(array)
+        if self._file is None or self._size >= self.chunk_bytes:
+            self._new_chunk()
+        # keep every array aligned to its item size in the chunk
+        pad = -self._size % 8
+        self._file.write(b'\0' * pad)
+        self._size += pad
+        # chunk, offset in bytes, shape and dtype of the array
+        location = [len(self.chunks) - 1, self._size, list(array.shape), array.dtype.name]
+        self._file.write(array.tobytes())
+        self._size += array.nbytes
+        return location
+
+    def _write_part(self, shape, arrays):
+        return {'shape': list(shape),
+                'arrays': {name: self._write(array) for name, array in arrays.items()}}
+
+    def _encode_part(self, value):
+        array = _to_numpy(value)
+        return self._write_part(array.shape, _encode(array, self.codec, self.dtype,
+                                                     self.params['topk'],
+                                                     self.params['threshold']))
+
+    def add(self, _id, value):
+        if isinstance(_id, np.generic):
+            _id = _id.item()
+        if isinstance(value, (list, tuple)):
+            self.entries.append({'id': _id, 'parts': [self._encode_part(v) for v in value]})
+        else:
+            self.entries.append({'id': _id, 'array': self._encode_part(value)})
+
+    def add_encoded(self, _id, parts, is_list):
+        """Adds the (shape, arrays) parts of an id as read by AttnStore.encoded."""
+        parts = [self._write_part(shape, arrays) for shape, arrays in parts]
+        self.entries.append({'id': _id, 'parts': parts} if is_list else
+                            {'id': _id, 'array': parts[0]})
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        index = {'dtype': self.dtype.name, 'codec': self.codec, 'params': self.params,
+                 'chunks': self.chunks, 'entries': self.entries}
+        tmp_path = os.path.join(self.path, INDEX + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class AttnStore(Mapping):
+    '''
+    Read side of AttnStoreWriter, a read-only mapping of id to float32
+    tensor (or list of tensors), decoded to the dense shape whatever the
+    codec. Only the index is loaded up front; a chunk file is memory-mapped
+    the first time one of its ids is read, so a plot of a few sentences
+    only pages in their attention.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX)) as f:
+            index = json.load(f)
+        self.dtype = np.dtype(index['dtype'])
+        self.codec = index['codec']
+        self.params = index['params']
+        self.chunks = index['chunks']
+        self._entries = {entry['id']: entry for entry in index['entries']}
+        self._maps = {}
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, INDEX))
+
+    def _chunk(self, k):
+        if k not in self._maps:
+            self._maps[k] = np.memmap(os.path.join(self.path, self.chunks[k]),
+                                      dtype=np.uint8, mode='r')
+        return self._maps[k]
+
+    def _array(self, location):
+        chunk, offset, shape, dtype = location
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        return self._chunk(chunk)[offset:offset + size].view(dtype).reshape(shape)
+
+    def _parts(self, entry):
+        parts = entry['parts'] if 'parts' in entry else [entry['array']]
+        return [(part['shape'], {name: self._array(location)
+                                 for name, location in part['arrays'].items()})
+                for part in parts]
+
+    def encoded(self, _id):
+        '''
+        The stored (shape, arrays) parts of an id, memory-mapped and not
+        decoded, and whether the id holds a list.
+        '''
+        entry = self._entries[_id]
+        return self._parts(entry), 'parts' in entry
+
+    def nbytes(self):
+        """Size of the stored arrays."""
+        return sum(os.path.getsize(os.path.join(self.path, chunk)) for chunk in self.chunks)
+
+    def __getitem__(self, _id):
+        parts, is_list = self.encoded(_id)
+        values = [torch.from_numpy(_decode(arrays, shape, self.codec))
+                  for shape, arrays in parts]
+        return values if is_list else values[0]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, _id):
+        return _id in self._entries
+
+def write_attn_store(path, items, dtype='float16', **options):
+    '''
+    Writes a dict (or list of pairs) of id to attention into a store, with
+    the codec options of AttnStoreWriter.
+    '''
+    items = items.items() if isinstance(items, dict) else items
+    with AttnStoreWriter(path, dtype, **options) as writer:
+        for _id, value in items:
+            writer.add(_id, value)
+
+def write_attn_stores(out_dir, names, tf_attns, ctx_attns, args):
+    '''
+    Writes the self and context attention of an extraction to the stores
+    names (self, context) in out_dir. The self attention takes the codec of
+    add_store_args, whose error on the NLAP trace is reported when it is
+    lossy; the context attention, a few values per id, is kept dense.
+    '''
+    tf_path, ctx_path = [os.path.join(out_dir, name) for name in names]
+    write_attn_store(tf_path, tf_attns, **store_options(args))
+    write_attn_store(ctx_path, ctx_attns, args.attn_dtype)
+    if args.attn_codec != 'dense':
+        print('NLAP fidelity of the {} attention store:'.format(args.attn_codec))
+        print_compression_report(compression_report(tf_attns, AttnStore(tf_path), ctx_attns))
+
+def merge_attn_stores(paths, out_path, order=None):
+    '''
+    Merges stores holding disjoint ids (e.g. the shards of an extraction)
+    into one, with the ids in the given order. The stored arrays are copied
+    as they are, so the stores must share their dtype and codec.
+    '''
+    stores = [AttnStore(path) for path in paths]
+    where = {}
+    for store in stores:
+        if (store.dtype, store.codec, store.params) != \
+                (stores[0].dtype, stores[0].codec, stores[0].params):
+            raise ValueError('{} is stored differently from {}'.format(store.path, paths[0]))
+        for _id in store:
+            where[_id] = store
+    if order is None:
+        order = list(where)
+    options = ({'dtype': stores[0].dtype.name, 'codec': stores[0].codec}
+               if stores else {})
+    options.update(stores[0].params if stores else {})
+    with AttnStoreWriter(out_path, **options) as writer:
+        for _id in order:
+            if _id in where:
+                writer.add_encoded(_id, *where[_id].encoded(_id))
+
+def nlap_trace(tf_attn, ctx_attn):
+    '''
+    NLAP trace of one sentence or window from its stored attention, the
+    context attention (len) rolled out through the self attention (head,
+    layer, len, len) of every layer and summed over the heads, as in
+    backward_nlap.
+    '''
+    tf_attn = torch.as_tensor(tf_attn).float()
+    pre_attn = torch.as_tensor(ctx_attn).float().reshape(1, 1, -1).expand(tf_attn.shape[0], 1, -1)
+    for layer in reversed(range(tf_attn.shape[1])):
+        pre_attn = torch.matmul(pre_attn, tf_attn[:, layer])
+    return pre_attn.sum(dim=0).squeeze(dim=0)
+
+def compression_report(reference, store, ctx_attns):
+    '''
+    Error of the self attention read back from store against the reference
+    attention (both id to tensor, or list of tensors), on the weights and
+    on the NLAP trace computed with the context attention of every id.
+    '''
+    n_attn = n_trace = n_seq = top1 = 0
+    attn_err = trace_err = trace_max = trace_l1 = dense_bytes = 0.0
+    for _id in store:
+        ref, out, ctx = reference[_id], store[_id], ctx_attns[_id]
+        if not isinstance(ref, (list, tuple)):
+            ref, out, ctx = [ref], [out], [ctx]
+        for ref_t, out_t, ctx_t in zip(ref, out, ctx):
+            ref_t = torch.as_tensor(ref_t).float()
+            dense_bytes += ref_t.numel() * 4
+            if ref_t.numel() == 0:
+                continue
+            attn_err += (ref_t - out_t).abs().sum().item()
+            n_attn += ref_t.numel()
+            ref_trace, out_trace = nlap_trace(ref_t, ctx_t), nlap_trace(out_t, ctx_t)
+            err = (ref_trace - out_trace).abs()
+            trace_err += err.sum().item()
+            trace_max = max(trace_max, err.max().item())
+            trace_l1 += ref_trace.abs().sum().item()
+            n_trace += err.numel()
+            top1 += int(ref_trace.argmax() == out_trace.argmax())
+            n_seq += 1
+    return {'attn_mae': attn_err / max(n_attn, 1),
+            'nlap_mae': trace_err / max(n_trace, 1),
+            'nlap_max_err': trace_max,
+            'nlap_rel_l1': trace_err / max(trace_l1, 1e-12),
+            'nlap_top1_agreement': top1 / max(n_seq, 1),
+            'compression_vs_float32': dense_bytes / max(store.nbytes(), 1)}
+
+def print_compression_report(report):
+    for k, v in report.items():
+        print('{:<28s}{:0.5f}'.format(k, v))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Recompresses a stored self attention and reports the error on the NLAP trace')
+    parser.add_argument('--tf_store', type=str, required=True,
+                        help='store of the self attention (e.g. [out_dir]/id_tf_attns_sst)')
+    parser.add_argument('--ctx_store', type=str, required=True,
+                        help='store of the context attention of the same ids')
+    parser.add_argument('--out_path', type=str, required=True,
+                        help='where to write the recompressed store')
+    add_store_args(parser)
+    args = parser.parse_args()
+
+    reference = AttnStore(args.tf_store)
+    write_attn_store(args.out_path, ((_id, reference[_id]) for _id in reference),
+                     **store_options(args))
+    print_compression_report(compression_report(reference, AttnStore(args.out_path),
+                                                AttnStore(args.ctx_store)))
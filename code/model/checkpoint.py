@@ -0,0 +1,319 @@
+"""Training checkpoints: resumable full-state checkpoints written atomically on
+a background thread, and a memory-mapped weights format for fast loading."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+import hashlib
+import struct
+import atexit
+import argparse
+import random
+import threading
+import queue
+
+import numpy as np
+import torch
+
+def to_cpu(obj):
+    '''
+    Returns a copy of a (nested) state dict with every tensor copied to the
+    CPU, so the training thread can keep updating the live tensors while the
+    copy is being written.
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+def rng_state():
+    """Snapshots the python, numpy, torch and cuda random generators."""
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file that is then renamed over path."""
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def torch_load(path, device):
+    """torch.load of a trusted checkpoint that also holds numpy/python objects."""
+    try:
+        return torch.load(path, map_location=device, weights_only=False)
+    except TypeError:
+        # torch releases before weights_only existed
+        return torch.load(path, map_location=device)
+
+class CheckpointWriter(object):
+    '''
+    Writes checkpoints on a daemon thread. save() snapshots the tensors to the
+    CPU on the calling thread and returns; the file is written to a temporary
+    path and renamed, so a reader (or a preempted job) never sees a partial
+    checkpoint. Pending writes are flushed by close(), which also runs at exit.
+    '''
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            obj, path = item
+            try:
+                atomic_save(obj, path)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def save(self, obj, path):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((to_cpu(obj), path))
+
+    def wait(self):
+        """Blocks until every queued checkpoint is on disk."""
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+def model_checkpoint(model, **meta):
+    '''
+    The checkpoint of train.save_checkpoint: the weights with what is needed
+    to rebuild the model (its encoder sizes and pruned heads) and meta.
+    '''
+    checkpoint = dict(meta, arch=model.arch, model=model.state_dict())
+    if model.attendedEncoder.pruned_heads:
+        # a pruned model has to be pruned the same way before loading
+        checkpoint['pruned_heads'] = list(model.attendedEncoder.pruned_heads)
+    return checkpoint
+
+def training_state(model, optimizer, epoch, best, **extra):
+    '''
+    Everything needed to continue a run after epoch `epoch`: the model and
+    optimizer state, the random generators and the best metrics so far.
+    '''
+    state = {'epoch': epoch,
+             'model': model.state_dict(),
+             'optimizer': optimizer.state_dict(),
+             'rng': rng_state(),
+             'best': dict(best)}
+    state.update(extra)
+    return state
+
+def load_training_state(path, model, optimizer, device):
+    '''
+    Restores a checkpoint written from training_state into the model and
+    optimizer, resets the random generators and returns (epoch, best).
+    '''
+    state = torch_load(path, device)
+    model.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    set_rng_state(state['rng'])
+    return state['epoch'], state['best']
+
+# memory-mapped weights format: magic, header length, JSON header, then the
+# raw tensor data, each tensor starting at a ALIGN byte boundary
+MAGIC = b'LATMMAP1'
+ALIGN = 64
+NUMPY_DTYPES = {'float32': np.float32, 'float64': np.float64, 'float16': np.float16,
+                'int64': np.int64, 'int32': np.int32, 'uint8': np.uint8, 'bool': np.bool_}
+
+def model_arch(model):
+    '''
+    Architecture of the self-attention encoder of a model, as plain ints (and
+    the list of pruned heads, if any).
+    '''
+    layers = model.attendedEncoder.layer_stack
+    slf_attn = layers[0].slf_attn
+    arch = {'model': type(model).__name__,
+            'n_layers': len(layers),
+            'n_head': slf_attn.n_head,
+            'd_k': slf_attn.d_k,
+            'd_v': slf_attn.d_v,
+            'd_model': slf_attn.fc.out_features,
+            'd_inner': layers[0].pos_ffn.w_1.out_features}
+    if model.attendedEncoder.pruned_heads:
+        arch['pruned_heads'] = list(model.attendedEncoder.pruned_heads)
+    return arch
+
+def apply_pruned_heads(model, pruned_heads):
+    """Removes the heads a checkpoint was pruned of from a freshly built model."""
+    if pruned_heads:
+        model.attendedEncoder.prune_heads(pruned_heads)
+
+def _aligned(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def save_mmap_checkpoint(model, path, meta=None):
+    '''
+    Writes the weights of a model in the memory-mapped format. The header is
+    JSON (meta, architecture and the dtype, shape and offset of every tensor),
+    so it can be validated without unpickling anything.
+    '''
+    state = model.state_dict()
+    tensors = {}
+    offset = 0
+    for name, t in state.items():
+        dtype = str(t.dtype).replace('torch.', '')
+        if dtype not in NUMPY_DTYPES:
+            raise ValueError('Cannot store {} tensor {}'.format(dtype, name))
+        tensors[name] = {'dtype': dtype, 'shape': list(t.shape), 'offset': offset}
+        offset = _aligned(offset + t.numel() * t.element_size())
+    header = json.dumps({'meta': meta or {}, 'arch': model_arch(model),
+                         'tensors': tensors}).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, t in state.items():
+            f.seek(data_start + tensors[name]['offset'])
+            f.write(t.detach().cpu().contiguous().numpy().tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+def is_mmap_checkpoint(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def read_mmap_header(path):
+    """Returns (header, data offset) of a memory-mapped checkpoint."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a memory-mapped checkpoint')
+        n = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(n).decode('utf-8'))
+    return header, _aligned(len(MAGIC) + 8 + n)
+
+def load_mmap_checkpoint(path, model, device=torch.device('cpu')):
+    '''
+    Loads a memory-mapped checkpoint into a model after checking that its
+    architecture matches. On the CPU the parameters are backed directly by the
+    (copy-on-write) mapping, so only the pages that are used get read; older
+    torch releases without load_state_dict(assign=True) copy them instead.
+    Returns the meta dict of the checkpoint.
+    '''
+    header, data_start = read_mmap_header(path)
+    apply_pruned_heads(model, header['arch'].get('pruned_heads'))
+    arch = model_arch(model)
+    if header['arch'] != arch:
+        raise ValueError('Checkpoint architecture {} does not match the model {}'.
+                         format(header['arch'], arch))
+    buf = np.memmap(path, dtype=np.uint8, mode='c')
+    state = {}
+    for name, info in header['tensors'].items():
+        dtype = np.dtype(NUMPY_DTYPES[info['dtype']])
+        count = int(np.prod(info['shape'], dtype=np.int64))
+        start = data_start + info['offset']
+        array = buf[start:start + count * dtype.itemsize].view(dtype).reshape(info['shape'])
+        state[name] = torch.from_numpy(array)
+    if torch.device(device).type == 'cpu':
+        try:
+            model.load_state_dict(state, assign=True)
+            return header['meta']
+        except TypeError:
+            pass
+    model.load_state_dict(state)
+    return header['meta']
+
+def checkpoint_fingerprint(path, chunk_bytes=1 << 20):
+    """SHA-1 of the bytes of a checkpoint, which identifies the weights it holds."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_checkpoint(path, device):
+    '''
+    Reads a checkpoint once to build its model from. Returns the encoder
+    sizes of the model it was saved from (the arch argument of the models;
+    None for checkpoints that predate configurable sizes, which all have
+    the default ones) and the loaded torch.save checkpoint to pass on to
+    load_model_weights. Memory-mapped checkpoints only have their header
+    read, and None in place of the checkpoint; they are mapped when loading.
+    '''
+    if is_mmap_checkpoint(path):
+        arch = dict(read_mmap_header(path)[0]['arch'])
+        # the model is built with all its heads and pruned when loading
+        arch['n_head'] += len(arch.get('pruned_heads', []))
+        return arch, None
+    checkpoint = torch_load(path, device)
+    return checkpoint.get('arch'), checkpoint
+
+def load_model_weights(path, model, device, checkpoint=None):
+    '''
+    Loads model weights from either checkpoint format: the memory-mapped one,
+    or a torch.save checkpoint as written by train.save_checkpoint, read from
+    path unless it is given already loaded (by read_checkpoint).
+    '''
+    if is_mmap_checkpoint(path):
+        return load_mmap_checkpoint(path, model, device)
+    if checkpoint is None:
+        checkpoint = torch_load(path, device)
+    apply_pruned_heads(model, checkpoint.get('pruned_heads'))
+    model.load_state_dict(checkpoint['model'])
+    return {k: v for k, v in checkpoint.items() if k != 'model'}
+
+def convert_checkpoint(model, in_path, out_path, checkpoint=None):
+    '''
+    Converts a train.save_checkpoint checkpoint (optionally already loaded)
+    into the memory-mapped format.
+    '''
+    meta = load_model_weights(in_path, model, torch.device('cpu'), checkpoint)
+    save_mmap_checkpoint(model, out_path, meta)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, required=True,
+                        help='checkpoint written by train.py')
+    parser.add_argument('--out_path', type=str, default=None,
+                        help='memory-mapped checkpoint to write (default: <model_path>.mmap)')
+    parser.add_argument('--dataset', type=str, default="SEND",
+                        help='the dataset the model was trained on (default: SEND)')
+    args = parser.parse_args()
+    from models import TransformerLinearAttn, TransformerLSTMAttn
+    model_class = TransformerLinearAttn if args.dataset == "SST" else TransformerLSTMAttn
+    arch, checkpoint = read_checkpoint(args.model_path, torch.device('cpu'))
+    model = model_class(mods=['linguistic'], dims={'linguistic' : 300},
+                        device=torch.device('cpu'), arch=arch)
+    out_path = args.out_path if args.out_path is not None else args.model_path + '.mmap'
+    convert_checkpoint(model, args.model_path, out_path, checkpoint)
+    print("Wrote " + out_path)
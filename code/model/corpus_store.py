@@ -0,0 +1,227 @@
+"""Contiguous memory-mapped storage for ragged per-sentence features."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import argparse
+import pickle
+from random import shuffle
+
+import numpy as np
+import torch
+
+from distributed import shard
+
+def write_ragged(prefix, ids, arrays, dtype=np.float32):
+    '''
+    Writes a list of variable length arrays as one contiguous matrix plus the
+    sentence offsets and ids, i.e. three files:
+
+    prefix.data.npy -- (total_rows, ...) concatenation of all the arrays
+    prefix.offsets.npy -- (n+1,) int64 row offsets of every array
+    prefix.ids.npy -- (n,) ids of the arrays
+    '''
+    lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+    offsets = np.zeros(len(arrays)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    first = np.asarray(arrays[0], dtype=dtype)
+    data = np.lib.format.open_memmap(prefix + '.data.npy', mode='w+', dtype=dtype,
+                                     shape=(int(offsets[-1]),) + first.shape[1:])
+    for i, a in enumerate(arrays):
+        data[offsets[i]:offsets[i+1]] = np.asarray(a, dtype=dtype)
+    data.flush()
+    del data
+    np.save(prefix + '.offsets.npy', offsets)
+    np.save(prefix + '.ids.npy', np.asarray(ids), allow_pickle=False)
+
+class RaggedStore(object):
+    '''
+    Read side of write_ragged. The data matrix is memory-mapped, so opening a
+    store is cheap and only the rows that are sliced or gathered get paged in.
+    '''
+
+    def __init__(self, prefix, mmap=True):
+        self.prefix = prefix
+        self.data = np.load(prefix + '.data.npy', mmap_mode='r' if mmap else None)
+        self.offsets = np.load(prefix + '.offsets.npy')
+        self.ids = np.load(prefix + '.ids.npy', allow_pickle=False).tolist()
+        self.lengths = np.diff(self.offsets)
+        self._index = None
+
+    @staticmethod
+    def exists(prefix):
+        return os.path.exists(prefix + '.data.npy')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def keys(self):
+        return self.ids
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]]
+
+    def index_of(self, _id):
+        if self._index is None:
+            self._index = {k: i for i, k in enumerate(self.ids)}
+        return self._index[_id]
+
+    def gather(self, index, max_len=None):
+        '''
+        Returns a zero padded (batch, max_len, ...) float tensor holding the
+        arrays at the given positions, built with a single fancy-index read.
+        '''
+        index = np.asarray(index, dtype=np.int64)
+        lengths = self.lengths[index]
+        if max_len is None:
+            max_len = int(lengths.max())
+        steps = np.arange(max_len)
+        valid = steps[None, :] < lengths[:, None]
+        rows = (self.offsets[index][:, None] + steps[None, :])[valid]
+        out = np.zeros((len(index), max_len) + self.data.shape[1:],
+                       dtype=self.data.dtype)
+        out[valid] = self.data[rows]
+        return torch.from_numpy(out)
+
+def open_sst_split(store_dir, split):
+    """Opens the converted id_embed_<split>.p store of SST."""
+    return RaggedStore(os.path.join(store_dir, 'id_embed_' + split))
+
+def generateBatchStore(store, input_target, args, batch_size=1,
+                       shuffle_batches=None, return_ids=False, pad_shards=True, index=None):
+    '''
+    Same batches as generateBatchSST, but read from a RaggedStore: sentences
+    are gathered straight into a padded tensor and sorted by length (longest
+    first) with a stable argsort. index restricts the batches to some
+    positions of the store (default: all of them).
+    '''
+    if shuffle_batches is None:
+        shuffle_batches = batch_size != 1
+    targets = np.array([input_target[_id] for _id in store.ids], dtype=np.float32)
+    if index is None:
+        index = [i for i in range(0, len(store))]
+    index = list(index)
+    if shuffle_batches:
+        shuffle(index)
+    # this process' share of the data in a distributed run
+    index, batch_size = shard(index, batch_size, pad=pad_shards)
+    for start in range(0, len(index), batch_size):
+        chunk = np.array(index[start:start + batch_size], dtype=np.int64)
+        order = np.argsort(-store.lengths[chunk], kind='stable')
+        chunk = chunk[order]
+        seq_len = store.lengths[chunk].tolist()
+        sort_feature = store.gather(chunk)
+        sort_targets = torch.from_numpy(targets[chunk])
+        mask = (torch.arange(seq_len[0])[None, :] <
+                torch.tensor(seq_len)[:, None]).float()
+        if return_ids:
+            yield sort_feature, sort_targets, seq_len, mask, \
+                [store.ids[i] for i in chunk]
+        else:
+            yield sort_feature, sort_targets, seq_len, mask
+
+class EmbeddingTableBuilder(object):
+    '''
+    Builds a shared embedding table out of pre-embedded corpora by giving every
+    distinct word vector an integer id. Id 0 is reserved for padding and holds
+    the zero vector.
+    '''
+
+    def __init__(self, dim=300):
+        self.dim = dim
+        self.rows = [np.zeros(dim, dtype=np.float32)]
+        self.row_ids = {self.rows[0].tobytes(): 0}
+
+    def add(self, vectors):
+        """Returns the int32 token ids of a (n, dim) array of word vectors."""
+        vectors = np.nan_to_num(np.asarray(vectors, dtype=np.float32)).reshape(-1, self.dim)
+        ids = np.empty(len(vectors), dtype=np.int32)
+        for i, v in enumerate(vectors):
+            key = v.tobytes()
+            if key not in self.row_ids:
+                self.row_ids[key] = len(self.rows)
+                self.rows.append(v)
+            ids[i] = self.row_ids[key]
+        return ids
+
+    def save(self, out_dir):
+        np.save(os.path.join(out_dir, 'embedding.npy'), np.stack(self.rows, axis=0))
+
+def open_embedding_table(token_dir):
+    '''
+    Memory-maps the shared embedding table. The mapping is copy-on-write so it
+    can back a tensor directly without copying it into memory.
+    '''
+    return np.load(os.path.join(token_dir, 'embedding.npy'), mmap_mode='c')
+
+def open_sst_tokens(token_dir, split):
+    """Opens the token id store of an SST split."""
+    return RaggedStore(os.path.join(token_dir, 'id_token_' + split))
+
+def open_send_tokens(token_dir, subset):
+    """Opens the token id store of a SEND subset (ids are 'ID_vid')."""
+    return RaggedStore(os.path.join(token_dir, 'send_token_' + subset))
+
+def convert_sst_tokens(data_dir, out_dir, builder, splits=('train', 'valid', 'test')):
+    """Converts the SST id_embed_<split>.p pickles into token id stores."""
+    for split in splits:
+        path = os.path.join(data_dir, 'id_embed_' + split + '.p')
+        print("Converting " + path + " ...")
+        id_embed = pickle.load(open(path, "rb"))
+        ids = [k for k in id_embed.keys()]
+        write_ragged(os.path.join(out_dir, 'id_token_' + split), ids,
+                     [builder.add(id_embed[_id]) for _id in ids], dtype=np.int32)
+        del id_embed
+
+def convert_send_tokens(data_dir, out_dir, builder, subsets=('Train', 'Valid', 'Test')):
+    """Converts the GloVe columns of the SEND word-level TSVs into token id stores."""
+    from datasets import load_dataset
+    for subset in subsets:
+        print("Converting SEND " + subset + " ...")
+        dataset = load_dataset(['linguistic'], data_dir, subset)
+        ids = ["_".join(seq_id) for seq_id in dataset.seq_ids]
+        write_ragged(os.path.join(out_dir, 'send_token_' + subset), ids,
+                     [builder.add(d) for d in dataset.data['linguistic']],
+                     dtype=np.int32)
+        del dataset
+
+def convert_sst(data_dir, out_dir, splits=('train', 'valid', 'test')):
+    """Converts the SST id_embed_<split>.p pickles into ragged stores."""
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for split in splits:
+        path = os.path.join(data_dir, 'id_embed_' + split + '.p')
+        print("Converting " + path + " ...")
+        id_embed = pickle.load(open(path, "rb"))
+        ids = [k for k in id_embed.keys()]
+        write_ragged(os.path.join(out_dir, 'id_embed_' + split), ids,
+                     [id_embed[_id] for _id in ids])
+        del id_embed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default="../../../Stanford-Sentiment-Treebank/",
+                        help='directory with the SST id_embed_*.p pickles (or the SEND data)')
+    parser.add_argument('--out_dir', type=str, default=None,
+                        help='where to write the stores (default: <data_dir>/store)')
+    parser.add_argument('--token_ids', action='store_true',
+                        help='store token ids plus one shared embedding table')
+    parser.add_argument('--dataset', type=str, default="SST",
+                        help='SST or SEND (SEND is only supported with --token_ids)')
+    args = parser.parse_args()
+    out_dir = args.out_dir if args.out_dir is not None else \
+        os.path.join(args.data_dir, 'store')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if args.token_ids:
+        builder = EmbeddingTableBuilder()
+        if args.dataset == "SST":
+            convert_sst_tokens(args.data_dir, out_dir, builder)
+        else:
+            convert_send_tokens(args.data_dir, out_dir, builder)
+        builder.save(out_dir)
+        print("Vocabulary size: ", len(builder.rows))
+    else:
+        convert_sst(args.data_dir, out_dir)
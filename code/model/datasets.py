@@ -328,6 +328,24 @@ def load_dataset(modalities, base_dir, subset,
                            [preprocess[m] for m in modalities],
                            base_rate, truncate, item_as_dict)
 
+def load_token_dataset(base_dir, subset, token_dir,
+                       truncate=False, item_as_dict=False):
+    '''
+    Same as load_dataset(['linguistic'], ...), but the linguistic modality
+    holds int32 token ids read from the memory-mapped store written by
+    `corpus_store.py --dataset SEND --token_ids`, so the GloVe columns of the
+    TSVs are never parsed.
+    '''
+    from corpus_store import open_send_tokens
+    dataset = load_dataset(['linguistic_timer'], base_dir, subset,
+                           truncate=truncate, item_as_dict=item_as_dict)
+    store = open_send_tokens(token_dir, subset)
+    dataset.data['linguistic'] = [store[store.index_of("_".join(seq_id))]
+                                  for seq_id in dataset.seq_ids]
+    dataset.lengths = [len(d) for d in dataset.data['linguistic']]
+    dataset.modalities = ['linguistic'] + dataset.modalities
+    return dataset
+
 if __name__ == "__main__":
     # Test code by loading dataset
     import argparse
@@ -0,0 +1,206 @@
+"""Knowledge distillation of a trained SST or SEND model into a smaller one
+(fewer or narrower encoder layers). Besides the outputs, the student learns to
+match the context attention and the NLAP trace of the teacher, so that its
+explanations stay comparable."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import random
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from models import TransformerLinearAttn, TransformerLSTMAttn, DEFAULT_ARCH
+from make_masks import generate_token_mask
+from metrics import one_hot
+from checkpoint import load_model_weights, read_checkpoint, atomic_save, model_checkpoint
+from early_exit import rollout, load_send_eval, run_send, compare_send
+from fidelity import fidelity_parser, load_sst_eval, load_sst_model, sst_batches, \
+    run_sst, compare_sst, print_report
+
+def explain_sst(model, inputs, length, mask):
+    '''
+    One pass of TransformerLinearAttn giving its output, its context attention
+    and its NLAP trace (both batch x len) as forward, backward_tf_attn and
+    backward_nlap compute them, and the token mask.
+    '''
+    inputs = model.embed(inputs)
+    mask_bool = mask.bool().unsqueeze(dim=-1)
+    encoded = model.attendedEncoder(inputs, mask_bool)
+    hs_attend, attn = model.pool(encoded[0], mask_bool)
+    return model.decode(hs_attend), attn.squeeze(dim=-1), rollout(attn, encoded[1]), mask
+
+def explain_send(model, inputs, length, token_length, mask):
+    '''
+    Same as explain_sst for TransformerLSTMAttn; the attention, the NLAP
+    trace and the token mask are per window (batch*len x tokens).
+    '''
+    single_mod = model.embed(inputs['linguistic'])
+    token_mask, _ = generate_token_mask(length, token_length, single_mod.shape[2],
+                                        model.device)
+    batch_size, max_len = len(length), max(length)
+    flat = single_mod.reshape(batch_size*max_len, token_mask.shape[-1], -1)
+    token_mask = token_mask.reshape(batch_size*max_len, -1, 1)
+    encoded = model.attendedEncoder(flat, token_mask)
+    hs_attend, attn = model.pool(encoded[0], token_mask)
+    target = model.decode(hs_attend.reshape(batch_size, max_len, -1), length, mask)
+    return target, attn.squeeze(dim=-1), rollout(attn, encoded[1]), token_mask.squeeze(dim=-1)
+
+def token_kl(teacher, student, mask, eps=1e-8):
+    '''
+    KL divergence of the student's from the teacher's scores over the tokens
+    of every sequence, both normalized to sum to one over the unmasked
+    tokens; summed over the sequences (fully masked ones add nothing).
+    '''
+    mask = mask.float()
+    p = teacher * mask
+    p = p / p.sum(dim=-1, keepdim=True).clamp(min=eps)
+    q = student * mask
+    q = q / q.sum(dim=-1, keepdim=True).clamp(min=eps)
+    return (p * (torch.log(p + eps) - torch.log(q + eps))).sum()
+
+def init_student(student, teacher):
+    '''
+    Copies every teacher weight of the same shape into the student: the
+    gate and output layers (and the LSTM), and evenly spaced encoder layers
+    where their sizes match.
+    '''
+    picks = np.linspace(0, teacher.att_n_layer - 1, student.att_n_layer).round().astype(int)
+    prefix = 'attendedEncoder.layer_stack.'
+    teacher_state = teacher.state_dict()
+    state = student.state_dict()
+    for key in state:
+        teacher_key = key
+        if key.startswith(prefix):
+            layer, rest = key[len(prefix):].split('.', 1)
+            teacher_key = prefix + str(picks[int(layer)]) + '.' + rest
+        if teacher_key in teacher_state and teacher_state[teacher_key].shape == state[key].shape:
+            state[key] = teacher_state[teacher_key].clone()
+    student.load_state_dict(state)
+
+class Distiller(object):
+    '''
+    Loss of a student against a frozen teacher, a weighted sum of
+    hard: the training loss of train.py on the labels,
+    logit: the same loss against the outputs of the teacher,
+    ctx: KL of the context attention, and
+    nlap: KL of the NLAP trace.
+    '''
+
+    def __init__(self, teacher, student, dataset, weights):
+        self.teacher = teacher.eval()
+        for p in self.teacher.parameters():
+            p.requires_grad_(False)
+        self.student = student
+        self.dataset = dataset
+        self.weights = weights
+        self.criterion = (nn.BCELoss(reduction='sum') if dataset == "SST"
+                          else nn.MSELoss(reduction='sum'))
+
+    def loss(self, batch):
+        """Returns the weighted loss of a training batch and its terms."""
+        if self.dataset == "SST":
+            feature, targets, seq_len, mask = batch
+            inputs, labels, explain = (feature, seq_len, mask), one_hot(targets), explain_sst
+        else:
+            data, target, mask, lengths, token_lengths = batch
+            inputs, labels, explain = (data, lengths, token_lengths, mask), target, explain_send
+        with torch.no_grad():
+            teacher_out, teacher_ctx, teacher_nlap, _ = explain(self.teacher, *inputs)
+        out, ctx, nlap, token_mask = explain(self.student, *inputs)
+        terms = {'hard': self.criterion(out, labels),
+                 'logit': self.criterion(out, teacher_out),
+                 'ctx': token_kl(teacher_ctx, ctx, token_mask),
+                 'nlap': token_kl(teacher_nlap, nlap, token_mask)}
+        return sum(self.weights[k] * v for k, v in terms.items()), terms
+
+    def train_epoch(self, batches, optimizer, epoch):
+        self.student.train()
+        totals = dict.fromkeys(self.weights, 0.0)
+        for batch in random.sample(batches, len(batches)):
+            loss, terms = self.loss(batch)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            for k, v in terms.items():
+                totals[k] += v.item()
+        print('Epoch: {}\t'.format(epoch) + '\t'.join(
+            '{}: {:2.5f}'.format(k, v / len(batches)) for k, v in totals.items()))
+
+def student_arch(args):
+    return {k: getattr(args, k) for k in DEFAULT_ARCH}
+
+if __name__ == "__main__":
+    parser = fidelity_parser()
+    parser.add_argument('--dataset', type=str, default="SST",
+                        help='SST or SEND (default: SST)')
+    parser.add_argument('--n_layers', type=int, default=2,
+                        help='student encoder layers (default: 2)')
+    parser.add_argument('--n_head', type=int, default=8,
+                        help='student attention heads (default: 8)')
+    parser.add_argument('--d_k', type=int, default=32,
+                        help='student query/key size per head (default: 32)')
+    parser.add_argument('--d_v', type=int, default=32,
+                        help='student value size per head (default: 32)')
+    parser.add_argument('--d_inner', type=int, default=64,
+                        help='student feed-forward size (default: 64)')
+    parser.add_argument('--epochs', type=int, default=20,
+                        help='distillation epochs (default: 20)')
+    parser.add_argument('--lr', type=float, default=1e-3,
+                        help='learning rate (default: 1e-3)')
+    parser.add_argument('--train_batch_size', type=int, default=50,
+                        help='training batch size (default: 50)')
+    for term, default in [('hard', 1.0), ('logit', 1.0), ('ctx', 1.0), ('nlap', 1.0)]:
+        parser.add_argument('--{}_weight'.format(term), type=float, default=default,
+                            help='weight of the {} loss (default: {})'.format(term, default))
+    parser.add_argument('--out_path', type=str, default="student-model.pth",
+                        help='where to save the best student (default: student-model.pth)')
+    args = parser.parse_args()
+    torch.manual_seed(1)
+    np.random.seed(1)
+    random.seed(1)
+
+    cpu = torch.device('cpu')
+    if args.dataset == "SST":
+        data, classes, embedding = load_sst_eval(args, 'train')
+        train_batches = sst_batches(data, classes, args.train_batch_size)
+        data, classes, embedding = load_sst_eval(args, args.split)
+        eval_batches = sst_batches(data, classes, args.batch_size)
+        teacher = load_sst_model(args, embedding)
+        student = TransformerLinearAttn(mods=['linguistic'], dims={'linguistic' : 300},
+                                        device=cpu, embedding=embedding, arch=student_arch(args))
+        run, compare, metric = run_sst, \
+            lambda r, c: compare_sst(r, c, eval_batches), 'candidate_multi_acc'
+    else:
+        train_batches, eval_batches, embedding = load_send_eval(args)
+        arch, checkpoint = read_checkpoint(args.model_path, cpu)
+        teacher = TransformerLSTMAttn(mods=['linguistic'], dims={'linguistic' : 300},
+                                      device=cpu, embedding=embedding, arch=arch)
+        load_model_weights(args.model_path, teacher, cpu, checkpoint)
+        student = TransformerLSTMAttn(mods=['linguistic'], dims={'linguistic' : 300},
+                                      device=cpu, embedding=embedding, arch=student_arch(args))
+        run, compare, metric = run_send, compare_send, 'candidate_ccc'
+    init_student(student, teacher)
+    print('Teacher parameters: {}\tStudent parameters: {}'.format(
+        sum(p.numel() for p in teacher.parameters()),
+        sum(p.numel() for p in student.parameters())))
+
+    weights = {'hard': args.hard_weight, 'logit': args.logit_weight,
+               'ctx': args.ctx_weight, 'nlap': args.nlap_weight}
+    distiller = Distiller(teacher, student, args.dataset, weights)
+    optimizer = optim.Adam(student.parameters(), lr=args.lr, weight_decay=1e-4)
+    reference = run(teacher, eval_batches)
+    best = -float('inf')
+    for epoch in range(1, args.epochs + 1):
+        distiller.train_epoch(train_batches, optimizer, epoch)
+        report = compare(reference, run(student, eval_batches))
+        print_report(report)
+        if report[metric] > best:
+            best = report[metric]
+            atomic_save(model_checkpoint(student, modalities=['linguistic'],
+                                         mod_dimension={'linguistic' : 300}), args.out_path)
+    print('Best {}: {:0.5f}, saved to {}'.format(metric, best, args.out_path))
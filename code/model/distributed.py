@@ -0,0 +1,102 @@
+"""Multi-process data-parallel training on the CPU (gloo backend, localhost)."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import socket
+import contextlib
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def shard(index, batch_size, pad=True):
+    '''
+    Splits a (shuffled) list of data indices between the processes. Every
+    process must pass the same list, i.e. shuffle with the same seed. Each
+    process gets every world_size-th index and a batch size of its share of
+    the global batch. With pad, the list is first padded by repeating its
+    head so that all processes run the same number of batches, which the
+    gradient all-reduce requires.
+    '''
+    world_size = get_world_size()
+    if world_size == 1:
+        return index, batch_size
+    index = list(index)
+    if pad and len(index) % world_size != 0:
+        index += index[:world_size - len(index) % world_size]
+    local_batch_size = max(1, -(-batch_size // world_size))
+    return index[get_rank()::world_size], local_batch_size
+
+def wrap_model(model):
+    '''
+    Wraps a model for gradient all-reduce. Buffers are not broadcast since
+    the models have no running statistics, and the frozen embedding table
+    would otherwise be sent on every forward pass.
+    '''
+    if not is_distributed():
+        return model
+    return DistributedDataParallel(model, broadcast_buffers=False)
+
+def maybe_no_sync(model, sync=True):
+    """Skips the gradient all-reduce of a backward pass unless sync is set."""
+    if sync or not isinstance(model, DistributedDataParallel):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+def unwrap_model(model):
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+def all_reduce_sum(value):
+    """Sums a python number or tensor over all processes."""
+    if not is_distributed():
+        return value
+    tensor = torch.as_tensor(value, dtype=torch.float64).clone()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.item() if not torch.is_tensor(value) else tensor.to(value.dtype)
+
+def all_gather_list(values):
+    """Concatenates a list of python objects from all processes, in rank order."""
+    if not is_distributed():
+        return list(values)
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, list(values))
+    return [v for part in gathered for v in part]
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _worker(rank, fn, args, world_size, port):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    # split the cores between the processes instead of oversubscribing them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    try:
+        fn(args)
+    finally:
+        dist.destroy_process_group()
+
+def launch(fn, args, nprocs):
+    '''
+    Runs fn(args) in nprocs local processes joined in a gloo process group,
+    and returns once all of them have finished.
+    '''
+    mp.spawn(_worker, args=(fn, args, nprocs, _free_port()), nprocs=nprocs, join=True)
@@ -0,0 +1,429 @@
+"""Early exit inference: small heads after intermediate layers of the
+attendedEncoder let confident inputs skip the remaining layers. The heads are
+trained post hoc on the frozen encoder of a trained SST or SEND model."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import time
+import random
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models import TransformerLSTMAttn
+from make_masks import generate_token_mask
+from metrics import CCC, one_hot
+from checkpoint import load_model_weights, read_checkpoint, torch_load
+from precision import full_precision
+from fidelity import fidelity_parser, load_sst_eval, load_sst_model, sst_batches, \
+    run_sst, compare_sst, nlap_agreement, print_report
+
+def rollout(gate_attn, tf_attns):
+    '''
+    NLAP rollout of the context gate attention (batch, len, 1) through the
+    self attention (batch, head, len, len) of the layers that were run,
+    summed over the heads as in backward_nlap. Returns (batch, len).
+    '''
+    with full_precision():
+        pre_attn = gate_attn.float().permute(0, 2, 1).unsqueeze(dim=1)
+        for tf_attn in reversed(tf_attns):
+            pre_attn = torch.matmul(pre_attn, tf_attn.float())
+        return pre_attn.sum(dim=1).squeeze(dim=1)
+
+class ExitHead(nn.Module):
+    '''
+    Exit head on the hidden states after an intermediate layer: a LayerNorm
+    (the encoder only normalizes its last output), a small context gate and a
+    linear output layer. SEND heads have no output layer; they only pool the
+    tokens of a window for the LSTM.
+    '''
+
+    def __init__(self, d_model, output_dim=None, d_gate=64):
+        super(ExitHead, self).__init__()
+        self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
+        self.gate = nn.Sequential(nn.Linear(d_model, d_gate),
+                                  nn.ReLU(),
+                                  nn.Linear(d_gate, 1))
+        self.out = nn.Linear(d_model, output_dim) if output_dim is not None else None
+
+    def forward(self, enc_output, mask):
+        """Returns the output (or the pooled states) and the gate attention."""
+        enc_output = self.layer_norm(enc_output)
+        attn = self.gate(enc_output).masked_fill(mask == 0, -1e9)
+        attn = F.softmax(attn.float(), dim=1)
+        pooled = torch.matmul(attn.permute(0, 2, 1), enc_output).squeeze(dim=1)
+        if self.out is None:
+            return pooled, attn
+        return self.out(pooled), attn
+
+class EarlyExit(nn.Module):
+    '''
+    Base class of the early exit wrappers. exit_layers are the numbers of
+    layers after which a head is attached; the inputs that pass none of the
+    exit tests go through all the layers and the model's own head.
+    '''
+
+    def __init__(self, model, exit_layers, output_dim, threshold):
+        super(EarlyExit, self).__init__()
+        self.model = model
+        self.n_layers = len(model.attendedEncoder.layer_stack)
+        self.exit_layers = sorted(set(exit_layers))
+        if self.exit_layers[0] < 1 or self.exit_layers[-1] >= self.n_layers:
+            raise ValueError('exit layers must be in [1, {})'.format(self.n_layers))
+        self.heads = nn.ModuleList([ExitHead(model.encoder_out, output_dim)
+                                    for _ in self.exit_layers])
+        self.threshold = threshold
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.layers_run = 0
+        self.n_inputs = 0
+
+    def mean_layers(self):
+        """Mean number of encoder layers run per input since reset_stats."""
+        return self.layers_run / max(self.n_inputs, 1)
+
+    def layer_states(self, inputs, masks):
+        '''
+        Full pass of the encoder, returning the hidden states after every exit
+        layer and the (normalized) encoder output.
+        '''
+        encoder = self.model.attendedEncoder
+        enc_output = encoder.dropout(inputs)
+        states, start = [], 0
+        for stop in self.exit_layers + [self.n_layers]:
+            enc_output, _ = encoder.run_layers(enc_output, masks, start, stop)
+            states.append(enc_output)
+            start = stop
+        return states[:-1], encoder.layer_norm(states[-1])
+
+    def exit_forward(self, inputs, masks, nlap=False):
+        '''
+        Runs the encoder on a shrinking batch: after every exit layer, the
+        inputs that pass the exit test leave with the output of that exit
+        head, and the rest carry on. Returns the output of every input, the
+        number of layers it ran and, if nlap, its NLAP scores over those layers
+        (otherwise None).
+        '''
+        encoder = self.model.attendedEncoder
+        n = inputs.shape[0]
+        active = torch.arange(n, device=inputs.device)
+        layers = torch.full((n,), self.n_layers, dtype=torch.long, device=inputs.device)
+        scores = inputs.new_zeros(n, inputs.shape[1], dtype=torch.float) if nlap else None
+        outputs = None
+        enc_output = encoder.dropout(inputs)
+        attns, previous, start = [], None, 0
+        for head, stop in zip(list(self.heads) + [None], self.exit_layers + [self.n_layers]):
+            enc_output, layer_attns = encoder.run_layers(enc_output, masks, start, stop)
+            attns += layer_attns
+            start = stop
+            if head is None:
+                output, gate = self.final(encoder.layer_norm(enc_output), masks)
+                done = torch.ones(len(active), dtype=torch.bool, device=active.device)
+            else:
+                output, gate = head(enc_output, masks)
+                done = self.exit_test(output, previous)
+            if outputs is None:
+                outputs = output.new_zeros((n,) + output.shape[1:])
+            if done.any():
+                index = active[done]
+                outputs[index] = output[done]
+                layers[index] = stop
+                if nlap:
+                    scores[index] = rollout(gate[done], [a[done] for a in attns])
+                keep = ~done
+                active, enc_output, masks = active[keep], enc_output[keep], masks[keep]
+                attns = [a[keep] for a in attns]
+                output = output[keep]
+            if len(active) == 0:
+                break
+            previous = output
+        self.layers_run += int(layers.sum())
+        self.n_inputs += n
+        return outputs, layers, scores
+
+    def train_heads(self, batches, epochs=10, lr=1e-3):
+        '''
+        Trains the exit heads on the frozen model, one optimizer step per
+        batch. Returns the mean loss of the last epoch.
+        '''
+        self.model.eval()
+        for p in self.model.parameters():
+            p.requires_grad_(False)
+        self.heads.train()
+        optimizer = torch.optim.Adam(self.heads.parameters(), lr=lr)
+        for epoch in range(epochs):
+            batches = random.sample(batches, len(batches))
+            total = 0.0
+            for batch in batches:
+                optimizer.zero_grad()
+                loss = self.exit_loss(*batch)
+                loss.backward()
+                optimizer.step()
+                total += loss.item()
+            print('Epoch: {}\tExit Loss: {:2.5f}'.format(epoch, total / len(batches)))
+        self.heads.eval()
+        return total / len(batches)
+
+    def save_heads(self, path):
+        torch.save({'exit_layers': self.exit_layers, 'heads': self.heads.state_dict()}, path)
+
+    def load_heads(self, path):
+        checkpoint = torch_load(path, torch.device('cpu'))
+        if checkpoint['exit_layers'] != self.exit_layers:
+            raise ValueError('{} has exit heads after layers {}'.format(
+                path, checkpoint['exit_layers']))
+        self.heads.load_state_dict(checkpoint['heads'])
+
+class EarlyExitSST(EarlyExit):
+    '''
+    Early exit for TransformerLinearAttn. A sentence exits once the largest
+    class score of an exit head reaches the threshold. Has the same forward
+    and backward_nlap interface as the model.
+    '''
+
+    def __init__(self, model, exit_layers=(2, 3, 4, 5), threshold=0.9):
+        super(EarlyExitSST, self).__init__(model, exit_layers,
+                                           model.out_fc2.out_features, threshold)
+        self.criterion = nn.BCELoss(reduction='sum')
+
+    def final(self, enc_output, mask):
+        m = self.model
+        pooled, attn = m.pool(enc_output, mask)
+        return m.out_fc2(m.out_dropout(F.relu(m.out_fc1(pooled)))), attn
+
+    def exit_test(self, output, previous):
+        return torch.sigmoid(output).max(dim=-1)[0] >= self.threshold
+
+    def forward(self, inputs, length, mask=None):
+        inputs = self.model.embed(inputs)
+        output, _, _ = self.exit_forward(inputs, mask.bool().unsqueeze(dim=-1))
+        return self.model.out_act(output)
+
+    def backward_nlap(self, inputs, length, mask=None):
+        '''
+        NLAP scores through the layers that each sentence actually ran, with
+        the gate of the head it exited at.
+        '''
+        inputs = self.model.embed(inputs)
+        _, _, scores = self.exit_forward(inputs, mask.bool().unsqueeze(dim=-1), nlap=True)
+        return scores
+
+    def exit_loss(self, inputs, targets, length, mask):
+        """Training loss of train.py (BCE on one-hot classes), summed over the heads."""
+        inputs = self.model.embed(inputs)
+        masks = mask.bool().unsqueeze(dim=-1)
+        with torch.no_grad():
+            states, _ = self.layer_states(inputs, masks)
+        targets = one_hot(targets)
+        loss = 0
+        for head, state in zip(self.heads, states):
+            output, _ = head(state, masks)
+            loss = loss + self.criterion(torch.sigmoid(output), targets)
+        return loss
+
+class EarlyExitSEND(EarlyExit):
+    '''
+    Early exit for TransformerLSTMAttn, per time window. The exit heads pool
+    the tokens of a window like the model's gate, and are trained to match
+    its pooled states. A window exits once the pooled states of two
+    consecutive exit heads have a cosine similarity of at least the threshold.
+    '''
+
+    def __init__(self, model, exit_layers=(2, 3, 4, 5), threshold=0.99):
+        super(EarlyExitSEND, self).__init__(model, exit_layers, None, threshold)
+        self.criterion = nn.MSELoss(reduction='sum')
+
+    def final(self, enc_output, mask):
+        return self.model.pool(enc_output, mask)
+
+    def exit_test(self, output, previous):
+        if previous is None:
+            return torch.zeros(len(output), dtype=torch.bool, device=output.device)
+        return F.cosine_similarity(output, previous, dim=-1) >= self.threshold
+
+    def windows(self, inputs, length, token_length):
+        '''
+        Flattens the windows of the batch as the model does, and returns the
+        windows inside the videos with their token masks and positions.
+        '''
+        single_mod = self.model.embed(inputs['linguistic'])
+        token_mask, _ = generate_token_mask(length, token_length, single_mod.shape[2],
+                                            self.model.device)
+        batch_size, max_len = len(length), max(length)
+        flat = single_mod.reshape(batch_size*max_len, token_mask.shape[-1], -1)
+        token_mask = token_mask.reshape(batch_size*max_len, -1, 1)
+        # padding windows are dropped by the LSTM anyway
+        valid = torch.arange(max_len)[None, :] < torch.tensor(length)[:, None]
+        index = valid.reshape(-1).nonzero().squeeze(dim=-1).to(flat.device)
+        return flat[index], token_mask[index], index, batch_size*max_len
+
+    def forward(self, inputs, length, token_length, mask=None):
+        flat, token_mask, index, n_windows = self.windows(inputs, length, token_length)
+        pooled, _, _ = self.exit_forward(flat, token_mask)
+        hs_attend = pooled.new_zeros(n_windows, pooled.shape[-1])
+        hs_attend[index] = pooled
+        return self.model.decode(hs_attend.reshape(len(length), max(length), -1),
+                                 length, mask)
+
+    def backward_nlap(self, inputs, length, token_length, mask=None):
+        '''
+        NLAP scores of every window (batch*len, tokens) through the layers it
+        actually ran; zero for the padding windows.
+        '''
+        flat, token_mask, index, n_windows = self.windows(inputs, length, token_length)
+        _, _, scores = self.exit_forward(flat, token_mask, nlap=True)
+        all_scores = scores.new_zeros(n_windows, scores.shape[-1])
+        all_scores[index] = scores
+        return all_scores
+
+    def exit_loss(self, inputs, target, mask, length, token_length):
+        """Squared error of the pooled states of the heads against the model's."""
+        flat, token_mask, _, _ = self.windows(inputs, length, token_length)
+        with torch.no_grad():
+            states, enc_output = self.layer_states(flat, token_mask)
+            target_pooled, _ = self.final(enc_output, token_mask)
+        loss = 0
+        for head, state in zip(self.heads, states):
+            pooled, _ = head(state, token_mask)
+            loss = loss + self.criterion(pooled, target_pooled)
+        return loss
+
+def load_send_splits(args):
+    '''
+    The SEND train and held out (Valid) videos as train.py prepares them,
+    each a tuple of (padded inputs, padded ratings, lengths, token lengths),
+    and the embedding table of --token_dir.
+    '''
+    # train.py sets up its log file on import, only do it for SEND
+    from train import load_data, constructInput, padInput, padRating
+    from corpus_store import open_embedding_table
+    modalities = ['linguistic']
+    window_size = {'linguistic' : 5, 'ratings' : 5}
+    pad_dimension = {'linguistic' : 300 if args.token_dir is None else None}
+    embedding = (open_embedding_table(args.token_dir) if args.token_dir is not None
+                 else None)
+    splits = []
+    for data in load_data(modalities, args.data_dir, token_dir=args.token_dir):
+        features, ratings = constructInput(data, channels=modalities, window_size=window_size)
+        padded, seq_lens, token_lens = padInput(features, modalities, pad_dimension)
+        ratings = padRating(ratings, max(seq_lens))
+        splits.append((padded, ratings, seq_lens, token_lens))
+    return splits[0], splits[1], embedding
+
+def load_send_eval(args):
+    '''
+    SEND training batches and held out videos (one per batch) as tuples of
+    (data, target, mask, lengths, token_lengths), built like train.py does.
+    '''
+    from train import generateTrainBatch
+    train_split, eval_split, embedding = load_send_splits(args)
+    splits = []
+    for split, batch_size in zip([train_split, eval_split], [args.train_batch_size, 1]):
+        splits.append(list(generateTrainBatch(*split, args, batch_size=batch_size,
+                                              pad_shards=False)))
+    return splits[0], splits[1], embedding
+
+def run_send(model, batches):
+    '''
+    SEND counterpart of fidelity.run_sst: the outputs and targets of every
+    video, the NLAP scores of every window (trimmed to its tokens) and the
+    wall time of the forward passes and of the rollouts.
+    '''
+    model.eval()
+    outputs, targets, scores = [], [], []
+    forward_time = nlap_time = 0.0
+    with torch.no_grad():
+        for data, target, mask, lengths, token_lengths in batches:
+            start = time.perf_counter()
+            output = model(data, lengths, token_lengths, mask)
+            forward_time += time.perf_counter() - start
+            start = time.perf_counter()
+            nlap = model.backward_nlap(data, lengths, token_lengths, mask)
+            nlap_time += time.perf_counter() - start
+            outputs.append(output)
+            targets.append(target)
+            nlap = nlap.cpu().numpy().reshape(len(lengths), max(lengths), -1)
+            for b, l in enumerate(lengths):
+                scores.extend([nlap[b, w, :t] for w, t in enumerate(token_lengths[b][:l]) if t > 0])
+    return {'outputs': outputs, 'targets': targets, 'nlap': scores,
+            'forward_time': forward_time, 'nlap_time': nlap_time}
+
+def compare_send(reference, candidate):
+    """Mean CCC per video of both runs, output difference, NLAP agreement and speedups."""
+    report = {}
+    for name, run in [('reference', reference), ('candidate', candidate)]:
+        report[name + '_ccc'] = float(np.nanmean(
+            [CCC().update(o, t).compute() for o, t in zip(run['outputs'], run['targets'])]))
+    report['output_max_abs_diff'] = max((r - c).abs().max().item() for r, c in
+                                        zip(reference['outputs'], candidate['outputs']))
+    report.update(nlap_agreement(reference['nlap'], candidate['nlap']))
+    report['forward_speedup'] = reference['forward_time'] / candidate['forward_time']
+    report['nlap_speedup'] = reference['nlap_time'] / candidate['nlap_time']
+    return report
+
+if __name__ == "__main__":
+    parser = fidelity_parser()
+    parser.add_argument('--dataset', type=str, default="SST",
+                        help='SST or SEND (default: SST)')
+    parser.add_argument('--exit_layers', type=int, nargs='+', default=[2, 3, 4, 5],
+                        help='numbers of layers after which an exit head is attached (default: 2 3 4 5)')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=None,
+                        help='exit thresholds to sweep (default: 0.7 0.8 0.9 0.95 for SST, '
+                             '0.9 0.95 0.99 0.999 for SEND)')
+    parser.add_argument('--heads_path', type=str, default=None,
+                        help='exit heads to load, or where to save them after training')
+    parser.add_argument('--epochs', type=int, default=10,
+                        help='epochs to train the exit heads (default: 10)')
+    parser.add_argument('--lr', type=float, default=1e-3,
+                        help='learning rate of the exit heads (default: 1e-3)')
+    parser.add_argument('--train_batch_size', type=int, default=50,
+                        help='batch size to train the exit heads (default: 50)')
+    args = parser.parse_args()
+    torch.manual_seed(1)
+    random.seed(1)
+
+    if args.dataset == "SST":
+        data, classes, embedding = load_sst_eval(args, 'train')
+        train_batches = sst_batches(data, classes, args.train_batch_size)
+        data, classes, embedding = load_sst_eval(args, args.split)
+        eval_batches = sst_batches(data, classes, args.batch_size)
+        model = load_sst_model(args, embedding)
+        wrapper = EarlyExitSST(model, args.exit_layers)
+        thresholds = args.thresholds or [0.7, 0.8, 0.9, 0.95]
+    else:
+        train_batches, eval_batches, embedding = load_send_eval(args)
+        arch, checkpoint = read_checkpoint(args.model_path, torch.device('cpu'))
+        model = TransformerLSTMAttn(mods=['linguistic'], dims={'linguistic' : 300},
+                                    device=torch.device('cpu'), embedding=embedding, arch=arch)
+        load_model_weights(args.model_path, model, torch.device('cpu'), checkpoint)
+        wrapper = EarlyExitSEND(model, args.exit_layers)
+        thresholds = args.thresholds or [0.9, 0.95, 0.99, 0.999]
+
+    if args.heads_path is not None and os.path.exists(args.heads_path):
+        wrapper.load_heads(args.heads_path)
+    else:
+        wrapper.train_heads(train_batches, args.epochs, args.lr)
+        if args.heads_path is not None:
+            wrapper.save_heads(args.heads_path)
+
+    if args.dataset == "SST":
+        reference = run_sst(model, eval_batches)
+    else:
+        reference = run_send(model, eval_batches)
+    for threshold in thresholds:
+        wrapper.threshold = threshold
+        wrapper.reset_stats()
+        if args.dataset == "SST":
+            report = compare_sst(reference, run_sst(wrapper, eval_batches), eval_batches)
+        else:
+            report = compare_send(reference, run_send(wrapper, eval_batches))
+        # forward and backward_nlap make the same exits
+        report['mean_layers'] = wrapper.mean_layers()
+        print('--- threshold {}'.format(threshold))
+        print_report(report)
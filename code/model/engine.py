@@ -0,0 +1,91 @@
+"""Loss accounting and logging helpers for the training loops."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import atexit
+import time
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+import torch
+import torch.distributed as dist
+
+class LossMeter(object):
+    '''
+    Accumulates a summed loss over an epoch. The batch losses are detached
+    and summed on their own device, so no autograd graph is kept alive and
+    the host only synchronizes when the value is actually read.
+    '''
+
+    def __init__(self):
+        self.total = None
+        self.count = 0
+
+    def update(self, loss, n=1):
+        """loss -- summed loss of the batch, n -- number of data points"""
+        loss = loss.detach()
+        # a copy, the caller may still change the batch loss in place
+        self.total = loss.clone() if self.total is None else self.total + loss
+        self.count += n
+        return self
+
+    def sum(self):
+        return 0.0 if self.total is None else self.total.item()
+
+    def all_reduce(self):
+        """Sums the loss and count over all processes of a distributed run."""
+        if dist.is_available() and dist.is_initialized():
+            stats = torch.tensor([self.sum(), self.count], dtype=torch.float64)
+            dist.all_reduce(stats, op=dist.ReduceOp.SUM)
+            self.total = stats[0]
+            self.count = int(stats[1].item())
+        return self
+
+    def mean(self):
+        return self.sum() / max(self.count, 1)
+
+class StepLogger(object):
+    '''
+    Rate limited logger for per-batch statistics. A line is only written every
+    `interval` steps, and tensor or LossMeter fields are only converted to
+    Python numbers at that point. The fields are also attached to the record
+    (as `record.fields`) for handlers that want structured output.
+    '''
+
+    def __init__(self, logger, interval=10):
+        self.logger = logger
+        self.interval = max(int(interval), 1)
+        self.last_time = time.time()
+
+    def due(self, step):
+        return step % self.interval == 0
+
+    def log(self, step, **fields):
+        if not self.due(step):
+            return
+        now = time.time()
+        values = {'Batch': step}
+        for k, v in fields.items():
+            if isinstance(v, LossMeter):
+                v = v.mean()
+            elif torch.is_tensor(v):
+                v = v.item()
+            values[k] = v
+        values['sec/batch'] = (now - self.last_time) / self.interval
+        self.last_time = now
+        msg = '\t'.join(['{}: {:5d}'.format(k, v) if isinstance(v, int)
+                         else '{}: {:2.5f}'.format(k, v)
+                         for k, v in values.items()])
+        self.logger.info(msg, extra={'fields': values})
+
+def async_handlers(logger):
+    """Moves the handlers of a logger onto a background thread."""
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, *logger.handlers,
+                             respect_handler_level=True)
+    logger.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,119 @@
+"""Resumable attention extraction: the results of every batch are saved as soon
+as it is done, with a manifest of the ids it covered, so that a run that is
+interrupted (or rerun on new test ids) only processes the ids it has no
+results for under the same checkpoint."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from checkpoint import atomic_save, torch_load, checkpoint_fingerprint
+
+def add_progress_args(parser):
+    parser.add_argument('--restart', action='store_true', default=False,
+                        help='delete the results saved by earlier runs of the same checkpoint')
+    return parser
+
+def extraction_fingerprint(model_path, *settings):
+    '''
+    Identifies the results of an extraction: the checkpoint bytes and the
+    settings that change the results (e.g. the dataset and precision).
+    '''
+    digest = hashlib.sha1(checkpoint_fingerprint(model_path).encode('utf-8'))
+    digest.update(repr(settings).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def _plain(_id):
+    return _id.item() if isinstance(_id, np.generic) else _id
+
+def _file_tag(name):
+    """The tag of the process that wrote a manifest or batch file, None for others."""
+    if name.startswith('manifest-'):
+        return name[len('manifest-'):].partition('.json')[0]
+    if name.startswith('batch-'):
+        return name[len('batch-'):].rpartition('-')[0]
+    return None
+
+class ExtractionProgress(object):
+    '''
+    Per id results saved batch by batch under out_dir/progress-<fingerprint>.
+    Every process (shard) appends to its own manifest of (batch file, ids),
+    and the ids listed in the manifests of any earlier run, whatever its
+    sharding, count as done.
+    '''
+
+    def __init__(self, out_dir, fingerprint, tag='shard-0-of-1', restart=False):
+        self.path = os.path.join(out_dir, 'progress-' + fingerprint)
+        # shards may create it at the same time
+        os.makedirs(self.path, exist_ok=True)
+        self.tag = tag
+        self.manifest_path = os.path.join(self.path, 'manifest-{}.json'.format(tag))
+        self.batches = []
+        self.where = dict()
+        if restart:
+            self.clear()
+            return
+        for name in sorted(os.listdir(self.path)):
+            if not (name.startswith('manifest-') and name.endswith('.json')):
+                continue
+            with open(os.path.join(self.path, name)) as f:
+                batches = json.load(f)['batches']
+            if name == os.path.basename(self.manifest_path):
+                self.batches = batches
+            for batch in batches:
+                for _id in batch['ids']:
+                    self.where[_id] = batch['file']
+
+    def clear(self):
+        '''
+        Removes the manifests and batch files of earlier runs, whatever their
+        sharding, except the ones of the other shards of this run (the same
+        number of shards): those may already be saving new results, and
+        clear their own files when they restart.
+        '''
+        run = self.tag.rpartition('-of-')[2]
+        for name in os.listdir(self.path):
+            tag = _file_tag(name)
+            if tag is None or (tag != self.tag and tag.rpartition('-of-')[2] == run):
+                continue
+            os.remove(os.path.join(self.path, name))
+
+    def __contains__(self, _id):
+        return _plain(_id) in self.where
+
+    def pending(self, ids):
+        """The ids without saved results, in order."""
+        return [_id for _id in ids if _id not in self]
+
+    def save(self, results):
+        '''
+        Saves the results (id to result) of a batch, then lists its ids in
+        the manifest; a batch interrupted before that is simply rerun.
+        '''
+        name = 'batch-{}-{:05d}.pth'.format(self.tag, len(self.batches))
+        atomic_save(results, os.path.join(self.path, name))
+        ids = [_plain(_id) for _id in results]
+        self.batches.append({'file': name, 'ids': ids})
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'batches': self.batches}, f)
+        os.replace(tmp_path, self.manifest_path)
+        for _id in ids:
+            self.where[_id] = name
+
+    def load(self, ids):
+        """The saved results of ids, in order, reading every batch file once."""
+        files = dict()
+        results = []
+        for _id in ids:
+            name = self.where[_plain(_id)]
+            if name not in files:
+                files[name] = torch_load(os.path.join(self.path, name), 'cpu')
+            results.append(files[name][_id])
+        return results
@@ -0,0 +1,311 @@
+"""Frozen-encoder feature cache: runs the attendedEncoder of a trained SST or
+SEND model once over the corpus, stores its output per sentence (SST) or window
+(SEND) in memory-mapped stores, and trains only the downstream modules (the
+context gate, the LSTM and the output layers) from the cache."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+import random
+from random import shuffle
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from models import TransformerLinearAttn, TransformerLSTMAttn
+from make_masks import generate_token_mask
+from metrics import SSTAccuracy, CCC, one_hot
+from checkpoint import load_model_weights, read_checkpoint, atomic_save, model_checkpoint
+from corpus_store import RaggedStore, write_ragged, generateBatchStore
+from fidelity import fidelity_parser, load_sst_eval, sst_batches
+
+# attended: the encoder output of every token, pooled: the attended
+# embedding of every sentence or window (the gate is frozen as well)
+LEVELS = ('attended', 'pooled')
+
+def cache_sst(model, batches, level):
+    '''
+    Ids, encoder output (len x dim, or 1 x dim when pooled) and class of
+    every sentence of batches with ids.
+    '''
+    ids, features, targets = [], [], []
+    model.eval()
+    with torch.no_grad():
+        for feature, target, seq_len, mask, batch_ids in batches:
+            attended_out, mask_bool = model.encode(feature, mask)
+            if level == 'pooled':
+                attended_out = model.pool(attended_out, mask_bool)[0].unsqueeze(dim=1)
+                seq_len = [1] * len(seq_len)
+            out = attended_out.float().cpu().numpy()
+            features.extend(out[b, :l] for b, l in enumerate(seq_len))
+            targets.extend([t] for t in target.tolist())
+            ids.extend(batch_ids)
+    return ids, features, targets
+
+def cache_send(model, split, args, level):
+    '''
+    Position, encoder output and ratings of every video of a split from
+    load_send_splits. The encoder output of a video is the valid tokens of
+    all its windows one after another (a window without tokens keeps its
+    first one, as the token mask does), or one row per window when pooled.
+    Also returns the number of tokens kept for every window.
+    '''
+    # train.py sets up its log file on import, only do it for SEND
+    from train import generateTrainBatch
+    ids, features, targets, tokens = [], [], [], []
+    model.eval()
+    with torch.no_grad():
+        # one video per batch, in order
+        batches = generateTrainBatch(*split, args, batch_size=1, pad_shards=False)
+        for i, (data, target, mask, lengths, token_lengths) in enumerate(batches):
+            attended_out, token_mask = model.encode(data, lengths, token_lengths)
+            n_tokens = token_mask.sum(dim=(1, 2)).long()
+            if level == 'pooled':
+                out = model.pool(attended_out, token_mask)[0]
+            else:
+                out = attended_out[token_mask.squeeze(dim=-1)]
+            ids.append(i)
+            features.append(out.float().cpu().numpy())
+            targets.append(target[0, :, 0].numpy())
+            tokens.append(n_tokens.numpy())
+    return ids, features, targets, tokens
+
+def write_cache(cache_dir, split, ids, features, targets, tokens=None):
+    prefix = os.path.join(cache_dir, split)
+    write_ragged(prefix + '.features', ids, features)
+    write_ragged(prefix + '.targets', ids, targets)
+    if tokens is not None:
+        write_ragged(prefix + '.tokens', ids, tokens, dtype=np.int64)
+
+class FeatureCache(object):
+    """Read side of a cached split, with the dataset and level of the cache."""
+
+    def __init__(self, cache_dir, split):
+        prefix = os.path.join(cache_dir, split)
+        with open(os.path.join(cache_dir, 'cache.json')) as f:
+            self.meta = json.load(f)
+        self.features = RaggedStore(prefix + '.features')
+        self.targets = RaggedStore(prefix + '.targets')
+        self.tokens = (RaggedStore(prefix + '.tokens')
+                       if RaggedStore.exists(prefix + '.tokens') else None)
+
+    @staticmethod
+    def exists(cache_dir, split):
+        return RaggedStore.exists(os.path.join(cache_dir, split + '.features'))
+
+    @property
+    def level(self):
+        return self.meta['level']
+
+    def sst_batches(self, batch_size, shuffle_batches=True):
+        """Batches of (features, targets, seq_len, mask) as generateBatchStore makes them."""
+        classes = {_id : float(self.targets[i][0]) for i, _id in enumerate(self.targets.ids)}
+        return generateBatchStore(self.features, classes, None, batch_size,
+                                  shuffle_batches=shuffle_batches, pad_shards=False)
+
+    def send_batches(self, batch_size, shuffle_batches=True):
+        '''
+        Batches of (features, target, mask, lengths, token_lengths) like
+        generateTrainBatch, with the encoder output in place of the inputs:
+        (batch*len, tokens, dim) zero padded windows, or (batch, len, dim)
+        attended embeddings when pooled.
+        '''
+        index = [i for i in range(0, len(self.features))]
+        if shuffle_batches:
+            shuffle(index)
+        for start in range(0, len(index), batch_size):
+            chunk = index[start:start + batch_size]
+            lengths = self.targets.lengths[chunk].tolist()
+            max_len = max(lengths)
+            target = self.targets.gather(chunk, max_len).float().unsqueeze(dim=-1)
+            mask = (torch.arange(max_len)[None, :] <
+                    torch.tensor(lengths)[:, None]).float().unsqueeze(dim=-1)
+            if self.level == 'pooled':
+                yield self.features.gather(chunk, max_len).float(), target, mask, lengths, None
+                continue
+            token_lengths = [self.tokens[i].tolist() for i in chunk]
+            max_token = max(max(t) for t in token_lengths)
+            features = torch.zeros(len(chunk) * max_len, max_token, self.features.data.shape[-1])
+            for b, i in enumerate(chunk):
+                rows = torch.tensor(self.features[i], dtype=torch.float)
+                for w, window in enumerate(rows.split(token_lengths[b])):
+                    features[b * max_len + w, :len(window)] = window
+            yield features, target, mask, lengths, token_lengths
+
+def cached_forward(model, dataset, level, batch):
+    """Output of the downstream modules of the model on a batch of the cache."""
+    if dataset == "SST":
+        feature, _, _, mask = batch
+        if level == 'pooled':
+            return model.decode(feature[:, 0])
+        return model.decode(model.pool(feature, mask.bool().unsqueeze(dim=-1))[0])
+    feature, _, mask, lengths, token_lengths = batch
+    if level == 'pooled':
+        return model.decode(feature, lengths, mask)
+    token_mask, _ = generate_token_mask(lengths, token_lengths, feature.shape[1], model.device)
+    hs_attend = model.pool(feature, token_mask.reshape(feature.shape[0], -1, 1))[0]
+    return model.decode(hs_attend.reshape(len(lengths), max(lengths), -1), lengths, mask)
+
+def freeze_encoder(model, level):
+    '''
+    Freezes the encoder (and the gate when the cache is pooled), and returns
+    the downstream modules that are left to train.
+    '''
+    frozen = ['embedding', 'attendedEncoder'] + (['encoder_gate'] if level == 'pooled' else [])
+    trained = []
+    for name, module in model.named_children():
+        if name in frozen:
+            for p in module.parameters():
+                p.requires_grad_(False)
+        else:
+            trained.append(module)
+    return trained
+
+def reset_modules(modules):
+    """Re-initializes the trained modules, to train them from scratch."""
+    for module in modules:
+        for m in module.modules():
+            if hasattr(m, 'reset_parameters'):
+                m.reset_parameters()
+
+def evaluate_cached(model, dataset, level, batches):
+    '''
+    Multiclass accuracy (SST) or mean CCC per video (SEND, one video per
+    batch) of the model on cached batches.
+    '''
+    model.eval()
+    if dataset == "SST":
+        metric = SSTAccuracy()
+    else:
+        ccc = []
+    with torch.no_grad():
+        for batch in batches:
+            output = cached_forward(model, dataset, level, batch)
+            if dataset == "SST":
+                metric.update(output, batch[1])
+            else:
+                ccc.append(CCC().update(output, batch[1]).compute())
+    return metric.compute()[0] if dataset == "SST" else float(np.nanmean(ccc))
+
+def train_cached(model, dataset, level, train_cache, eval_batches, args):
+    '''
+    Trains the downstream modules with the loss and optimizer of train.py,
+    and saves the model with the best held out metric to args.out_path.
+    '''
+    criterion = (nn.BCELoss(reduction='sum') if dataset == "SST"
+                 else nn.MSELoss(reduction='sum'))
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = optim.Adam(params, lr=args.lr, weight_decay=1e-4)
+    best = -float('inf')
+    for epoch in range(1, args.epochs + 1):
+        model.train()
+        # the encoder is frozen, no dropout over it either
+        model.attendedEncoder.eval()
+        total, n = 0.0, 0
+        if dataset == "SST":
+            batches = train_cache.sst_batches(args.train_batch_size)
+        else:
+            batches = train_cache.send_batches(args.train_batch_size)
+        for batch in batches:
+            output = cached_forward(model, dataset, level, batch)
+            target = one_hot(batch[1]) if dataset == "SST" else batch[1]
+            batch_loss = criterion(output, target)
+            batch_loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            total += batch_loss.item()
+            n += 1
+        metric = evaluate_cached(model, dataset, level, eval_batches)
+        print('Epoch: {}\tMean Batch Loss: {:2.5f}\tEval: {:0.5f}'.format(
+            epoch, total / n, metric))
+        if metric > best:
+            best = metric
+            atomic_save(model_checkpoint(model, modalities=['linguistic'],
+                                         mod_dimension={'linguistic' : 300}), args.out_path)
+    return best
+
+def load_model(dataset, model_path, embedding=None):
+    Model = TransformerLinearAttn if dataset == "SST" else TransformerLSTMAttn
+    arch, checkpoint = read_checkpoint(model_path, torch.device('cpu'))
+    model = Model(mods=['linguistic'], dims={'linguistic' : 300},
+                  device=torch.device('cpu'), embedding=embedding, arch=arch)
+    load_model_weights(model_path, model, torch.device('cpu'), checkpoint)
+    return model.eval()
+
+def build_cache(args):
+    if not os.path.exists(args.cache_dir):
+        os.makedirs(args.cache_dir)
+    if args.dataset == "SST":
+        for split in ['train', 'valid', 'test']:
+            data, classes, embedding = load_sst_eval(args, split)
+            model = load_model(args.dataset, args.model_path, embedding)
+            batches = sst_batches(data, classes, args.batch_size, return_ids=True)
+            write_cache(args.cache_dir, split, *cache_sst(model, batches, args.level))
+            print('Cached {} {} sentences'.format(len(data), split))
+    else:
+        from early_exit import load_send_splits
+        train_split, eval_split, embedding = load_send_splits(args)
+        model = load_model(args.dataset, args.model_path, embedding)
+        for split, videos in [('train', train_split), ('valid', eval_split)]:
+            write_cache(args.cache_dir, split, *cache_send(model, videos, args, args.level))
+            print('Cached {} {} videos'.format(len(videos[2]), split))
+    with open(os.path.join(args.cache_dir, 'cache.json'), 'w') as f:
+        json.dump({'dataset': args.dataset, 'level': args.level,
+                   'model_path': args.model_path, 'arch': model.arch}, f, indent=2)
+
+if __name__ == "__main__":
+    parser = fidelity_parser()
+    parser.add_argument('--dataset', type=str, default="SST",
+                        help='SST or SEND (default: SST)')
+    parser.add_argument('--cache_dir', type=str, default="feature-cache",
+                        help='directory of the feature cache (default: feature-cache)')
+    parser.add_argument('--build', action='store_true', default=False,
+                        help='run the encoder over the corpus and write the cache')
+    parser.add_argument('--level', type=str, default="attended",
+                        help='attended (encoder output per token) or pooled (attended '
+                             'embedding per sentence or window) (default: attended)')
+    parser.add_argument('--reinit', action='store_true', default=False,
+                        help='train the downstream modules from scratch')
+    parser.add_argument('--epochs', type=int, default=20,
+                        help='training epochs (default: 20)')
+    parser.add_argument('--lr', type=float, default=1e-3,
+                        help='learning rate (default: 1e-3)')
+    parser.add_argument('--train_batch_size', type=int, default=50,
+                        help='training batch size (default: 50)')
+    parser.add_argument('--out_path', type=str, default="cached-model.pth",
+                        help='where to save the best model (default: cached-model.pth)')
+    args = parser.parse_args()
+    if args.level not in LEVELS:
+        parser.error('--level must be one of {}'.format(', '.join(LEVELS)))
+    torch.manual_seed(1)
+    np.random.seed(1)
+    random.seed(1)
+
+    if args.build:
+        build_cache(args)
+    else:
+        train_cache = FeatureCache(args.cache_dir, 'train')
+        dataset, level = train_cache.meta['dataset'], train_cache.level
+        # SEND only has the Valid videos held out
+        split = args.split if FeatureCache.exists(args.cache_dir, args.split) else 'valid'
+        eval_cache = FeatureCache(args.cache_dir, split)
+        if dataset == "SST":
+            eval_batches = list(eval_cache.sst_batches(args.batch_size, shuffle_batches=False))
+        else:
+            eval_batches = list(eval_cache.send_batches(1, shuffle_batches=False))
+        # the frozen encoder is saved with the trained modules, its inputs
+        # are never embedded here
+        model = load_model(dataset, train_cache.meta['model_path'])
+        trained = freeze_encoder(model, level)
+        if args.reinit:
+            reset_modules(trained)
+        print('Trained parameters: {}'.format(
+            sum(p.numel() for p in model.parameters() if p.requires_grad)))
+        best = train_cached(model, dataset, level, train_cache, eval_batches, args)
+        print('Best {} on {}: {:0.5f}, saved to {}'.format(
+            'multi acc' if dataset == "SST" else 'ccc', split, best, args.out_path))
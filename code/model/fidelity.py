@@ -0,0 +1,192 @@
+"""Checks that a faster SST inference mode keeps the predictions and NLAP
+attributions of the float32 model, and measures how much faster it is."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import time
+import argparse
+import contextlib
+import pickle
+
+import numpy as np
+import torch
+from scipy.stats import spearmanr
+
+from models import TransformerLinearAttn
+from metrics import SSTAccuracy
+from checkpoint import load_model_weights, read_checkpoint
+from corpus_store import RaggedStore, open_sst_split, open_sst_tokens, \
+    open_embedding_table, generateBatchStore
+from precision import autocast
+
+def sst_class(rating):
+    """Same 5 sentiment classes as generate_class in train.py."""
+    for _class, upper in enumerate((0.2, 0.4, 0.6, 0.8), 1):
+        if rating <= upper:
+            return _class
+    return 5
+
+def load_sst_eval(args, split):
+    '''
+    Loads an SST split as (data, class of every id, embedding table), from
+    the token id store, the float32 store or the pickles.
+    '''
+    ratings = pickle.load(open(os.path.join(args.data_dir, "id_rating_" + split + ".p"), "rb"))
+    classes = {_id : sst_class(r) for _id, r in ratings.items()}
+    if args.token_dir is not None:
+        return open_sst_tokens(args.token_dir, split), classes, \
+            open_embedding_table(args.token_dir)
+    if args.sst_store is not None:
+        return open_sst_split(args.sst_store, split), classes, None
+    data = pickle.load(open(os.path.join(args.data_dir, "id_embed_" + split + ".p"), "rb"))
+    return data, classes, None
+
+def sst_batches(data, classes, batch_size=500, return_ids=False):
+    '''
+    Deterministic (unshuffled) evaluation batches of (features, targets,
+    seq_len, mask), sorted by length within a batch, and the sentence ids if
+    return_ids.
+    '''
+    if isinstance(data, RaggedStore):
+        return list(generateBatchStore(data, classes, None, batch_size,
+                                       shuffle_batches=False, return_ids=return_ids))
+    seq_ids = [k for k in data.keys()]
+    batches = []
+    for start in range(0, len(seq_ids), batch_size):
+        chunk = seq_ids[start:start + batch_size]
+        chunk = sorted(chunk, key=lambda _id: -len(data[_id]))
+        features = [torch.as_tensor(np.asarray(data[_id], dtype=np.float32)) for _id in chunk]
+        seq_len = [len(f) for f in features]
+        padded = torch.nn.utils.rnn.pad_sequence(features, batch_first=True)
+        targets = torch.tensor([classes[_id] for _id in chunk], dtype=torch.float)
+        mask = (torch.arange(seq_len[0])[None, :] <
+                torch.tensor(seq_len)[:, None]).float()
+        batches.append((padded, targets, seq_len, mask, chunk) if return_ids
+                       else (padded, targets, seq_len, mask))
+    return batches
+
+def run_sst(model, batches, context=contextlib.nullcontext):
+    '''
+    Runs the forward pass and the NLAP rollout of every batch. Returns the
+    float32 outputs, the per-sentence NLAP scores (trimmed to the sentence
+    length) and the wall time of the forward passes and of the rollouts.
+    '''
+    model.eval()
+    outputs, scores = [], []
+    forward_time = nlap_time = 0.0
+    with torch.no_grad():
+        for feature, _, seq_len, mask in batches:
+            with context():
+                start = time.perf_counter()
+                output = model(feature, seq_len, mask)
+                forward_time += time.perf_counter() - start
+                start = time.perf_counter()
+                nlap = model.backward_nlap(feature, seq_len, mask)
+                nlap_time += time.perf_counter() - start
+            outputs.append(output.float())
+            nlap = nlap.float().cpu().numpy()
+            scores.extend([nlap[i, :l] for i, l in enumerate(seq_len)])
+    return {'outputs': torch.cat(outputs, dim=0), 'nlap': scores,
+            'forward_time': forward_time, 'nlap_time': nlap_time}
+
+def sentence_latency(model, batches, context=contextlib.nullcontext, n=200):
+    '''
+    Latency of scoring single sentences, i.e. the serving setting: mean,
+    median and 95th percentile milliseconds over the first n sentences.
+    '''
+    model.eval()
+    times = []
+    with torch.no_grad():
+        for feature, _, seq_len, mask in batches:
+            for i in range(len(seq_len)):
+                if len(times) == n:
+                    break
+                l = seq_len[i]
+                with context():
+                    start = time.perf_counter()
+                    model(feature[i:i+1, :l], [l], mask[i:i+1, :l])
+                    times.append((time.perf_counter() - start) * 1000)
+    return {'latency_ms_mean': float(np.mean(times)),
+            'latency_ms_p50': float(np.percentile(times, 50)),
+            'latency_ms_p95': float(np.percentile(times, 95))}
+
+def nlap_agreement(reference, candidate, top_k=3):
+    '''
+    Per-sentence agreement of two sets of NLAP scores: the mean Spearman
+    correlation, the mean overlap of the top_k tokens, and the largest
+    absolute difference of the (sum to one) normalized scores.
+    '''
+    rho, overlap, max_diff = [], [], 0.0
+    for r, c in zip(reference, candidate):
+        r_n = r / r.sum()
+        c_n = c / c.sum()
+        max_diff = max(max_diff, float(np.abs(r_n - c_n).max()))
+        if len(r) > 1:
+            rho.append(spearmanr(r, c)[0])
+        k = min(top_k, len(r))
+        overlap.append(len(set(np.argsort(-r)[:k]) & set(np.argsort(-c)[:k])) / k)
+    return {'nlap_spearman': float(np.nanmean(rho)),
+            'nlap_top{}_overlap'.format(top_k): float(np.mean(overlap)),
+            'nlap_max_abs_diff': max_diff}
+
+def compare_sst(reference, candidate, batches):
+    '''
+    Compares two runs of run_sst: accuracy of both, prediction agreement and
+    output difference, NLAP agreement and the speedups.
+    '''
+    targets = torch.cat([b[1] for b in batches], dim=0)
+    report = {}
+    for name, run in [('reference', reference), ('candidate', candidate)]:
+        multi, binary = SSTAccuracy().update(run['outputs'], targets).compute()
+        report[name + '_multi_acc'] = multi
+        report[name + '_binary_acc'] = binary
+    ref_out, cand_out = reference['outputs'], candidate['outputs']
+    report['prediction_agreement'] = \
+        (ref_out.argmax(dim=-1) == cand_out.argmax(dim=-1)).float().mean().item()
+    report['output_max_abs_diff'] = (ref_out - cand_out).abs().max().item()
+    report.update(nlap_agreement(reference['nlap'], candidate['nlap']))
+    report['forward_speedup'] = reference['forward_time'] / candidate['forward_time']
+    report['nlap_speedup'] = reference['nlap_time'] / candidate['nlap_time']
+    report['sentences_per_sec'] = len(targets) / candidate['forward_time']
+    return report
+
+def print_report(report):
+    for k, v in report.items():
+        print('{:<28s}{:0.5f}'.format(k, v))
+
+def fidelity_parser():
+    """Arguments shared by the SST fidelity checks."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default="../../../Stanford-Sentiment-Treebank/",
+                        help='path to the SST data')
+    parser.add_argument('--model_path', type=str, default="../bd01a5fa/best-model-SST-m.pth",
+                        help='float32 checkpoint of the SST model')
+    parser.add_argument('--split', type=str, default="test",
+                        help='held-out split to check on (default: test)')
+    parser.add_argument('--batch_size', type=int, default=500,
+                        help='evaluation batch size (default: 500)')
+    parser.add_argument('--sst_store', type=str, default=None,
+                        help='directory of SST stores made by corpus_store.py (default: load pickles)')
+    parser.add_argument('--token_dir', type=str, default=None,
+                        help='directory of token id stores made by corpus_store.py --token_ids')
+    return parser
+
+def load_sst_model(args, embedding=None):
+    arch, checkpoint = read_checkpoint(args.model_path, torch.device('cpu'))
+    model = TransformerLinearAttn(mods=['linguistic'], dims={'linguistic' : 300},
+                                  device=torch.device('cpu'), embedding=embedding, arch=arch)
+    load_model_weights(args.model_path, model, torch.device('cpu'), checkpoint)
+    return model.eval()
+
+if __name__ == "__main__":
+    # bfloat16 autocast against float32
+    args = fidelity_parser().parse_args()
+    data, classes, embedding = load_sst_eval(args, args.split)
+    model = load_sst_model(args, embedding)
+    batches = sst_batches(data, classes, args.batch_size)
+    reference = run_sst(model, batches)
+    candidate = run_sst(model, batches, lambda: autocast(True))
+    print_report(compare_sst(reference, candidate, batches))
@@ -0,0 +1,141 @@
+"""Streaming evaluation metrics for the SST and SEND experiments."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import torch
+import torch.nn.functional as F
+import torch.distributed as dist
+
+def one_hot(targets, n_class=5):
+    """Converts 1-indexed class labels into float one-hot targets."""
+    return F.one_hot(targets.long() - 1, n_class).float()
+
+class Metric(object):
+    '''
+    Base class of a mergeable accumulator. All the state of a metric lives in
+    a single float64 tensor of sufficient statistics, so merging two
+    accumulators (or reducing them across processes) is just a sum.
+    '''
+
+    def __init__(self, size):
+        self.state = torch.zeros(size, dtype=torch.float64)
+
+    def _add(self, stats):
+        if self.state.device != stats.device:
+            self.state = self.state.to(stats.device)
+        self.state += stats.to(torch.float64)
+        return self
+
+    def reset(self):
+        self.state.zero_()
+        return self
+
+    def merge(self, other):
+        """Adds the statistics of another accumulator of the same kind."""
+        return self._add(other.state)
+
+    def all_reduce(self, group=None):
+        """Sums the statistics over all processes of a distributed run."""
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.state, op=dist.ReduceOp.SUM, group=group)
+        return self
+
+class ConfusionMatrix(Metric):
+    '''
+    Confusion matrix over 1-indexed class labels; rows are the actual class
+    and columns the predicted class.
+    '''
+
+    def __init__(self, n_class=5):
+        super(ConfusionMatrix, self).__init__((n_class, n_class))
+        self.n_class = n_class
+
+    def update(self, predict, actual):
+        """predict -- (batch, n_class) scores, actual -- (batch,) labels"""
+        predicted = predict.argmax(dim=-1)
+        index = (actual.long() - 1) * self.n_class + predicted
+        counts = torch.bincount(index.reshape(-1),
+                                minlength=self.n_class*self.n_class)
+        return self._add(counts.reshape(self.n_class, self.n_class))
+
+    def compute(self):
+        return self.state.long().cpu()
+
+class SSTAccuracy(ConfusionMatrix):
+    '''
+    Multiclass and binary accuracy for SST. The binary accuracy only counts
+    the non-neutral sentences, and a sentence counts as correct when the
+    predicted class is on the same side of the neutral class.
+    '''
+
+    def __init__(self, n_class=5, neutral=3):
+        super(SSTAccuracy, self).__init__(n_class)
+        self.neutral = neutral
+
+    def counts(self):
+        """Returns (multiclass correct, binary correct, binary total)."""
+        cm = self.state
+        neg = self.neutral - 1
+        pos = self.neutral
+        multiclass = cm.trace()
+        binary = cm[:neg, :neg].sum() + cm[pos:, pos:].sum()
+        binary_total = cm[:neg].sum() + cm[pos:].sum()
+        return int(multiclass), int(binary), int(binary_total)
+
+    def compute(self):
+        """Returns (multiclass accuracy, binary accuracy)."""
+        multiclass, binary, binary_total = self.counts()
+        total = int(self.state.sum())
+        return multiclass*1.0/total, binary*1.0/binary_total
+
+class MSE(Metric):
+    """Mean squared error over the non-padding entries."""
+
+    def __init__(self):
+        super(MSE, self).__init__(2)
+
+    def update(self, y_pred, y_true, mask=None):
+        diff = (y_pred.detach() - y_true.detach()).to(torch.float64)
+        if mask is None:
+            mask = torch.ones_like(diff)
+        mask = mask.to(diff).expand_as(diff)
+        return self._add(torch.stack([mask.sum(), (mask*diff*diff).sum()]))
+
+    def compute(self):
+        n, sse = self.state.tolist()
+        return sse / n
+
+class CCC(Metric):
+    '''
+    Concordance correlation coefficient computed from running moments
+    (count, sums, sums of squares and cross products), so it gives the same
+    value as calculating it over the concatenated arrays.
+    '''
+
+    def __init__(self):
+        super(CCC, self).__init__(6)
+
+    def update(self, y_true, y_pred, mask=None):
+        x = y_true.detach().to(torch.float64).reshape(-1)
+        y = y_pred.detach().to(torch.float64).reshape(-1)
+        if mask is None:
+            w = torch.ones_like(x)
+        else:
+            w = mask.detach().to(x).reshape(-1)
+        stats = torch.stack([w.sum(), (w*x).sum(), (w*y).sum(),
+                             (w*x*x).sum(), (w*y*y).sum(), (w*x*y).sum()])
+        return self._add(stats)
+
+    def compute(self):
+        n, sx, sy, sxx, syy, sxy = self.state.tolist()
+        true_mean = sx / n
+        pred_mean = sy / n
+        true_var = sxx / n - true_mean ** 2
+        pred_var = syy / n - pred_mean ** 2
+        covar = sxy / n - true_mean * pred_mean
+        denom = true_var + pred_var + (pred_mean-true_mean) ** 2
+        if denom == 0:
+            return float('nan')
+        return 2*covar / denom
@@ -10,10 +10,10 @@ import numpy as np
 import torch.nn.functional as F
 import math, copy, time
 from torch.autograd import Variable
-import matplotlib.pyplot as plt
 
 from t.Models import *
 from make_masks import *
+from precision import full_precision
 
 def pad_shift(x, shift, padv=0.0):
     """Shift 3D tensor forwards in time with padding."""
@@ -42,6 +42,32 @@ def get_subsequent_mask(seq):
         torch.ones((1, len_s, len_s), device=seq.device), diagonal=1)).bool()
     return subsequent_mask
 
+# sizes of the self-attention encoder of the published models; d_model is
+# the size of the word vectors (300)
+DEFAULT_ARCH = {'n_layers': 6, 'n_head': 8, 'd_k': 64, 'd_v': 64, 'd_inner': 64}
+
+def encoder_arch(arch=None):
+    """DEFAULT_ARCH with the sizes given in arch (e.g. of a smaller student)."""
+    full = dict(DEFAULT_ARCH)
+    if arch is not None:
+        full.update((k, v) for k, v in arch.items() if k in DEFAULT_ARCH)
+    return full
+
+class FrozenEmbedding(nn.Module):
+    '''
+    Lookup table of pre-trained word vectors for token id inputs. The table is
+    never trained and is kept as a non-persistent buffer, so it can stay
+    memory-mapped, is shared by every model built on it and is not copied into
+    the checkpoints.
+    '''
+
+    def __init__(self, table):
+        super(FrozenEmbedding, self).__init__()
+        self.register_buffer('weight', torch.as_tensor(table), persistent=False)
+
+    def forward(self, ids):
+        return F.embedding(ids.long(), self.weight)
+
 class TransformerLinearAttn(nn.Module):
     '''
     Model Code: bd01a5fa-07d4-4870-8ef8-303abd397874
@@ -54,22 +80,27 @@ class TransformerLinearAttn(nn.Module):
     '''
 
     def __init__(self, mods, dims,
-                 device=torch.device('cuda:0')):
+                 device=torch.device('cuda:0'), embedding=None, arch=None):
         super(TransformerLinearAttn, self).__init__()
         # init
         self.mods = mods
         self.dims = dims
         self.window_embed_size={'linguistic' : 300}
 
+        # optional frozen lookup table for token id inputs
+        self.embedding = (FrozenEmbedding(embedding) if embedding is not None
+                          else None)
+
         # self-attention window embeddings
-        self.att_n_layer = 6
-        self.att_n_header = 8
+        self.arch = encoder_arch(arch)
+        self.att_n_layer = self.arch['n_layers']
+        self.att_n_header = self.arch['n_head']
         self.encoder_in = self.window_embed_size['linguistic']
         self.encoder_out = 300
-        att_d_k = 64
-        self.att_d_v = 64
+        att_d_k = self.arch['d_k']
+        self.att_d_v = self.arch['d_v']
         att_d_model = self.encoder_out
-        att_d_inner = 64
+        att_d_inner = self.arch['d_inner']
         self.attendedEncoder = attendedEncoder(self.att_n_layer,
                                                self.att_n_header,
                                                att_d_k,
@@ -103,9 +134,22 @@ class TransformerLinearAttn(nn.Module):
                        torch.device('cpu'))
         self.to(self.device)
 
-    def forward(self, inputs, length, mask=None):
-        batch_size = inputs.shape[0]
-        seq_len = inputs.shape[1]
+    def embed(self, inputs):
+        '''
+        Looks token id inputs up in the frozen embedding table; pre-embedded
+        float inputs are passed through.
+        '''
+        if self.embedding is not None and not inputs.is_floating_point():
+            return self.embedding(inputs)
+        return inputs
+
+    def encode(self, inputs, mask):
+        '''
+        The self-attention encoder. Returns its output and the token mask
+        (batch, len, 1) to pool it with. Split from forward so the encoder
+        output can be cached (see feature_cache.py).
+        '''
+        inputs = self.embed(inputs)
 
         # self-attention layers
         mask_bool = mask.bool()
@@ -114,33 +158,39 @@ class TransformerLinearAttn(nn.Module):
         attended_out, _,_,_,_,_,_,_,_,_,_,_ = \
             self.attendedEncoder(inputs,
                                  mask_bool)
+        # tokens dropped by token pruning are masked out as well
+        return attended_out, self.attendedEncoder.effective_mask(mask_bool)
 
-        # context layer
+    def pool(self, attended_out, mask_bool):
+        """Context layer: returns the attended embeddings and the gate attention."""
         attn = self.encoder_gate(attended_out)
         attn = attn.masked_fill(mask_bool == 0, -1e9)
-        attn = F.softmax(attn, dim=1)
+        attn = F.softmax(attn.float(), dim=1)
         # attened embeddings
         hs_attend = \
             torch.matmul(attn.permute(0,2,1), attended_out).squeeze(dim=1)
+        return hs_attend, attn
 
-        # final output blocks
-        hs_tw_fc1_pre = hs_attend.clone()
+    def decode(self, hs_attend):
+        """Final output blocks."""
         hs_tw_fc1 = self.out_fc1(hs_attend)
-        hs_tw_fc1_post = hs_tw_fc1.clone()
         hs_tw_fc2 = self.out_dropout(F.relu(hs_tw_fc1))
-        hs_tw_fc2_pre = hs_tw_fc2.clone()
-        hs_tw_fc2_post = self.out_fc2(hs_tw_fc2)
-        target_pre = hs_tw_fc2_post
-        target_ret = target_pre.clone()
+        target_pre = self.out_fc2(hs_tw_fc2)
         target = self.out_act(target_pre)
 
         return target
 
+    def forward(self, inputs, length, mask=None):
+        attended_out, mask_bool = self.encode(inputs, mask)
+        hs_attend, _ = self.pool(attended_out, mask_bool)
+        return self.decode(hs_attend)
+
     def backward_nlap(self, inputs, length, mask=None):
         '''
         This is backing out the attention using the context based attention and
         the attentions within the transformer using naive lap method proposed.
         '''
+        inputs = self.embed(inputs)
         batch_size = inputs.shape[0]
         seq_len = inputs.shape[1]
 
@@ -154,19 +204,23 @@ class TransformerLinearAttn(nn.Module):
 
         # context layer
         attn = self.encoder_gate(attended_out)
+        # tokens dropped by token pruning are masked out as well
+        mask_bool = self.attendedEncoder.effective_mask(mask_bool)
         attn = attn.masked_fill(mask_bool == 0, -1e9)
-        attn = F.softmax(attn, dim=1)
+        attn = F.softmax(attn.float(), dim=1)
 
         # self attention backout
         tf_attns = torch.stack(tf_attns, dim=0).permute(2,0,1,3,4)
         raw_attns = []
-        for h in range(tf_attns.shape[0]):
-            tf_attn = tf_attns[h]
-            pre_attn = attn.clone().permute(0, 2, 1)
-            for i in reversed(range(self.att_n_layer)):
-                curr_tf_attn = torch.matmul(pre_attn, tf_attn[i])
-                pre_attn = curr_tf_attn
-            raw_attns.append(pre_attn.permute(0,2,1))
+        # the rollout stays in float32 under autocast
+        with full_precision():
+            for h in range(tf_attns.shape[0]):
+                tf_attn = tf_attns[h]
+                pre_attn = attn.clone().permute(0, 2, 1)
+                for i in reversed(range(self.att_n_layer)):
+                    curr_tf_attn = torch.matmul(pre_attn, tf_attn[i])
+                    pre_attn = curr_tf_attn
+                raw_attns.append(pre_attn.permute(0,2,1))
 
         raw_attns = torch.stack(raw_attns, dim=0).sum(dim=0)
         return raw_attns.squeeze(dim=-1)
@@ -175,6 +229,7 @@ class TransformerLinearAttn(nn.Module):
         '''
         This is returning the transformer attention for each layer and each head.
         '''
+        inputs = self.embed(inputs)
         batch_size = inputs.shape[0]
         seq_len = inputs.shape[1]
 
@@ -187,8 +242,10 @@ class TransformerLinearAttn(nn.Module):
                                  mask_bool)
         # context layer
         attn = self.encoder_gate(attended_out)
+        # tokens dropped by token pruning are masked out as well
+        mask_bool = self.attendedEncoder.effective_mask(mask_bool)
         attn = attn.masked_fill(mask_bool == 0, -1e9)
-        attn = F.softmax(attn, dim=1)
+        attn = F.softmax(attn.float(), dim=1)
 
         ctx_attn = attn.clone().squeeze(dim=-1)
         tf_attns = torch.stack(tf_attns, dim=0).permute(1,2,0,3,4).contiguous()
@@ -215,22 +272,27 @@ class TransformerLSTMAttn(nn.Module):
     '''
 
     def __init__(self, mods, dims,
-                 device=torch.device('cuda:0')):
+                 device=torch.device('cuda:0'), embedding=None, arch=None):
         super(TransformerLSTMAttn, self).__init__()
         # init
         self.mods = mods
         self.dims = dims
         self.window_embed_size={'linguistic' : 300}
 
+        # optional frozen lookup table for token id inputs
+        self.embedding = (FrozenEmbedding(embedding) if embedding is not None
+                          else None)
+
         # self-attention window embeddings
-        self.att_n_layer = 6
-        self.att_n_header = 8
+        self.arch = encoder_arch(arch)
+        self.att_n_layer = self.arch['n_layers']
+        self.att_n_header = self.arch['n_head']
         self.encoder_in = self.window_embed_size['linguistic']
         self.encoder_out = 300
-        att_d_k = 64
-        self.att_d_v = 64
+        att_d_k = self.arch['d_k']
+        self.att_d_v = self.arch['d_v']
         att_d_model = self.encoder_out
-        att_d_inner = 64
+        att_d_inner = self.arch['d_inner']
         self.attendedEncoder = attendedEncoder(self.att_n_layer,
                                                self.att_n_header,
                                                att_d_k,
@@ -272,12 +334,24 @@ class TransformerLSTMAttn(nn.Module):
                        torch.device('cpu'))
         self.to(self.device)
 
-    def forward(self, inputs, length, token_length, mask=None):
+    def embed(self, inputs):
         '''
-        inputs = dict{} of (batch_size, seq_len, dim)
+        Looks token id inputs up in the frozen embedding table; pre-embedded
+        float inputs are passed through.
+        '''
+        if self.embedding is not None and not inputs.is_floating_point():
+            return self.embedding(inputs)
+        return inputs
+
+    def encode(self, inputs, length, token_length):
+        '''
+        The self-attention encoder over every window of the batch. Returns its
+        output (batch*len, tokens, dim) and the token mask (batch*len,
+        tokens, 1) to pool it with. Split from forward so the encoder output
+        can be cached (see feature_cache.py).
         '''
         # set the input to only single channel
-        single_mod = inputs['linguistic']
+        single_mod = self.embed(inputs['linguistic'])
 
         # generate token mask for encoder to use (only for att model)
         global_max_token_length = single_mod.shape[2]
@@ -294,25 +368,32 @@ class TransformerLSTMAttn(nn.Module):
 
         # reshape
         single_mod_flat = single_mod.reshape(batch_size*max_len, max_token, self.encoder_in)
-        token_len_pad_flat = token_len_pad.reshape(batch_size*max_len,)
         token_mask_flat = token_mask.reshape(batch_size*max_len, -1)
 
         # transformer encoder
         attended_out, _,_,_,_,_,_,_,_,_,_,_ = \
             self.attendedEncoder(single_mod_flat,
                                  token_mask_flat.unsqueeze(dim=-1))
+        # tokens dropped by token pruning are masked out as well
+        return attended_out, self.attendedEncoder.effective_mask(token_mask_flat.unsqueeze(dim=-1))
 
-        # get gated attention
+    def pool(self, attended_out, token_mask_flat):
+        """Gated attention over the tokens of every window: the attended embeddings and the gate attention."""
         attn = self.encoder_gate(attended_out)
-        token_mask_flat = token_mask_flat.unsqueeze(dim=-1)
         attn = attn.masked_fill(token_mask_flat == 0, -1e9)
-        attn = F.softmax(attn, dim=1)
+        attn = F.softmax(attn.float(), dim=1)
 
         # attened embeddings
         hs_attend = \
             torch.matmul(attn.permute(0,2,1), attended_out).squeeze(dim=1)
-        hs_attend = hs_attend.reshape(batch_size, max_len, -1)
+        return hs_attend, attn
 
+    def decode(self, hs_attend, length, mask):
+        '''
+        LSTM over the attended windows (batch, len, dim) and the output
+        layers.
+        '''
+        batch_size = len(length)
         # rnn on time windows
         embed_tw = pack_padded_sequence(hs_attend, length,
                                         batch_first=True,
@@ -330,13 +411,22 @@ class TransformerLSTMAttn(nn.Module):
 
         return target
 
+    def forward(self, inputs, length, token_length, mask=None):
+        '''
+        inputs = dict{} of (batch_size, seq_len, dim)
+        '''
+        attended_out, token_mask_flat = self.encode(inputs, length, token_length)
+        hs_attend, _ = self.pool(attended_out, token_mask_flat)
+        hs_attend = hs_attend.reshape(len(length), max(length), -1)
+        return self.decode(hs_attend, length, mask)
+
     def backward_nlap_ctx(self, inputs, length, token_length, mask=None):
         '''
         This is backing out the attention only using the context based attention
         scores.
         '''
         # set the input to only single channel
-        single_mod = inputs['linguistic']
+        single_mod = self.embed(inputs['linguistic'])
 
         # generate token mask for encoder to use (only for att model)
         global_max_token_length = single_mod.shape[2]
@@ -363,9 +453,10 @@ class TransformerLSTMAttn(nn.Module):
 
         # get gated attention
         attn = self.encoder_gate(attended_out)
-        token_mask_flat = token_mask_flat.unsqueeze(dim=-1)
+        # tokens dropped by token pruning are masked out as well
+        token_mask_flat = self.attendedEncoder.effective_mask(token_mask_flat.unsqueeze(dim=-1))
         attn = attn.masked_fill(token_mask_flat == 0, -1e9)
-        attn = F.softmax(attn, dim=1)
+        attn = F.softmax(attn.float(), dim=1)
 
         return attn.squeeze(dim=-1)
 
@@ -375,7 +466,7 @@ class TransformerLSTMAttn(nn.Module):
         the attentions within the transformer using naive lap method proposed.
         '''
         # set the input to only single channel
-        single_mod = inputs['linguistic']
+        single_mod = self.embed(inputs['linguistic'])
 
         # generate token mask for encoder to use (only for att model)
         global_max_token_length = single_mod.shape[2]
@@ -402,20 +493,23 @@ class TransformerLSTMAttn(nn.Module):
 
         # get gated attention
         attn = self.encoder_gate(attended_out)
-        token_mask_flat = token_mask_flat.unsqueeze(dim=-1)
+        # tokens dropped by token pruning are masked out as well
+        token_mask_flat = self.attendedEncoder.effective_mask(token_mask_flat.unsqueeze(dim=-1))
         attn = attn.masked_fill(token_mask_flat == 0, -1e9)
-        attn = F.softmax(attn, dim=1)
+        attn = F.softmax(attn.float(), dim=1)
 
         # self attention backout
         tf_attns = torch.stack(tf_attns, dim=0).permute(2,0,1,3,4)
         raw_attns = []
-        for h in range(tf_attns.shape[0]):
-            tf_attn = tf_attns[h]
-            pre_attn = attn.permute(0, 2, 1)
-            for i in reversed(range(self.att_n_layer)):
-                curr_tf_attn = torch.matmul(pre_attn, tf_attn[i])
-                pre_attn = curr_tf_attn
-            raw_attns.append(pre_attn.permute(0,2,1))
+        # the rollout stays in float32 under autocast
+        with full_precision():
+            for h in range(tf_attns.shape[0]):
+                tf_attn = tf_attns[h]
+                pre_attn = attn.permute(0, 2, 1)
+                for i in reversed(range(self.att_n_layer)):
+                    curr_tf_attn = torch.matmul(pre_attn, tf_attn[i])
+                    pre_attn = curr_tf_attn
+                raw_attns.append(pre_attn.permute(0,2,1))
 
         raw_attns = torch.stack(raw_attns, dim=0).sum(dim=0)
         return raw_attns.squeeze(dim=-1)
@@ -426,7 +520,7 @@ class TransformerLSTMAttn(nn.Module):
         using lap method proposed.
         '''
         # set the input to only single channel
-        single_mod = inputs['linguistic']
+        single_mod = self.embed(inputs['linguistic'])
 
         # generate token mask for encoder to use (only for att model)
         global_max_token_length = single_mod.shape[2]
@@ -457,9 +551,10 @@ class TransformerLSTMAttn(nn.Module):
 
         # get gated attention
         attn = self.encoder_gate(attended_out)
-        token_mask_flat = token_mask_flat.unsqueeze(dim=-1)
+        # tokens dropped by token pruning are masked out as well
+        token_mask_flat = self.attendedEncoder.effective_mask(token_mask_flat.unsqueeze(dim=-1))
         attn = attn.masked_fill(token_mask_flat == 0, -1e9)
-        attn = F.softmax(attn, dim=1)
+        attn = F.softmax(attn.float(), dim=1)
 
         # attened embeddings
         hs_attend = \
@@ -528,7 +623,7 @@ class TransformerLSTMAttn(nn.Module):
         This is returning the transformer attention for each layer and each head.
         '''
         # set the input to only single channel
-        single_mod = inputs['linguistic']
+        single_mod = self.embed(inputs['linguistic'])
 
         # generate token mask for encoder to use (only for att model)
         global_max_token_length = single_mod.shape[2]
@@ -559,9 +654,10 @@ class TransformerLSTMAttn(nn.Module):
 
         # get gated attention
         attn = self.encoder_gate(attended_out)
-        token_mask_flat = token_mask_flat.unsqueeze(dim=-1)
+        # tokens dropped by token pruning are masked out as well
+        token_mask_flat = self.attendedEncoder.effective_mask(token_mask_flat.unsqueeze(dim=-1))
         attn = attn.masked_fill(token_mask_flat == 0, -1e9)
-        attn = F.softmax(attn, dim=1)
+        attn = F.softmax(attn.float(), dim=1)
 
         ctx_attn = attn.clone().squeeze(dim=-1)
         tf_attns = torch.stack(tf_attns, dim=0).permute(1,2,0,3,4).contiguous()
@@ -0,0 +1,154 @@
+"""Three stage pipeline for the attention extraction: batches are prepared on a
+loader thread and the results post-processed and written on a writer thread,
+joined to the main thread that runs the model by bounded queues, with the
+time every stage spends busy."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import queue
+import threading
+from contextlib import contextmanager
+
+STAGES = ('load', 'compute', 'write')
+_END = object()
+
+def add_pipeline_args(parser):
+    parser.add_argument('--pipeline_depth', type=int, default=2,
+                        help='batches queued between the load, compute and write stages, '
+                             '0 to run them one after the other (default: 2)')
+    return parser
+
+class StageClock(object):
+    """Busy and waiting time of a stage, and the number of items it handled."""
+
+    def __init__(self):
+        self.busy = 0.0
+        self.wait = 0.0
+        self.items = 0
+
+    @contextmanager
+    def busy_time(self):
+        start = time.time()
+        yield
+        self.busy += time.time() - start
+
+    @contextmanager
+    def wait_time(self):
+        start = time.time()
+        yield
+        self.wait += time.time() - start
+
+def _put(q, item, stop):
+    # block until there is room, unless the pipeline is stopping
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def run_pipeline(source, compute, sink, depth=2):
+    '''
+    Runs compute on every item of source and sink on every result, in
+    order. Iterating source (load) and sink (write) run on their own
+    threads with at most depth items queued before and after compute, which
+    runs on the calling thread and so can use autograd. Threads rather than
+    processes, so batches and results are not copied; the model ops release
+    the GIL. With depth 0 the stages run one after the other.
+
+    An error in any stage stops the pipeline and is raised here once the
+    results already computed are written. Returns the StageClock of every
+    stage and the wall time.
+    '''
+    clocks = {stage: StageClock() for stage in STAGES}
+    start = time.time()
+    if depth == 0:
+        items = iter(source)
+        while True:
+            with clocks['load'].busy_time():
+                item = next(items, _END)
+            if item is _END:
+                break
+            with clocks['compute'].busy_time():
+                result = compute(item)
+            with clocks['write'].busy_time():
+                sink(result)
+            for clock in clocks.values():
+                clock.items += 1
+        return clocks, time.time() - start
+
+    loaded, computed = queue.Queue(depth), queue.Queue(depth)
+    stop = threading.Event()
+    # the items loaded before an error in load are still computed and written
+    load_errors, errors = [], []
+
+    def load():
+        try:
+            items = iter(source)
+            while not stop.is_set():
+                with clocks['load'].busy_time():
+                    item = next(items, _END)
+                if item is _END:
+                    break
+                clocks['load'].items += 1
+                with clocks['load'].wait_time():
+                    _put(loaded, item, stop)
+        except BaseException as e:
+            load_errors.append(e)
+        finally:
+            _put(loaded, _END, stop)
+
+    def write():
+        while True:
+            with clocks['write'].wait_time():
+                result = computed.get()
+            if result is _END:
+                return
+            if errors:
+                continue
+            try:
+                with clocks['write'].busy_time():
+                    sink(result)
+                clocks['write'].items += 1
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+    threads = [threading.Thread(target=load, name='pipeline-load', daemon=True),
+               threading.Thread(target=write, name='pipeline-write', daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while not errors:
+            with clocks['compute'].wait_time():
+                item = loaded.get()
+            if item is _END:
+                break
+            with clocks['compute'].busy_time():
+                result = compute(item)
+            clocks['compute'].items += 1
+            with clocks['compute'].wait_time():
+                computed.put(result)
+    finally:
+        # let the loader exit and the writer finish the results it has
+        stop.set()
+        computed.put(_END)
+        for thread in threads:
+            thread.join()
+    errors += load_errors
+    if errors:
+        raise errors[0]
+    return clocks, time.time() - start
+
+def utilization_report(clocks, wall):
+    """Fraction of the wall time every stage was busy, and the items it handled."""
+    report = 'Pipeline ({:0.1f}s)'.format(wall)
+    for stage in STAGES:
+        clock = clocks[stage]
+        report += '\t{}: {:0.0f}% busy, {:0.0f}% waiting, {} batches'.format(
+            stage, 100.0 * clock.busy / max(wall, 1e-9), 100.0 * clock.wait / max(wall, 1e-9),
+            clock.items)
+    return report
@@ -0,0 +1,30 @@
+"""Mixed precision (bfloat16 autocast) on the CPU."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import contextlib
+
+import torch
+
+def cpu_autocast_available():
+    return hasattr(torch, 'autocast') and hasattr(torch, 'bfloat16')
+
+def autocast(enabled=True, dtype=None):
+    '''
+    Runs the matmuls and linear layers of the enclosed code in bfloat16 on
+    the CPU. The models keep the softmaxes, LayerNorms, the residual stream
+    and the attention rollouts in float32 themselves.
+    '''
+    if not enabled:
+        return contextlib.nullcontext()
+    if not cpu_autocast_available():
+        raise RuntimeError('This torch release has no CPU autocast')
+    return torch.autocast('cpu', dtype=dtype or torch.bfloat16)
+
+def full_precision():
+    """Disables autocast, e.g. for the chains of matmuls of an attention rollout."""
+    if not cpu_autocast_available():
+        return contextlib.nullcontext()
+    return torch.autocast('cpu', enabled=False)
@@ -0,0 +1,171 @@
+"""Head pruning for the SST model: scores the attention heads by their LAT
+contribution to sentiment-bearing tokens or by gradient importance, removes the
+least important ones from every layer, optionally fine-tunes, and reports the
+speed/accuracy curve."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import pickle
+import random
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from metrics import one_hot
+from checkpoint import atomic_save, model_checkpoint
+from fidelity import fidelity_parser, load_sst_eval, load_sst_model, sst_batches, \
+    run_sst, compare_sst
+
+CURVE_KEYS = ['candidate_multi_acc', 'candidate_binary_acc', 'prediction_agreement',
+              'nlap_spearman', 'forward_speedup', 'nlap_speedup']
+
+def lat_head_scores(model, batches, token_rate, include_words=(1, 5)):
+    '''
+    Mean attention mass each head routes to the tokens rated in
+    include_words (very negative or very positive), as in
+    attention_util.head_heatmap_viz_func: the context attention rolled back
+    through the attention of one head in every layer. batches have ids.
+    '''
+    scores, n = 0, 0
+    with torch.no_grad():
+        for feature, _, seq_len, mask, ids in batches:
+            tf_attns, ctx_attn = model.backward_tf_attn(feature, seq_len, mask)
+            # batch x head x 1 x len, rolled back layer by layer
+            pre_attn = ctx_attn.float()[:, None, None, :]
+            for i in reversed(range(tf_attns.shape[2])):
+                pre_attn = torch.matmul(pre_attn, tf_attns[:, :, i].float())
+            sentiment = torch.zeros(len(ids), pre_attn.shape[-1])
+            for row, _id in enumerate(ids):
+                rates = token_rate[_id][:seq_len[row]]
+                sentiment[row, :len(rates)] = torch.tensor([r in include_words for r in rates],
+                                                           dtype=torch.float)
+            scores = scores + (pre_attn.squeeze(dim=2) * sentiment[:, None, :]).sum(dim=(0, 2))
+            n += len(ids)
+    return (scores / n).numpy()
+
+def gradient_head_scores(model, batches):
+    '''
+    Gradient importance of every head (Michel et al., 2019): the absolute
+    first order change of the training loss of a sentence when the head is
+    masked out, |head output . d loss / d head output|, summed over the
+    sentences and the layers.
+    '''
+    encoder = model.attendedEncoder
+    n_head = encoder.layer_stack[0].slf_attn.n_head
+    criterion = nn.BCELoss(reduction='sum')
+    scores = torch.zeros(n_head, dtype=torch.float64)
+
+    def capture(module, inputs, output):
+        # the input of fc is the concatenated output of the heads
+        heads = inputs[0]
+        def accumulate(grad):
+            contrib = (heads.detach() * grad).view(heads.shape[0], heads.shape[1], n_head, -1)
+            scores.add_(contrib.sum(dim=(1, 3)).abs().sum(dim=0).double())
+        heads.register_hook(accumulate)
+
+    handles = [enc_layer.slf_attn.fc.register_forward_hook(capture)
+               for enc_layer in encoder.layer_stack]
+    model.eval()
+    try:
+        for batch in batches:
+            feature, targets, seq_len, mask = batch[:4]
+            model.zero_grad()
+            output = model(feature, seq_len, mask)
+            criterion(output, one_hot(targets)).backward()
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.zero_grad()
+    return scores.numpy()
+
+def finetune(model, batches, epochs=1, lr=1e-4):
+    """Fine-tunes a pruned model with the SST loss and optimizer of train.py."""
+    criterion = nn.BCELoss(reduction='sum')
+    optimizer = optim.Adam(model.parameters(), lr=lr, weight_decay=1e-4)
+    for epoch in range(epochs):
+        model.train()
+        total = 0.0
+        for feature, targets, seq_len, mask in random.sample(batches, len(batches)):
+            batch_loss = criterion(model(feature, seq_len, mask), one_hot(targets))
+            batch_loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            total += batch_loss.item()
+        print('Epoch: {}\tMean Batch Loss: {:2.5f}'.format(epoch, total / len(batches)))
+    return model.eval()
+
+def save_pruned(model, path):
+    '''
+    Saves a pruned model like train.save_checkpoint, with the pruned heads,
+    so that load_model_weights can prune a fresh model before loading it.
+    '''
+    atomic_save(model_checkpoint(model, modalities=['linguistic'],
+                                 mod_dimension={'linguistic' : 300}), path)
+
+if __name__ == "__main__":
+    parser = fidelity_parser()
+    parser.add_argument('--score', type=str, default="lat",
+                        help='lat (attention to sentiment tokens) or grad (gradient importance)')
+    parser.add_argument('--token_rate', type=str, default=None,
+                        help='seq_token_rate.p written by attention_viz.py, needed by --score lat')
+    parser.add_argument('--score_split', type=str, default="valid",
+                        help='split to score the heads on (default: valid)')
+    parser.add_argument('--n_prune', type=int, nargs='+', default=[1, 2, 4, 6],
+                        help='numbers of heads to prune from every layer (default: 1 2 4 6)')
+    parser.add_argument('--finetune_epochs', type=int, default=0,
+                        help='epochs to fine-tune every pruned model on train (default: 0)')
+    parser.add_argument('--lr', type=float, default=1e-4,
+                        help='fine-tuning learning rate (default: 1e-4)')
+    parser.add_argument('--train_batch_size', type=int, default=50,
+                        help='fine-tuning batch size (default: 50)')
+    parser.add_argument('--out_dir', type=str, default=None,
+                        help='where to save the pruned models (default: do not save)')
+    args = parser.parse_args()
+    if args.score == "lat" and args.token_rate is None:
+        parser.error('--score lat needs --token_rate')
+    torch.manual_seed(1)
+    random.seed(1)
+
+    data, classes, embedding = load_sst_eval(args, args.split)
+    eval_batches = sst_batches(data, classes, args.batch_size)
+    model = load_sst_model(args, embedding)
+
+    data, classes, _ = load_sst_eval(args, args.score_split)
+    if args.score == "lat":
+        token_rate = pickle.load(open(args.token_rate, "rb"))
+        scores = lat_head_scores(model, sst_batches(data, classes, args.batch_size,
+                                                    return_ids=True), token_rate)
+    else:
+        scores = gradient_head_scores(model, sst_batches(data, classes, args.batch_size))
+    # least important first
+    order = np.argsort(scores, kind='stable').tolist()
+    print('Head scores: ' + ' '.join('{}:{:0.5f}'.format(h, scores[h]) for h in range(len(scores))))
+
+    train_batches = None
+    if args.finetune_epochs > 0:
+        data, classes, _ = load_sst_eval(args, 'train')
+        train_batches = sst_batches(data, classes, args.train_batch_size)
+
+    reference = run_sst(model, eval_batches)
+    curve = []
+    for n_prune in args.n_prune:
+        pruned = load_sst_model(args, embedding)
+        pruned.attendedEncoder.prune_heads(order[:n_prune])
+        if train_batches is not None:
+            finetune(pruned, train_batches, args.finetune_epochs, args.lr)
+        report = compare_sst(reference, run_sst(pruned, eval_batches), eval_batches)
+        curve.append((n_prune, report))
+        if args.out_dir is not None:
+            save_pruned(pruned, os.path.join(args.out_dir,
+                                             'pruned-{}-model-SST.pth'.format(n_prune)))
+
+    print('unpruned multi acc {:0.5f} binary acc {:0.5f}'.format(
+        curve[0][1]['reference_multi_acc'], curve[0][1]['reference_binary_acc']))
+    print('{:>8s}'.format('pruned') + ''.join('{:>24s}'.format(k) for k in CURVE_KEYS))
+    for n_prune, report in curve:
+        print('{:>8d}'.format(n_prune) + ''.join('{:>24.5f}'.format(report[k]) for k in CURVE_KEYS))
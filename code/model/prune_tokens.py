@@ -0,0 +1,56 @@
+"""Token pruning for SST inference: after a chosen layer of the attendedEncoder,
+only the tokens that received the most attention so far are kept, so the later
+layers run on shorter sequences. Reports speedup against accuracy and NLAP drift."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from fidelity import fidelity_parser, load_sst_eval, load_sst_model, sst_batches, \
+    run_sst, compare_sst
+
+REPORT_KEYS = ['candidate_multi_acc', 'candidate_binary_acc', 'prediction_agreement',
+               'nlap_spearman', 'nlap_top3_overlap', 'forward_speedup', 'nlap_speedup']
+
+def sweep(model, batches, layers, ratios, min_tokens=1):
+    '''
+    Runs every (layer, keep ratio) setting against the unpruned model and
+    returns the reference accuracy and one compare_sst report per setting.
+    '''
+    encoder = model.attendedEncoder
+    encoder.set_token_pruning(None)
+    reference = run_sst(model, batches)
+    results = []
+    for layer in layers:
+        for ratio in ratios:
+            encoder.set_token_pruning(layer, ratio, min_tokens)
+            candidate = run_sst(model, batches)
+            results.append((layer, ratio, compare_sst(reference, candidate, batches)))
+    encoder.set_token_pruning(None)
+    return results
+
+if __name__ == "__main__":
+    parser = fidelity_parser()
+    parser.add_argument('--prune_layers', type=int, nargs='+', default=[1, 2, 3],
+                        help='numbers of layers run on all the tokens before pruning (default: 1 2 3)')
+    parser.add_argument('--keep_ratios', type=float, nargs='+', default=[0.75, 0.5, 0.25],
+                        help='fractions of the tokens of a sentence to keep (default: 0.75 0.5 0.25)')
+    parser.add_argument('--min_tokens', type=int, default=1,
+                        help='never keep fewer tokens than this (default: 1)')
+    args = parser.parse_args()
+
+    data, classes, embedding = load_sst_eval(args, args.split)
+    model = load_sst_model(args, embedding)
+    n_layers = len(model.attendedEncoder.layer_stack)
+    if min(args.prune_layers) < 1 or max(args.prune_layers) >= n_layers:
+        parser.error('--prune_layers must be in [1, {})'.format(n_layers))
+    batches = sst_batches(data, classes, args.batch_size)
+    results = sweep(model, batches, args.prune_layers, args.keep_ratios, args.min_tokens)
+
+    first = results[0][2]
+    print('unpruned multi acc {:0.5f} binary acc {:0.5f}'.format(
+        first['reference_multi_acc'], first['reference_binary_acc']))
+    print('{:>6s}{:>6s}'.format('layer', 'keep') + ''.join('{:>24s}'.format(k) for k in REPORT_KEYS))
+    for layer, ratio, report in results:
+        print('{:>6d}{:>6.2f}'.format(layer, ratio) +
+              ''.join('{:>24.5f}'.format(report[k]) for k in REPORT_KEYS))
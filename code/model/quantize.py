@@ -0,0 +1,61 @@
+"""Dynamic int8 quantized inference for the SST model (TransformerLinearAttn)."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import torch
+import torch.nn as nn
+
+from checkpoint import torch_load
+from fidelity import fidelity_parser, load_sst_eval, load_sst_model, sst_batches, \
+    run_sst, compare_sst, sentence_latency, print_report
+
+def quantize_model(model):
+    '''
+    Returns a copy of a float32 model with every nn.Linear replaced by a
+    dynamically quantized int8 one: the attention projections (w_qs, w_ks,
+    w_vs, fc), the position-wise feed-forward layers, the context gate and the
+    output layers. Activations are quantized on the fly per batch, so no
+    calibration data is needed. CPU inference only.
+    '''
+    model = model.cpu().eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def save_quantized(model, path):
+    torch.save({'model': model.state_dict()}, path)
+
+def load_quantized(model, path):
+    '''
+    Loads a checkpoint written by save_quantized into a float32 model of the
+    same architecture, which is quantized first to get the int8 modules.
+    '''
+    model = quantize_model(model)
+    model.load_state_dict(torch_load(path, torch.device('cpu'))['model'])
+    return model
+
+if __name__ == "__main__":
+    parser = fidelity_parser()
+    parser.add_argument('--out_path', type=str, default=None,
+                        help='where to save the quantized model (default: do not save)')
+    parser.add_argument('--latency_n', type=int, default=200,
+                        help='number of single sentences to time (default: 200)')
+    args = parser.parse_args()
+
+    data, classes, embedding = load_sst_eval(args, args.split)
+    model = load_sst_model(args, embedding)
+    qmodel = quantize_model(model)
+    if args.out_path is not None:
+        save_quantized(qmodel, args.out_path)
+
+    # batched throughput, accuracy and LAT agreement against float32
+    batches = sst_batches(data, classes, args.batch_size)
+    reference = run_sst(model, batches)
+    candidate = run_sst(qmodel, batches)
+    report = compare_sst(reference, candidate, batches)
+    report['reference_sentences_per_sec'] = len(reference['outputs']) / reference['forward_time']
+    # single sentence latency
+    for name, m in [('reference', model), ('candidate', qmodel)]:
+        for k, v in sentence_latency(m, batches, n=args.latency_n).items():
+            report[name + '_' + k] = v
+    print_report(report)
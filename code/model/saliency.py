@@ -0,0 +1,182 @@
+"""Gradient saliency of the model inputs (the gs scores of attn_analyze.py),
+computed with vector-Jacobian products of the outputs w.r.t. the inputs only:
+the gradient of the summed outputs in one pass, or the gradient of every
+output (e.g. every class) of every sample of a batch by batching one-hot
+cotangents through a vmapped backward pass, a chunk at a time. Also the
+integrated gradients and occlusion baselines, which run the interpolation
+points or occluded tokens as copies of the batch stacked into large forward
+passes, a bounded number of copies at a time."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import inspect
+import warnings
+
+import torch
+
+def batched_grads_available():
+    return 'is_grads_batched' in inspect.signature(torch.autograd.grad).parameters
+
+def output_cotangents(output, sample_dims=1):
+    '''
+    One-hot cotangents (n, *output.shape) picking every one of the n outputs
+    of a sample, the same one in every sample: output.shape[:sample_dims]
+    index the samples. The samples of a batch do not interact, so the VJP
+    with each cotangent is the gradient of that output of every sample.
+    '''
+    shape = output.shape[sample_dims:]
+    n = 1
+    for size in shape:
+        n *= size
+    eye = torch.eye(n, dtype=output.dtype, device=output.device).reshape((n,) + (1,) * sample_dims + shape)
+    return eye.expand((n,) + output.shape)
+
+def _missing_batching_rule(error):
+    """Whether the vmapped backward failed on an op that vmap cannot batch."""
+    message = str(error)
+    return 'Batching rule not implemented' in message or 'vmap' in message
+
+def _batched_vjp(output, inputs, cotangents):
+    '''
+    The VJPs of a chunk of cotangents, vmapped over the backward pass; a
+    loop over them where that is missing (older torch) or cannot batch an
+    op of the model, with a warning. Other errors are raised.
+    '''
+    if batched_grads_available():
+        try:
+            return torch.autograd.grad(output, inputs, cotangents, retain_graph=True,
+                                       is_grads_batched=True)[0]
+        except RuntimeError as e:
+            if not _missing_batching_rule(e):
+                raise
+            warnings.warn('the backward pass cannot be vmapped, running one cotangent at a '
+                          'time: ' + str(e).splitlines()[0])
+    return torch.stack([torch.autograd.grad(output, inputs, v, retain_graph=True)[0]
+                        for v in cotangents], dim=0)
+
+def input_gradients(forward, inputs, cotangents=None, chunk_size=None):
+    '''
+    Runs forward on inputs and returns its output (detached) with the
+    gradients of the output w.r.t. inputs. With cotangents None, the
+    gradient of the summed outputs (inputs.shape); otherwise one gradient
+    per cotangent (n, *inputs.shape), chunk_size cotangents at a time (all
+    at once by default). cotangents can be a function of the output, e.g.
+    output_cotangents.
+
+    The gradients do not build up in the parameters, and the graph of
+    forward is freed on return, so other passes (e.g. the LAT) can run
+    under torch.no_grad.
+    '''
+    inputs = inputs.detach().requires_grad_()
+    with torch.enable_grad():
+        output = forward(inputs)
+    if cotangents is None:
+        return output.detach(), torch.autograd.grad(output, inputs, torch.ones_like(output))[0]
+    if callable(cotangents):
+        cotangents = cotangents(output)
+    chunk_size = chunk_size or len(cotangents)
+    gradients = [_batched_vjp(output, inputs, cotangents[start:start + chunk_size])
+                 for start in range(0, len(cotangents), chunk_size)]
+    return output.detach(), torch.cat(gradients, dim=0)
+
+def per_output_gradients(forward, inputs, sample_dims=1, chunk_size=None):
+    '''
+    The gradient of every output of every sample (e.g. every class of a
+    sentence, or every window of a video) w.r.t. its inputs: the output and
+    (n, *inputs.shape), with n the outputs of a sample. Their sum over n is
+    the gradient of input_gradients without cotangents.
+    '''
+    return input_gradients(forward, inputs,
+                           lambda output: output_cotangents(output, sample_dims), chunk_size)
+
+def gradient_saliency(gradients):
+    """Squared gradients summed over the features (last dim), the gs score."""
+    return (gradients**2).sum(dim=-1)
+
+ATTRIBUTIONS = ('ig', 'occlusion')
+
+def add_attribution_args(parser):
+    parser.add_argument('--attributions', type=str, nargs='*', default=[], choices=ATTRIBUTIONS,
+                        help='baselines to score the words with next to LAT and gs: integrated '
+                             'gradients (ig) and occlusion (default: none)')
+    parser.add_argument('--ig_steps', type=int, default=16,
+                        help='interpolation steps of integrated gradients (default: 16)')
+    parser.add_argument('--attribution_chunk', type=int, default=4,
+                        help='copies of a batch (interpolation steps or occluded tokens) per '
+                             'forward pass of the attributions (default: 4)')
+    return parser
+
+def attribution_settings(args):
+    """The settings that change the attribution scores, none without attributions."""
+    if not args.attributions:
+        return ()
+    return (tuple(args.attributions), args.ig_steps)
+
+def integrated_gradients(forward, inputs, baseline=None, steps=16, chunk_size=4):
+    '''
+    Integrated gradients of the summed outputs of every sample w.r.t. its
+    inputs, from baseline (zeros, i.e. padding, by default), with a
+    midpoint sum over steps points of the path. The points are stacked as
+    copies of the batch along its first dim, chunk_size of them per forward
+    pass, so forward has to take any number of stacked copies. Returns the
+    attributions (inputs.shape); summed over the features, the attribution
+    of every token. Their sum approaches the change of the outputs from
+    baseline as steps grow, slowly from zeros: the input LayerNorm of the
+    models makes the start of that path steep.
+    '''
+    inputs = inputs.detach()
+    baseline = torch.zeros_like(inputs) if baseline is None else baseline
+    delta = inputs - baseline
+    total = torch.zeros_like(inputs)
+    for start in range(0, steps, chunk_size):
+        alphas = torch.arange(start, min(start + chunk_size, steps), dtype=inputs.dtype,
+                              device=inputs.device)
+        alphas = ((alphas + 0.5) / steps).reshape((-1,) + (1,) * inputs.dim())
+        points = baseline + alphas * delta
+        _, grad = input_gradients(forward, points.reshape((-1,) + inputs.shape[1:]))
+        total += grad.reshape(points.shape).sum(dim=0)
+    return total * delta / steps
+
+def occlusion(forward, inputs, baseline=None, chunk_size=4):
+    '''
+    Drop of the summed outputs of every sample when each of its tokens
+    (every position between the first and the feature dims) is replaced by
+    baseline (zeros, i.e. padding, by default): (batch, *positions). A
+    token is occluded in every sample of a copy of the batch at once, since
+    the samples do not interact, and chunk_size copies are stacked per
+    forward pass. Positions that are padding in every sample are skipped,
+    their drop is 0.
+    '''
+    inputs = inputs.detach()
+    baseline = torch.zeros_like(inputs) if baseline is None else baseline
+    batch_size, positions = inputs.shape[0], inputs.shape[1:-1]
+    flat = inputs.reshape(batch_size, -1, inputs.shape[-1])
+    flat_baseline = baseline.reshape(flat.shape)
+    active = (flat != flat_baseline).any(dim=-1).any(dim=0).nonzero().reshape(-1)
+    drops = torch.zeros(flat.shape[1], batch_size)
+    with torch.no_grad():
+        reference = forward(inputs).float().reshape(batch_size, -1).sum(dim=-1)
+        for start in range(0, len(active), chunk_size):
+            occluded = active[start:start + chunk_size]
+            copies = flat.unsqueeze(dim=0).repeat(len(occluded), 1, 1, 1)
+            copies[torch.arange(len(occluded)), :, occluded] = \
+                flat_baseline[:, occluded].permute(1, 0, 2)
+            output = forward(copies.reshape((-1,) + inputs.shape[1:])).float()
+            drops[occluded] = (reference - output.reshape(len(occluded), batch_size, -1).sum(dim=-1)).cpu()
+    return drops.t().reshape((batch_size,) + positions)
+
+def token_attributions(forward, inputs, args):
+    '''
+    The token scores (batch, *positions) of every attribution of
+    args.attributions, in order; forward takes stacked copies of the batch.
+    '''
+    scores = []
+    for name in args.attributions:
+        if name == 'ig':
+            scores.append(integrated_gradients(forward, inputs, steps=args.ig_steps,
+                                               chunk_size=args.attribution_chunk).sum(dim=-1))
+        elif name == 'occlusion':
+            scores.append(occlusion(forward, inputs, chunk_size=args.attribution_chunk))
+    return scores
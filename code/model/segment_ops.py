@@ -0,0 +1,97 @@
+"""Normalizations of ragged scores, one segment (sentence or window) at a time,
+in one vectorized call over a flat array of the scores of every segment and
+the offsets where the segments start. Every function takes a NumPy array or a
+torch tensor and returns the same type."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import numpy as np
+import torch
+
+def pack_segments(padded, lengths):
+    '''
+    Flattens the first lengths[i] scores of every row of padded (rows x
+    len) into a flat array, with the offsets (rows + 1) of the segments.
+    Lengths longer than the rows are cut to them.
+    '''
+    width = padded.shape[1]
+    if torch.is_tensor(padded):
+        lengths = torch.as_tensor(lengths, dtype=torch.long).clamp(max=width)
+        mask = torch.arange(width).unsqueeze(dim=0) < lengths.unsqueeze(dim=-1)
+        offsets = torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(lengths, dim=0)])
+        return padded[mask], offsets
+    lengths = np.minimum(np.asarray(lengths, dtype=np.int64), width)
+    mask = np.arange(width)[None, :] < lengths[:, None]
+    return padded[mask], np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+def split_segments(flat, offsets):
+    """The segments of a flat array, as a list of arrays (or tensors)."""
+    offsets = offsets.tolist()
+    return [flat[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+def _segment_ids(offsets):
+    if torch.is_tensor(offsets):
+        return torch.repeat_interleave(torch.arange(len(offsets) - 1), offsets[1:] - offsets[:-1])
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+def _reduce(flat, offsets, op):
+    '''
+    max or min (op) of every segment, with -inf or inf for the empty ones;
+    reduceat over the non-empty segments in NumPy, a max over the segments
+    padded into rows in torch.
+    '''
+    fill = -np.inf if op == 'max' else np.inf
+    if torch.is_tensor(flat):
+        lengths = offsets[1:] - offsets[:-1]
+        width = int(lengths.max()) if len(lengths) else 0
+        padded = torch.full((len(lengths), max(width, 1)), fill, dtype=flat.dtype)
+        ids = _segment_ids(offsets)
+        padded[ids, torch.arange(len(flat)) - offsets[ids]] = flat
+        return padded.max(dim=1)[0] if op == 'max' else padded.min(dim=1)[0]
+    lengths = np.diff(offsets)
+    out = np.full(len(lengths), fill, dtype=np.result_type(flat.dtype, np.float32))
+    nonempty = lengths > 0
+    if nonempty.any():
+        ufunc = np.maximum if op == 'max' else np.minimum
+        out[nonempty] = ufunc.reduceat(flat, offsets[:-1][nonempty])
+    return out
+
+def _segment_sum(values, offsets, ids):
+    if torch.is_tensor(values):
+        return torch.zeros(len(offsets) - 1, dtype=values.dtype).index_add(0, ids, values)
+    return np.bincount(ids, weights=values, minlength=len(offsets) - 1)
+
+def _nonzero(x):
+    """x with its zeros replaced by ones, to divide by."""
+    if torch.is_tensor(x):
+        return torch.where(x == 0, torch.ones_like(x), x)
+    return np.where(x == 0, 1, x)
+
+def segment_softmax(flat, offsets):
+    """Softmax of every segment, as attn_analyze.softmax over its scores."""
+    ids = _segment_ids(offsets)
+    exp = flat - _reduce(flat, offsets, 'max')[ids]
+    exp = torch.exp(exp) if torch.is_tensor(exp) else np.exp(exp)
+    return exp / _segment_sum(exp, offsets, ids)[ids]
+
+def segment_minmax(flat, offsets):
+    '''
+    Min-max scaling of every segment to [0, 1], as normalize_w: a segment
+    whose scores are all equal gets their mean.
+    '''
+    ids = _segment_ids(offsets)
+    low, high = _reduce(flat, offsets, 'min'), _reduce(flat, offsets, 'max')
+    span = (high - low)[ids]
+    mean = (_segment_sum(flat, offsets, ids) / _nonzero(offsets[1:] - offsets[:-1]))[ids]
+    scaled = (flat - low[ids]) / _nonzero(span)
+    return (torch.where if torch.is_tensor(flat) else np.where)(span == 0, mean, scaled)
+
+def segment_absmax(flat, offsets):
+    '''
+    Scores of every segment divided by their largest absolute value, as
+    normalize_lap; an all zero segment stays zero.
+    '''
+    ids = _segment_ids(offsets)
+    return flat / _nonzero(_reduce(abs(flat), offsets, 'max')[ids])
@@ -0,0 +1,87 @@
+"""Sharded attention extraction: splits a corpus between independent processes
+(--num_shards/--shard_id, or all of them locally with --launch), each writing
+its results to a shard directory, and merges the shards back into the outputs
+of a single process run."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import copy
+import pickle
+
+import torch
+import torch.multiprocessing as mp
+
+def add_shard_args(parser):
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='number of shards the ids are split into (default: 1)')
+    parser.add_argument('--shard_id', type=int, default=0,
+                        help='shard to extract, out of --num_shards (default: 0)')
+    parser.add_argument('--launch', action='store_true', default=False,
+                        help='extract all the shards in local processes, then merge them')
+    parser.add_argument('--merge', action='store_true', default=False,
+                        help='merge the shards written to --out_dir')
+    return parser
+
+def shard_name(num_shards, shard_id):
+    return 'shard-{}-of-{}'.format(shard_id, num_shards)
+
+def shard_dir(out_dir, num_shards, shard_id):
+    return os.path.join(out_dir, shard_name(num_shards, shard_id))
+
+def shard_batches(ids, batch_size, num_shards=1, shard_id=0):
+    '''
+    Splits ids into the batches of a single process run and returns the ids
+    of every num_shards-th batch, starting at shard_id, and the positions of
+    these batches, so that every shard runs the same batches as a single
+    process would.
+    '''
+    starts = list(range(0, len(ids), batch_size))[shard_id::num_shards]
+    shard_ids = [_id for start in starts for _id in ids[start:start + batch_size]]
+    return shard_ids, [start // batch_size for start in starts]
+
+def _shard_worker(shard_id, fn, args, num_shards):
+    # split the cores between the shards instead of oversubscribing them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_shards))
+    args = copy.copy(args)
+    args.shard_id = shard_id
+    fn(args)
+
+def launch_shards(fn, args, num_shards):
+    '''
+    Runs fn(args) in num_shards local processes with args.shard_id set to
+    0 .. num_shards-1. Unlike distributed.launch the processes are not
+    joined in a process group, the shards never communicate.
+    '''
+    mp.spawn(_shard_worker, args=(fn, args, num_shards), nprocs=num_shards, join=True)
+
+def save_shard(out_dir, num_shards, shard_id, outputs):
+    """Writes the outputs (file name to object) of a shard to its directory."""
+    path = shard_dir(out_dir, num_shards, shard_id)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for name, obj in outputs.items():
+        with open(os.path.join(path, name), 'wb') as f:
+            pickle.dump(obj, f)
+
+def load_shards(out_dir, num_shards, name):
+    """The output `name` of every shard, in shard order."""
+    parts = []
+    for shard_id in range(num_shards):
+        with open(os.path.join(shard_dir(out_dir, num_shards, shard_id), name), 'rb') as f:
+            parts.append(pickle.load(f))
+    return parts
+
+def merge_dicts(parts, order=None):
+    '''
+    Merges the per id dicts of the shards, which hold disjoint ids, with the
+    keys in the given order (the order of a single process run).
+    '''
+    merged = {}
+    for part in parts:
+        merged.update(part)
+    if order is None:
+        return merged
+    return {_id: merged[_id] for _id in order if _id in merged}
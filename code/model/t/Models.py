@@ -1,7 +1,9 @@
 ''' Define the Transformer model '''
+import inspect
 import torch
 import torch.nn as nn
 import numpy as np
+from torch.utils.checkpoint import checkpoint
 from t.Layers import EncoderLayer
 
 
@@ -33,12 +35,38 @@ class PositionalEncoding(nn.Module):
         return x + self.pos_table[:, :x.size(1)].clone().detach()
 
 
+def _token_index(index, shape, dim):
+    """Expands a (batch, k) token index over the other dims of a tensor shape."""
+    view = [1] * len(shape)
+    view[0], view[dim] = index.shape
+    return index.view(view).expand(*shape)
+
+def gather_tokens(x, index, dim=1):
+    """Selects the tokens in index (batch, k) along a token dim of x."""
+    shape = list(x.shape)
+    shape[dim] = index.shape[1]
+    return x.gather(dim, _token_index(index, shape, dim))
+
+def scatter_tokens(x, index, kept, length, dim=1):
+    '''
+    Inverse of gather_tokens: puts the selected tokens back at their
+    positions of a length long token dim, with zeros for the dropped tokens
+    and for the selected tokens that are not kept.
+    '''
+    view = [1] * x.dim()
+    view[0], view[dim] = kept.shape
+    x = x * kept.view(view).to(x.dtype)
+    shape = list(x.shape)
+    shape[dim] = length
+    return x.new_zeros(shape).scatter(dim, _token_index(index, x.shape, dim), x)
+
+
 class attendedEncoder(nn.Module):
     ''' A encoder model with self attention mechanism. '''
 
     def __init__(
             self, n_layers, n_head, d_k, d_v,
-            d_model, d_inner, dropout=0.1):
+            d_model, d_inner, dropout=0.1, checkpoint_activations=False):
 
         super().__init__()
 
@@ -47,9 +75,122 @@ class attendedEncoder(nn.Module):
             EncoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout=dropout)
             for _ in range(n_layers)])
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
+        # recompute the layer activations in backward instead of storing them
+        self.checkpoint_activations = checkpoint_activations
+        # inference-time token pruning, see set_token_pruning
+        self.prune_after_layer = None
+        self.prune_keep_ratio = 1.0
+        self.prune_min_tokens = 1
+        self.kept_mask = None
+        # original indices of the heads removed by prune_heads
+        self.pruned_heads = []
+
+    def prune_heads(self, heads):
+        '''
+        Removes the same heads (original indices, out of the heads the model
+        was built with) from every layer, so the per-head NLAP rollout still
+        follows one head through all the layers. Heads that are already
+        pruned are skipped.
+        '''
+        n_head = self.layer_stack[0].slf_attn.n_head + len(self.pruned_heads)
+        remaining = [h for h in range(n_head) if h not in self.pruned_heads]
+        heads = sorted(set(heads) & set(remaining))
+        if not heads:
+            return
+        current = [remaining.index(h) for h in heads]
+        for enc_layer in self.layer_stack:
+            enc_layer.slf_attn.prune_heads(current)
+        self.pruned_heads = sorted(self.pruned_heads + heads)
+
+    def set_token_pruning(self, after_layer=None, keep_ratio=0.5, min_tokens=1):
+        '''
+        In eval mode, drops the tokens that received the least attention in
+        the first `after_layer` layers, so the remaining layers only run on
+        (at least min_tokens and) keep_ratio of the tokens of every sequence.
+        after_layer=None turns pruning off; otherwise at least one layer has to
+        run before and after the pruning.
+        '''
+        n_layers = len(self.layer_stack)
+        if after_layer is not None and not 1 <= after_layer < n_layers:
+            raise ValueError('token pruning layer must be in [1, {})'.format(n_layers))
+        self.prune_after_layer = after_layer
+        self.prune_keep_ratio = keep_ratio
+        self.prune_min_tokens = min_tokens
+
+    def select_tokens(self, attn_list, masks):
+        '''
+        Ranks the tokens by the attention they received from the valid queries
+        over all the heads of the layers run so far, and returns the positions
+        of the top tokens in sequence order (batch, k), which of them are kept
+        (sequences with fewer tokens than the longest one select some
+        padding), and the mask for the remaining layers.
+        '''
+        valid = masks.reshape(masks.shape[0], -1).bool()
+        importance = 0
+        for attn in attn_list:
+            importance = importance + (attn * valid[:, None, :, None]).sum(dim=(1, 2))
+        importance = importance.masked_fill(~valid, float('-inf'))
+        n_valid = valid.sum(dim=1)
+        n_keep = torch.ceil(n_valid.float() * self.prune_keep_ratio).long()
+        n_keep = torch.min(n_keep.clamp(min=self.prune_min_tokens), n_valid)
+        k = max(int(n_keep.max()), 1)
+        order = importance.topk(k, dim=1).indices
+        kept = torch.arange(k, device=order.device)[None, :] < n_keep[:, None]
+        index, perm = order.sort(dim=1)
+        kept = kept.gather(1, perm)
+        return index, kept, kept.unsqueeze(dim=-1).to(masks.dtype)
+
+    def effective_mask(self, mask):
+        '''
+        Mask of the tokens that made it through the last forward pass, in the
+        shape and dtype of the given input mask (which is returned as is if
+        nothing was pruned).
+        '''
+        if self.kept_mask is None:
+            return mask
+        kept = self.kept_mask.view(mask.shape)
+        return mask & kept if mask.dtype == torch.bool else mask * kept.to(mask.dtype)
+
+    def run_layers(self, enc_output, masks, start, stop):
+        '''
+        Runs the layers [start, stop) of the stack on (not yet normalized)
+        hidden states, and returns their output with the self attention of
+        every layer run. Used by early exit inference, which stops after
+        fewer layers for some inputs.
+        '''
+        attns = []
+        for enc_layer in self.layer_stack[start:stop]:
+            enc_output, enc_slf_attn = enc_layer(enc_output, slf_attn_mask=masks)[:2]
+            attns.append(enc_slf_attn)
+        return enc_output, attns
+
+    def checkpointed_forward(self, inputs, masks):
+        '''
+        Training forward pass that keeps only the output of every layer and
+        recomputes the rest in backward. The per-layer intermediate lists are
+        returned empty, since only the encoder output is needed to train.
+        '''
+        self.kept_mask = None
+        enc_output = self.dropout(inputs)
+        for enc_layer in self.layer_stack:
+            def run_layer(x, enc_layer=enc_layer):
+                return enc_layer(x, slf_attn_mask=masks)[0]
+            if 'use_reentrant' in inspect.signature(checkpoint).parameters:
+                enc_output = checkpoint(run_layer, enc_output, use_reentrant=False)
+            else:
+                # the reentrant version only backpropagates into the layer
+                # if its input requires grad
+                if not enc_output.requires_grad:
+                    enc_output = enc_output.detach().requires_grad_()
+                enc_output = checkpoint(run_layer, enc_output)
+        enc_output = self.layer_norm(enc_output)
+        return (enc_output,) + ([],) * 11
 
     def forward(self, inputs, masks):
 
+        if self.checkpoint_activations and self.training and torch.is_grad_enabled():
+            return self.checkpointed_forward(inputs, masks)
+
         enc_slf_attn_list = []
 
         x_1_pre_list = []
@@ -68,12 +209,35 @@ class attendedEncoder(nn.Module):
 
         # -- Forward
         enc_output = self.dropout(inputs)
+        self.kept_mask = None
+        index = None
+
+        for layer_i, enc_layer in enumerate(self.layer_stack):
+            if layer_i == self.prune_after_layer and not self.training:
+                # run the remaining layers on the most attended tokens only
+                index, kept, masks = self.select_tokens(enc_slf_attn_list, masks)
+                enc_output = gather_tokens(enc_output, index)
+                length = inputs.shape[1]
+                self.kept_mask = torch.zeros(index.shape[0], length, dtype=torch.bool,
+                                             device=index.device).scatter(1, index, kept)
 
-        for enc_layer in self.layer_stack:
             enc_output, enc_slf_attn, x_1_pre, x_1_post, x_2_pre, x_2_post, \
                 q_ma_last_pre, q_ma_last_post_ret, \
                 attn_pre, attn_post, \
                 v_ma_first_pre, v_ma_first_post = enc_layer(enc_output, slf_attn_mask=masks)
+
+            if index is not None:
+                # back to full length, with zeros for the dropped tokens
+                enc_slf_attn = scatter_tokens(scatter_tokens(enc_slf_attn, index, kept, length, dim=2),
+                                              index, kept, length, dim=3)
+                x_1_pre, x_1_post, x_2_pre, x_2_post, \
+                    q_ma_last_pre, q_ma_last_post_ret, v_ma_first_pre, v_ma_first_post = \
+                    [scatter_tokens(x, index, kept, length) for x in
+                     (x_1_pre, x_1_post, x_2_pre, x_2_post,
+                      q_ma_last_pre, q_ma_last_post_ret, v_ma_first_pre, v_ma_first_post)]
+                attn_pre = scatter_tokens(attn_pre, index, kept, length, dim=2)
+                attn_post = scatter_tokens(attn_post, index, kept, length, dim=2)
+
             enc_slf_attn_list += [enc_slf_attn]
 
             x_1_pre_list += [x_1_pre]
@@ -91,6 +255,8 @@ class attendedEncoder(nn.Module):
             v_ma_first_post_list += [v_ma_first_post]
 
         enc_output = self.layer_norm(enc_output)
+        if index is not None:
+            enc_output = scatter_tokens(enc_output, index, kept, length)
 
         return enc_output, enc_slf_attn_list, \
                 x_1_pre_list, x_1_post_list, x_2_pre_list, x_2_post_list, \
@@ -22,7 +22,8 @@ class ScaledDotProductAttention(nn.Module):
             mask_t = torch.cat(w_len*[mask_t], dim=2)
             attn = attn.masked_fill(mask_t == 0, -1e9)
 
-        attn = self.dropout(F.softmax(attn, dim=-1))
+        # softmax in float32 also under bfloat16 autocast
+        attn = self.dropout(F.softmax(attn.float(), dim=-1))
 
         output = torch.matmul(attn, v)
 
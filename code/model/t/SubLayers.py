@@ -7,6 +7,22 @@ import torch
 
 __author__ = "Zhengxuan Wu"
 
+def prune_linear(layer, index, dim=0):
+    '''
+    Copy of a linear layer with only the output (dim=0) or input (dim=1)
+    features in index.
+    '''
+    weight = layer.weight.index_select(dim, index.to(layer.weight.device)).detach().clone()
+    bias = layer.bias
+    if bias is not None and dim == 0:
+        bias = bias.index_select(0, index.to(bias.device))
+    new_layer = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None)
+    new_layer = new_layer.to(device=weight.device, dtype=weight.dtype)
+    new_layer.weight.data.copy_(weight)
+    if bias is not None:
+        new_layer.bias.data.copy_(bias.detach())
+    return new_layer
+
 class MultiHeadAttention(nn.Module):
     ''' Multi-Head Attention module '''
 
@@ -66,12 +82,30 @@ class MultiHeadAttention(nn.Module):
         q_ma_last_pre = q_hs.view(sz_b, len_q, -1)
         q_ma_last_post = self.fc(q_ma_last_pre)
         q_ma_last_post_ret = q_ma_last_post.clone()
-        q = self.dropout(q_ma_last_post)
+        # keep the residual stream in its own (float32) precision under autocast
+        q = self.dropout(q_ma_last_post).to(residual.dtype)
         q += residual
 
         return q, attn, q_ma_last_pre, q_ma_last_post_ret, attn_pre, attn_post, \
                 v_ma_first_pre, v_ma_first_post_ret
 
+    def prune_heads(self, heads):
+        '''
+        Removes the given heads (indices among the current heads) by dropping
+        their rows of w_qs, w_ks and w_vs and their columns of fc. The
+        remaining heads compute exactly what they did before.
+        '''
+        keep = [h for h in range(self.n_head) if h not in set(heads)]
+        if not keep:
+            raise ValueError('Cannot prune every head')
+        qk = torch.cat([torch.arange(h*self.d_k, (h+1)*self.d_k) for h in keep])
+        v = torch.cat([torch.arange(h*self.d_v, (h+1)*self.d_v) for h in keep])
+        self.w_qs = prune_linear(self.w_qs, qk, dim=0)
+        self.w_ks = prune_linear(self.w_ks, qk, dim=0)
+        self.w_vs = prune_linear(self.w_vs, v, dim=0)
+        self.fc = prune_linear(self.fc, v, dim=1)
+        self.n_head = len(keep)
+
 
 class PositionwiseFeedForward(nn.Module):
     ''' A two-feed-forward-layer module '''
@@ -94,7 +128,7 @@ class PositionwiseFeedForward(nn.Module):
 
         x_2_post_ret = x_2_post.clone()
 
-        x = self.dropout(x_2_post)
+        x = self.dropout(x_2_post).to(residual.dtype)
         x += residual
 
         return x, x_1_pre, x_1_post, x_2_pre, x_2_post_ret
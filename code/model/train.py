@@ -19,32 +19,42 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.utils.data import DataLoader
 
-from datasets import seq_collate_dict, load_dataset
+from datasets import seq_collate_dict, load_dataset, load_token_dataset
 from models import *
+from metrics import SSTAccuracy, CCC, one_hot
+from engine import LossMeter, StepLogger, async_handlers
+from corpus_store import RaggedStore, open_sst_split, generateBatchStore, \
+    open_sst_tokens, open_embedding_table
+from checkpoint import CheckpointWriter, training_state, load_training_state, model_checkpoint
+from precision import autocast
+from distributed import shard, wrap_model, launch, is_distributed, is_main_process, \
+    get_rank, get_world_size, all_reduce_sum, all_gather_list, maybe_no_sync
+import random
 from random import shuffle
 from operator import itemgetter
 import pprint
 
 import logging
 logFilename = "./train.log"
+logFormat = "%(asctime)s - %(message)s"
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(message)s",
+    format=logFormat,
     handlers=[
-        logging.FileHandler(logFilename, 'w'),
         logging.StreamHandler()
     ])
 logger = logging.getLogger()
 
-def eval_ccc(y_true, y_pred):
-    """Computes concordance correlation coefficient."""
-    true_mean = np.mean(y_true)
-    true_var = np.var(y_true)
-    pred_mean = np.mean(y_pred)
-    pred_var = np.var(y_pred)
-    covar = np.cov(y_true, y_pred, bias=True)[0][1]
-    ccc = 2*covar / (true_var + pred_var +  (pred_mean-true_mean) ** 2)
-    return ccc
+def add_log_file(logger):
+    '''
+    Logs to train.log as well. Rank 0 starts the file: a single process, or
+    the launcher of a distributed run before any worker runs; the worker
+    processes append to it.
+    '''
+    logMode = 'a' if is_distributed() else 'w'
+    handler = logging.FileHandler(logFilename, logMode)
+    handler.setFormatter(logging.Formatter(logFormat))
+    logger.addHandler(handler)
 
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
@@ -54,7 +64,7 @@ def chunks(l, n):
 '''
 helper to chunknize the data for each a modality
 '''
-def generateInputChunkHelper(data_chunk, length_chunk, tensor=True):
+def generateInputChunkHelper(data_chunk, length_chunk, tensor=True, dtype=torch.float):
     # sort the data with length from long to short
     combined_data = list(zip(data_chunk, length_chunk))
     combined_data.sort(key=itemgetter(1),reverse=True)
@@ -63,21 +73,28 @@ def generateInputChunkHelper(data_chunk, length_chunk, tensor=True):
         data_sort.append(pair[0])
     if tensor:
         # produce the operatable tensors
-        data_sort_t = torch.tensor(data_sort, dtype=torch.float)
+        data_sort_t = torch.tensor(data_sort, dtype=dtype)
         return data_sort_t
     else:
         return data_sort
 
+def input_dtype(args):
+    """Token id inputs are batched as long, embedded inputs as float."""
+    return torch.long if getattr(args, 'token_dir', None) else torch.float
+
 '''
 yielding training batch for the training process
 '''
-def generateTrainBatch(input_data, input_target, input_length, token_lengths, args, batch_size=25):
+def generateTrainBatch(input_data, input_target, input_length, token_lengths, args, batch_size=25,
+                       pad_shards=True):
     # TODO: support input_data as a dictionary
     # get chunk
     input_size = len(input_data[list(input_data.keys())[0]]) # all values have same size
     index = [i for i in range(0, input_size)]
     if batch_size != 1:
         shuffle(index)
+    # this process' share of the data in a distributed run
+    index, batch_size = shard(index, batch_size, pad=pad_shards)
     shuffle_chunks = [i for i in chunks(index, batch_size)]
     for chunk in shuffle_chunks:
         # chunk yielding data
@@ -94,8 +111,9 @@ def generateTrainBatch(input_data, input_target, input_length, token_lengths, ar
         for mod in list(input_data.keys()):
             data_chunk = [input_data[mod][index] for index in chunk]
             data_chunk_sorted = \
-                generateInputChunkHelper(data_chunk, length_chunk)
-            data_chunk_sorted = data_chunk_sorted[:,:max_length,:max_token_length,:]
+                generateInputChunkHelper(data_chunk, length_chunk,
+                                         dtype=input_dtype(args))
+            data_chunk_sorted = data_chunk_sorted[:,:max_length,:max_token_length]
             yield_input_data[mod] = data_chunk_sorted
         # target generating
         target_sort = \
@@ -117,13 +135,16 @@ def generateTrainBatch(input_data, input_target, input_length, token_lengths, ar
 '''
 yielding training batch for the training process
 '''
-def generateTrainBatchRandom(input_data, input_target, input_length, token_lengths, args, batch_size=30):
+def generateTrainBatchRandom(input_data, input_target, input_length, token_lengths, args, batch_size=30,
+                             pad_shards=True):
     # TODO: support input_data as a dictionary
     # get chunk
     input_size = len(input_data[list(input_data.keys())[0]]) # all values have same size
     index = [i for i in range(0, input_size)]
     if batch_size != 1:
         shuffle(index)
+    # this process' share of the data in a distributed run
+    index, batch_size = shard(index, batch_size, pad=pad_shards)
     shuffle_chunks = [i for i in chunks(index, batch_size)]
     for chunk in shuffle_chunks:
         # chunk yielding data
@@ -140,8 +161,9 @@ def generateTrainBatchRandom(input_data, input_target, input_length, token_lengt
         for mod in list(input_data.keys()):
             data_chunk = [input_data[mod][index] for index in chunk]
             data_chunk_sorted = \
-                generateInputChunkHelper(data_chunk, length_chunk)
-            data_chunk_sorted = data_chunk_sorted[:,:max_length,:max_token_length,:]
+                generateInputChunkHelper(data_chunk, length_chunk,
+                                         dtype=input_dtype(args))
+            data_chunk_sorted = data_chunk_sorted[:,:max_length,:max_token_length]
             yield_input_data[mod] = data_chunk_sorted
         # target generating
         target_sort = \
@@ -176,96 +198,79 @@ def generateTrainBatchRandom(input_data, input_target, input_length, token_lengt
         # yielding for each batch
         yield (yield_input_data, torch.unsqueeze(target_sort, dim=2), lstm_masks, length_chunk, token_length_sort)
 
+def splitMicroBatches(data, target, mask, lengths, token_lengths, size):
+    '''
+    Splits a length-sorted SEND batch into micro-batches of at most `size`
+    videos, each trimmed to its own longest video and time window.
+    '''
+    if not size or size >= len(lengths):
+        yield data, target, mask, lengths, token_lengths
+        return
+    for start in range(0, len(lengths), size):
+        end = start + size
+        micro_lengths = lengths[start:end]
+        micro_token_lengths = token_lengths[start:end]
+        max_length = max(micro_lengths)
+        max_token_length = max([max(tls) for tls in micro_token_lengths])
+        micro_data = {mod : data[mod][start:end,:max_length,:max_token_length]
+                      for mod in data.keys()}
+        yield micro_data, target[start:end,:max_length], mask[start:end,:max_length], \
+            micro_lengths, micro_token_lengths
+
 def train(input_data, input_target, lengths, token_lengths, model, criterion, optimizer, epoch, args):
     # TODO: support input_data as a dictionary
     # input_data = input_data['linguistic']
-
     if args.random_train:
-        model.train()
-        data_num = 0
-        loss = 0.0
-        batch_num = 0
-        # batch our data
-        for (data, target, mask, lengths, token_lengths) in generateTrainBatchRandom(input_data,
-                                                                input_target,
-                                                                lengths,
-                                                                token_lengths, 
-                                                                args):
-            # send to device
-            mask = mask.to(args.device)
-            # send all data to the device
-            for mod in list(data.keys()):
-                # print(mod)
-                data[mod] = data[mod].to(args.device)
-            target = target.to(args.device)
-            # lengths = lengths.to(args.device)
-            # Run forward pass.
-            output = model(data, lengths, token_lengths, mask)
-            # Compute loss and gradients
-            batch_loss = criterion(output, target)
-            # Accumulate total loss for epoch
-            loss += batch_loss
-            # Average over number of non-padding datapoints before stepping
-            batch_loss /= sum(lengths)
-            batch_loss.backward()
-            # Step, then zero gradients
-            optimizer.step()
-            optimizer.zero_grad()
-            # Keep track of total number of time-points
-            data_num += sum(lengths)
-            logger.info('Batch: {:5d}\tLoss: {:2.5f}'.\
-                format(batch_num, loss/data_num))
-            batch_num += 1
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-        # Average losses and print
-        loss /= data_num
-        logger.info('---')
-        logger.info('Epoch: {}\tLoss: {:2.5f}'.format(epoch, loss))
-        return loss
+        batch_generator = generateTrainBatchRandom
     else:
-        model.train()
-        data_num = 0
-        loss = 0.0
-        batch_num = 0
-        # batch our data
-        for (data, target, mask, lengths, token_lengths) in generateTrainBatch(input_data,
-                                                                input_target,
-                                                                lengths,
-                                                                token_lengths, 
-                                                                args):
-            # send to device
-            mask = mask.to(args.device)
-            # send all data to the device
-            for mod in list(data.keys()):
-                # print(mod)
-                data[mod] = data[mod].to(args.device)
-            target = target.to(args.device)
-            # lengths = lengths.to(args.device)
-            # Run forward pass.
-            output = model(data, lengths, token_lengths, mask)
-            # Compute loss and gradients
-            batch_loss = criterion(output, target)
-            # Accumulate total loss for epoch
-            loss += batch_loss
-            # Average over number of non-padding datapoints before stepping
-            batch_loss /= sum(lengths)
-            batch_loss.backward()
-            # Step, then zero gradients
-            optimizer.step()
-            optimizer.zero_grad()
-            # Keep track of total number of time-points
-            data_num += sum(lengths)
-            logger.info('Batch: {:5d}\tLoss: {:2.5f}'.\
-                format(batch_num, loss/data_num))
-            batch_num += 1
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-        # Average losses and print
-        loss /= data_num
-        logger.info('---')
-        logger.info('Epoch: {}\tLoss: {:2.5f}'.format(epoch, loss))
-        return loss
+        batch_generator = generateTrainBatch
+
+    model.train()
+    loss = LossMeter()
+    step_logger = StepLogger(logger, args.log_interval)
+    # batch our data
+    for batch_num, (data, target, mask, lengths, token_lengths) in \
+        enumerate(batch_generator(input_data,
+                                  input_target,
+                                  lengths,
+                                  token_lengths,
+                                  args)):
+        # send to device
+        mask = mask.to(args.device)
+        # send all data to the device
+        for mod in list(data.keys()):
+            data[mod] = data[mod].to(args.device)
+        target = target.to(args.device)
+        # Average over number of non-padding datapoints before stepping; in a
+        # distributed run that is the count over all processes, scaled by the
+        # number of processes since the gradients get averaged
+        loss_scale = get_world_size() / all_reduce_sum(sum(lengths))
+        # Accumulate the gradients of the micro-batches (if any), only
+        # all-reducing them after the last one
+        micro_batches = list(splitMicroBatches(data, target, mask, lengths, token_lengths,
+                                               args.micro_batch_size))
+        for i, (micro_data, micro_target, micro_mask, micro_lengths, micro_token_lengths) in \
+            enumerate(micro_batches):
+            with maybe_no_sync(model, sync=(i == len(micro_batches) - 1)):
+                with autocast(args.bf16):
+                    # Run forward pass.
+                    output = model(micro_data, micro_lengths, micro_token_lengths, micro_mask)
+                    # Compute loss and gradients
+                    batch_loss = criterion(output, micro_target)
+                # Accumulate total loss for epoch (detached, no host sync)
+                loss.update(batch_loss, sum(micro_lengths))
+                (batch_loss * loss_scale).backward()
+        # Step, then zero gradients
+        optimizer.step()
+        optimizer.zero_grad()
+        step_logger.log(batch_num, Loss=loss)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    # Average losses and print
+    loss = loss.all_reduce().mean()
+    logger.info('---')
+    logger.info('Epoch: {}\tLoss: {:2.5f}'.format(epoch, loss))
+    return loss
 
 def evaluateOnEval(input_data, input_target, lengths, token_lengths, model, criterion, args, fig_path=None):
     model.eval()
@@ -273,7 +278,6 @@ def evaluateOnEval(input_data, input_target, lengths, token_lengths, model, crit
     actuals = []
     data_num = 0
     loss, ccc = 0.0, []
-    count = 0
     index = 0
     for (data, target, mask, lengths, token_lengths) in generateTrainBatch(input_data,
                                                             input_target,
@@ -295,14 +299,8 @@ def evaluateOnEval(input_data, input_target, lengths, token_lengths, model, crit
         loss += criterion(output, target)
         # Keep track of total number of time-points
         data_num += sum(lengths)
-        # Compute correlation and CCC of predictions against ratings
-        output = torch.squeeze(torch.squeeze(output, dim=2), dim=0).cpu().detach().numpy()
-        target = torch.squeeze(torch.squeeze(target, dim=2), dim=0).cpu().detach().numpy()
-        if count == 0:
-            # print(output)
-            # print(target)
-            count += 1
-        curr_ccc = eval_ccc(output, target)
+        # Compute CCC of predictions against ratings
+        curr_ccc = CCC().update(output, target).compute()
         ccc.append(curr_ccc)
         index += 1
     # Average losses and print
@@ -317,7 +315,6 @@ def evaluate(input_data, input_target, lengths, token_lengths, model, criterion,
     predictions = []
     data_num = 0
     loss, corr, ccc = 0.0, [], []
-    count = 0
 
     local_best_output = []
     local_best_target = []
@@ -329,7 +326,8 @@ def evaluate(input_data, input_target, lengths, token_lengths, model, criterion,
                                                             lengths,
                                                             token_lengths, 
                                                             args,
-                                                            batch_size=1):
+                                                            batch_size=1,
+                                                            pad_shards=False):
 
         # send to device
         mask = mask.to(args.device)
@@ -338,29 +336,37 @@ def evaluate(input_data, input_target, lengths, token_lengths, model, criterion,
             data[mod] = data[mod].to(args.device)
         target = target.to(args.device)
         # Run forward pass
-        output = model(data, lengths, token_lengths, mask)
+        with autocast(args.bf16):
+            output = model(data, lengths, token_lengths, mask).float()
         # Compute loss
         loss += criterion(output, target)
         # Keep track of total number of time-points
         data_num += sum(lengths)
         # Compute correlation and CCC of predictions against ratings
+        curr_ccc = CCC().update(output, target).compute()
         output = torch.squeeze(torch.squeeze(output, dim=2), dim=0).cpu().numpy()
         target = torch.squeeze(torch.squeeze(target, dim=2), dim=0).cpu().numpy()
-        if count == 0:
-            # print(output)
-            # print(target)
-            count += 1
-        curr_ccc = eval_ccc(output, target)
         corr.append(pearsonr(output, target)[0])
         ccc.append(curr_ccc)
         index += 1
         if curr_ccc > local_best_ccc:
             local_best_output = output
             local_best_target = target
-            local_best_index = index
+            # position in the whole (unsharded) evaluation set
+            local_best_index = (index - 1) * get_world_size() + get_rank() + 1
             local_best_ccc = curr_ccc
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
+    # Collect the statistics of all processes in a distributed run
+    if is_distributed():
+        loss = all_reduce_sum(loss)
+        data_num = all_reduce_sum(data_num)
+        corr = all_gather_list(corr)
+        ccc = all_gather_list(ccc)
+        local_best_ccc, local_best_output, local_best_target, local_best_index = \
+            max(all_gather_list([(local_best_ccc, local_best_output,
+                                  local_best_target, local_best_index)]),
+                key=itemgetter(0))
     # Average losses and print
     loss /= data_num
     # Average statistics and print
@@ -446,17 +452,43 @@ def save_params(args, model, train_stats, test_stats):
     df.set_index('model')
     df.to_csv(fname, mode='a', header=(not os.path.exists(fname)), sep='\t')
 
-def save_checkpoint(modalities, mod_dimension, window_size, model, path):
-    checkpoint = {'modalities': modalities, 'mod_dimension' : mod_dimension, 'window_size' : window_size, 'model': model.state_dict()}
-    torch.save(checkpoint, path)
+def save_checkpoint(modalities, mod_dimension, window_size, model, path, writer=None):
+    checkpoint = model_checkpoint(model, modalities=modalities, mod_dimension=mod_dimension,
+                                  window_size=window_size)
+    if writer is not None:
+        # snapshot now, write atomically in the background
+        writer.save(checkpoint, path)
+    else:
+        torch.save(checkpoint, path)
+
+def save_training_state(model, optimizer, epoch, best, args, writer, name):
+    """Saves a resumable checkpoint every args.ckpt_freq epochs."""
+    if args.ckpt_freq > 0 and epoch % args.ckpt_freq == 0 and is_main_process():
+        path = os.path.join(args.model_dir, name)
+        writer.save(training_state(model, optimizer, epoch, best), path)
+
+def resume_training(model, optimizer, args):
+    """Returns (first epoch, best metrics) of a run restarted with --resume."""
+    if args.resume is None:
+        return 1, {}
+    epoch, best = load_training_state(args.resume, model, optimizer, args.device)
+    logger.info('Resumed from {} after epoch {}'.format(args.resume, epoch))
+    return epoch + 1, best
 
 def load_checkpoint(path, device):
     checkpoint = torch.load(path, map_location=device)
     return checkpoint
 
-def load_data(modalities, data_dir, eval_dir=None):
+def load_data(modalities, data_dir, eval_dir=None, token_dir=None):
     print("Loading data...")
     if eval_dir == None:
+        if token_dir is not None:
+            train_data = load_token_dataset(data_dir, 'Train', token_dir,
+                                            truncate=True, item_as_dict=True)
+            test_data = load_token_dataset(data_dir, 'Valid', token_dir,
+                                           truncate=True, item_as_dict=True)
+            print("Done.")
+            return train_data, test_data
         train_data = load_dataset(modalities, data_dir, 'Train',
                                 truncate=True, item_as_dict=True)
         test_data = load_dataset(modalities, data_dir, 'Valid',
@@ -473,16 +505,21 @@ def videoInputHelper(input_data, window_size, channel):
     # channel features
     vectors_raw = input_data[channel]
     ts = input_data[channel+"_timer"]
-    # remove nan values
-    vectors = []
-    for vec in vectors_raw:
-        inner_vec = []
-        for v in vec:
-            if np.isnan(v):
-                inner_vec.append(0)
-            else:
-                inner_vec.append(v)
-        vectors.append(inner_vec)
+    token_ids = np.ndim(vectors_raw) == 1
+    if token_ids:
+        # token ids, nothing to clean
+        vectors = list(vectors_raw)
+    else:
+        # remove nan values
+        vectors = []
+        for vec in vectors_raw:
+            inner_vec = []
+            for v in vec:
+                if np.isnan(v):
+                    inner_vec.append(0)
+                else:
+                    inner_vec.append(v)
+            vectors.append(inner_vec)
 
     #  get the window size and repeat rate if oversample is needed
     oversample = int(window_size[channel]/window_size['ratings'])
@@ -513,7 +550,7 @@ def videoInputHelper(input_data, window_size, channel):
                         window_vs.append(pad_vec)
                     else:
                         # or simply 0 like will never happened!
-                        pad_vec = [0.0] * mod_dimension[channel]
+                        pad_vec = 0 if token_ids else [0.0] * mod_dimension[channel]
                         window_vs.append(pad_vec)
             for i in range(0, oversample):
                 temp = np.array(window_vs)
@@ -590,7 +627,8 @@ def padInputHelper(input_data, dim, old_version=False):
             max_num_vec_in_window = max([len(w) for w in data])
         token_lens.append([len(w) for w in data])
 
-    padVec = [0.0]*dim
+    # token ids (dim of None) are padded with the id 0
+    padVec = 0 if dim is None else [0.0]*dim
     for vid in input_data:
         vidNewTmp = []
         for wind in vid:
@@ -643,6 +681,18 @@ def padRating(input_data, max_len):
     return output
 
 def main(args):
+    # write the log on a background thread, in the launcher and in every
+    # (spawned) worker, but not when train is only imported for its helpers
+    add_log_file(logger)
+    async_handlers(logger)
+    if args.nprocs > 1 and not is_distributed():
+        # data-parallel on the CPU: rerun main in every worker process
+        launch(main, args, args.nprocs)
+        return
+    if is_distributed():
+        args.device = 'cpu'
+        if not is_main_process():
+            logger.setLevel(logging.WARNING)
     if args.dataset == "SST":
         SST(args)
     else:
@@ -656,6 +706,7 @@ def SEND(args):
     torch.manual_seed(1)
     torch.cuda.manual_seed(1)
     np.random.seed(1)
+    random.seed(1)
 
     # clear memory
     if torch.cuda.is_available():
@@ -672,33 +723,47 @@ def SEND(args):
 
     # loss function define
     criterion = nn.MSELoss(reduction='sum')
+    # token id inputs are looked up in a shared frozen embedding table
+    embedding = None
+    pad_dimension = mod_dimension
+    if args.token_dir is not None:
+        embedding = open_embedding_table(args.token_dir)
+        pad_dimension = {'linguistic' : None}
     # construct model
-    model = TransformerLSTMAttn(mods=args.modalities, dims=mod_dimension, device=args.device)
+    model = TransformerLSTMAttn(mods=args.modalities, dims=mod_dimension, device=args.device,
+                                embedding=embedding)
     # Setting the optimizer
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=1e-4)
     # Load data for specified modalities
-    train_data, test_data = load_data(args.modalities, args.data_dir)
+    train_data, test_data = load_data(args.modalities, args.data_dir,
+                                      token_dir=args.token_dir)
 
     # training data
     input_features_train, ratings_train = constructInput(train_data, channels=args.modalities, window_size=window_size)
-    input_padded_train, seq_lens_train, token_lens_train = padInput(input_features_train, args.modalities, mod_dimension)
+    input_padded_train, seq_lens_train, token_lens_train = padInput(input_features_train, args.modalities, pad_dimension)
     ratings_padded_train = padRating(ratings_train, max(seq_lens_train))
 
     # testing data
     input_features_test, ratings_test = constructInput(test_data, channels=args.modalities, window_size=window_size)
-    input_padded_test, seq_lens_test, token_lens_test = padInput(input_features_test, args.modalities, mod_dimension)
+    input_padded_test, seq_lens_test, token_lens_test = padInput(input_features_test, args.modalities, pad_dimension)
     ratings_padded_test = padRating(ratings_test, max(seq_lens_test))
 
     input_train = input_padded_train
     input_test = input_padded_test
 
     # Train and save best model
-    best_ccc = -1
-    single_best_ccc = -1
-    for epoch in range(1, args.epochs+1):
+    writer = CheckpointWriter()
+    start_epoch, best = resume_training(model, optimizer, args)
+    best_ccc = best.get('ccc', -1)
+    single_best_ccc = best.get('single_ccc', -1)
+    # recompute encoder activations in backward to save memory
+    model.attendedEncoder.checkpoint_activations = args.checkpoint_activations
+    # gradient all-reduce in a distributed run
+    train_model = wrap_model(model)
+    for epoch in range(start_epoch, args.epochs+1):
         print('---')
         train(input_train, ratings_padded_train, seq_lens_train, token_lens_train,
-              model, criterion, optimizer, epoch, args)
+              train_model, criterion, optimizer, epoch, args)
         if epoch % args.eval_freq == 0:
             with torch.no_grad():
                 pred, loss, stats, (local_best_output, local_best_target, local_best_index) =\
@@ -706,9 +771,9 @@ def SEND(args):
                              model, criterion, args)
             if stats['ccc'] > best_ccc:
                 best_ccc = stats['ccc']
-                if not args.unit_test:
+                if not args.unit_test and is_main_process():
                     path = os.path.join(args.model_dir, 'best-model.pth')
-                    save_checkpoint(args.modalities, mod_dimension, window_size, model, path)
+                    save_checkpoint(args.modalities, mod_dimension, window_size, model, path, writer)
             if stats['max_ccc'] > single_best_ccc:
                 single_best_ccc = stats['max_ccc']
                 logger.info('===single_max_predict===')
@@ -718,6 +783,10 @@ def SEND(args):
                 logger.info('===end single_max_predict===')
             logger.info('CCC_STATS\tSINGLE_BEST: {:0.9f}\tBEST: {:0.9f}'.\
             format(single_best_ccc, best_ccc))
+        save_training_state(model, optimizer, epoch,
+                            {'ccc': best_ccc, 'single_ccc': single_best_ccc},
+                            args, writer, 'last-model.pth')
+    writer.wait()
 
     return best_ccc
 
@@ -764,12 +833,18 @@ def sortSST(data_chunk, length_chunk, tensor=True):
         return data_sort_t
     return data_sort
 
-def generateBatchSST(input_data, input_target, args, batch_size=1):
+def generateBatchSST(input_data, input_target, args, batch_size=1, pad_shards=True):
+    if isinstance(input_data, RaggedStore):
+        yield from generateBatchStore(input_data, input_target, args, batch_size,
+                                      pad_shards=pad_shards)
+        return
     # select batch sentence id
     seq_ids = [k for k in input_data.keys()]
     index = [i for i in range(0, len(seq_ids))]
     if batch_size != 1:
         shuffle(index)
+    # this process' share of the data in a distributed run
+    index, batch_size = shard(index, batch_size, pad=pad_shards)
     shuffle_chunks = [i for i in chunks(index, batch_size)] # contains array index
     for chunk in shuffle_chunks:
         chunk_ids = [seq_ids[index] for index in chunk]
@@ -790,33 +865,6 @@ def generateBatchSST(input_data, input_target, args, batch_size=1):
             mask[i,:seq_len[i]] = 1
         yield sort_feature, sort_targets, seq_len, mask
 
-def oneHotVector(sort_targets):
-    n_class = 5
-    batch_size = sort_targets.shape[0]
-    target = torch.zeros((batch_size, int(n_class)), dtype=torch.float).to(args.device)
-    for i in range(batch_size):
-        target[i][int(sort_targets[i]) - 1] = 1.0
-    return target
-
-def calculate_accuracy(predict, actual):
-    _, predicted = torch.max(predict, dim=-1)
-    multiclass = 0
-    for i in range(predict.shape[0]):
-        if int(predicted[i]) == int(actual[i]) - 1:
-            multiclass += 1
-
-    binary = 0
-    binary_total = 0 # will not count nuetural cases
-    for i in range(predict.shape[0]):
-        if int(actual[i]) != 3:
-            binary_total += 1
-            if int(actual[i]) < 3 and int(predicted[i]) < 2:
-                binary += 1
-            elif int(actual[i]) > 3 and int(predicted[i]) > 2:
-                binary += 1
-
-    return multiclass, binary, binary_total
-
 def SST(args):
     '''
     This is the training main function for SST dataset training
@@ -825,6 +873,7 @@ def SST(args):
     torch.manual_seed(1)
     torch.cuda.manual_seed(1)
     np.random.seed(1)
+    random.seed(1)
 
     # clear memory
     if torch.cuda.is_available():
@@ -837,8 +886,19 @@ def SST(args):
     print("Loading SST data ...")
     data_folder = args.data_dir
     import pickle
-    train_data = pickle.load( open( data_folder + "id_embed_train.p", "rb" ) )
-    valid_data = pickle.load( open( data_folder + "id_embed_valid.p", "rb" ) )
+    embedding = None
+    if args.token_dir is not None:
+        # token id stores plus the shared embedding table
+        train_data = open_sst_tokens(args.token_dir, 'train')
+        valid_data = open_sst_tokens(args.token_dir, 'valid')
+        embedding = open_embedding_table(args.token_dir)
+    elif args.sst_store is not None:
+        # memory-mapped float32 stores written by corpus_store.py
+        train_data = open_sst_split(args.sst_store, 'train')
+        valid_data = open_sst_split(args.sst_store, 'valid')
+    else:
+        train_data = pickle.load( open( data_folder + "id_embed_train.p", "rb" ) )
+        valid_data = pickle.load( open( data_folder + "id_embed_valid.p", "rb" ) )
     train_target = pickle.load( open( data_folder + "id_rating_train.p", "rb" ) )
     valid_target = pickle.load( open( data_folder + "id_rating_valid.p", "rb" ) )
     # verify some basics of the data loaded
@@ -857,94 +917,91 @@ def SST(args):
     # loss function define
     criterion = nn.BCELoss(reduction='sum')
     # construct model
-    model = TransformerLinearAttn(mods=args.modalities, dims=mod_dimension, device=args.device)
+    model = TransformerLinearAttn(mods=args.modalities, dims=mod_dimension, device=args.device,
+                                  embedding=embedding)
     # # Setting the optimizer
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=1e-4)
 
-    loss = 0.0
-    best_multi_acur = -1.0
-    best_binary_acur = -1.0
     args.batch_size = 500
 
-    for epoch in range(1, args.epochs+1):
-        batch_num = 1
-        data_num = 0.0
+    writer = CheckpointWriter()
+    start_epoch, best = resume_training(model, optimizer, args)
+    best_multi_acur = best.get('multi', -1.0)
+    best_binary_acur = best.get('binary', -1.0)
+    # recompute encoder activations in backward to save memory
+    model.attendedEncoder.checkpoint_activations = args.checkpoint_activations
+    # gradient all-reduce in a distributed run
+    train_model = wrap_model(model)
+    for epoch in range(start_epoch, args.epochs+1):
+        train_model.train()
+        loss = LossMeter()
+        step_logger = StepLogger(logger, args.log_interval)
         # for each epoch do the training
-        for sort_feature, sort_targets, seq_len, mask in \
-            generateBatchSST(train_data, train_class, args, batch_size=args.batch_size):
+        for batch_num, (sort_feature, sort_targets, seq_len, mask) in \
+            enumerate(generateBatchSST(train_data, train_class, args, batch_size=args.batch_size), 1):
                 # send to device
                 mask = mask.to(args.device)
                 sort_feature = sort_feature.to(args.device)
                 sort_targets = sort_targets.to(args.device)
-                # Run forward pass.
-                output = model(sort_feature, seq_len, mask)
-                oneHot_target = oneHotVector(sort_targets)
-                # Compute loss and gradients
-                batch_loss = criterion(output, oneHot_target)
-                # Accumulate total loss for epoch
-                loss += batch_loss
-                # backout prop
-                batch_loss.backward()
+                with autocast(args.bf16):
+                    # Run forward pass.
+                    output = train_model(sort_feature, seq_len, mask)
+                    oneHot_target = one_hot(sort_targets)
+                    # Compute loss and gradients
+                    batch_loss = criterion(output, oneHot_target)
+                # Accumulate total loss for epoch (detached, no host sync)
+                loss.update(batch_loss)
+                # backout prop, scaled up as the gradients of a distributed
+                # run are averaged over the processes
+                (batch_loss * get_world_size()).backward()
                 # Step, then zero gradients
                 optimizer.step()
                 optimizer.zero_grad()
-                # Keep track of total number of time-points
-                data_num += 1
-                logger.info('Batch: {:5d}\tLoss: {:2.5f}'.\
-                    format(batch_num, batch_loss))
-                batch_num += 1
+                step_logger.log(batch_num, Loss=batch_loss)
                 if torch.cuda.is_available():
                     torch.cuda.empty_cache()
-        # Average losses and print
-        loss /= data_num
+        # Average losses and print; every process runs the same number of batches
+        n_batches = max(loss.count, 1)
         logger.info('---')
-        logger.info('Epoch: {}\tMean Batch Loss: {:2.5f}'.format(epoch, loss))
+        logger.info('Epoch: {}\tMean Batch Loss: {:2.5f}'.format(epoch, loss.all_reduce().sum() / n_batches))
 
         # valid dataset error
         if epoch % args.eval_freq == 0:
             eval_loss = 0.0
-            multiclass_correct = 0
-            binary_correct = 0
-            multiclass_instance = 0
-            binary_instance = 0
-            multi = []
-            binary = []
+            accuracy = SSTAccuracy()
             with torch.no_grad():
                 model.eval()
                 # for each epoch do the training
                 for sort_feature, sort_targets, seq_len, mask in \
-                    generateBatchSST(valid_data, valid_class, args, batch_size=args.batch_size):
+                    generateBatchSST(valid_data, valid_class, args, batch_size=args.batch_size,
+                                     pad_shards=False):
                     # send to device
                     mask = mask.to(args.device)
                     sort_feature = sort_feature.to(args.device)
                     sort_targets = sort_targets.to(args.device)
-                    # Run forward pass.
-                    output = model(sort_feature, seq_len, mask)
-                    oneHot_target = oneHotVector(sort_targets)
-                    # Compute loss and gradients
-                    batch_loss = criterion(output, oneHot_target)
+                    with autocast(args.bf16):
+                        # Run forward pass.
+                        output = model(sort_feature, seq_len, mask)
+                        oneHot_target = one_hot(sort_targets)
+                        # Compute loss and gradients
+                        batch_loss = criterion(output, oneHot_target)
                     # Accumulate total loss for epoch
                     eval_loss += batch_loss
                     # get binary and multiclass accuracy
-                    multiclass, binary, binary_total = calculate_accuracy(output, sort_targets)
-                    multiclass_correct += multiclass
-                    multiclass_instance += len(seq_len)
-                    binary_correct += binary
-                    binary_instance += binary_total
+                    accuracy.update(output, sort_targets)
 
-            multi_accu = multiclass_correct*1.0/multiclass_instance
-            binary_accu = binary_correct*1.0/binary_instance
+            multi_accu, binary_accu = accuracy.all_reduce().compute()
 
-            if not args.unit_test:
+            if not args.unit_test and is_main_process():
                 if multi_accu > best_multi_acur:
                     # save model
                     path = os.path.join(args.model_dir, 'best-model-SST-m.pth')
-                    save_checkpoint(args.modalities, mod_dimension, -1, model, path)
+                    save_checkpoint(args.modalities, mod_dimension, -1, model, path, writer)
 
                 if binary_accu > best_binary_acur:
                     # save model
                     path = os.path.join(args.model_dir, 'best-model-SST-b.pth')
-                    save_checkpoint(args.modalities, mod_dimension, -1, model, path)
+                    save_checkpoint(args.modalities, mod_dimension, -1, model, path, writer)
 
             if multi_accu > best_multi_acur:
                 best_multi_acur = multi_accu
@@ -956,6 +1013,10 @@ def SST(args):
                     'max_multi': best_multi_acur, 'max_binary': best_binary_acur}
             logger.info('Evaluation\tmulti_acc: {:0.3f} \tbinary_acc: {:0.3f} \tmax_multi: {:0.3f}\tmax_binary: {:0.3f}'.\
                 format(stats['multi_acc'], stats['binary_acc'], stats['max_multi'], stats['max_binary']))
+        save_training_state(model, optimizer, epoch,
+                            {'multi': best_multi_acur, 'binary': best_binary_acur},
+                            args, writer, 'last-model-SST.pth')
+    writer.wait()
 
     return None
 
@@ -973,9 +1034,27 @@ if __name__ == "__main__":
                         help='path to data base directory')
     parser.add_argument('--dataset', type=str, default="SEND",
                         help='the dataset we want to run (default: SEND)')
+    parser.add_argument('--sst_store', type=str, default=None,
+                        help='directory of SST stores made by corpus_store.py (default: load pickles)')
+    parser.add_argument('--token_dir', type=str, default=None,
+                        help='directory of token id stores made by corpus_store.py --token_ids')
     parser.add_argument('--device', type=str, default='cuda:0',
                         help='device to use (default: cuda:0 if available)')
     parser.add_argument('--eval_freq', type=int, default=1, metavar='N',
                         help='evaluate every N epochs (default: 1)')
+    parser.add_argument('--log_interval', type=int, default=10, metavar='N',
+                        help='log training loss every N batches (default: 10)')
+    parser.add_argument('--ckpt_freq', type=int, default=0, metavar='N',
+                        help='save a resumable checkpoint to model_dir every N epochs (default: 0, never)')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='resumable checkpoint to continue training from')
+    parser.add_argument('--nprocs', type=int, default=1, metavar='N',
+                        help='number of data-parallel CPU processes (default: 1)')
+    parser.add_argument('--micro_batch_size', type=int, default=0, metavar='N',
+                        help='accumulate gradients over micro-batches of N SEND videos (default: 0, off)')
+    parser.add_argument('--checkpoint_activations', action='store_true',
+                        help='recompute the encoder activations in backward to save memory')
+    parser.add_argument('--bf16', action='store_true',
+                        help='run the model under bfloat16 autocast on the CPU')
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,154 @@
+"""Streaming per word statistics of the LAT and gradient scores written to the
+words_Test_*.csv files of attn_analyze.py. Words are mapped to integer ids and
+every score keeps a count, sum and Welford variance per word, updated with
+grouped reductions over buffered occurrences instead of lists of scores."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import csv
+
+import numpy as np
+
+def _grow(array, size):
+    if size <= len(array):
+        return array
+    grown = np.zeros((max(size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+class WordAggregator(object):
+    '''
+    Count, sum, mean and sum of squared deviations (M2) of every score of
+    every word. Occurrences are buffered and reduced flush_size at a time
+    with bincount over the ids of their words; partial statistics are
+    combined with the pairwise update of Chan et al., which also merges the
+    aggregators of several shards.
+
+    Words keep the order they first appeared in. Every add takes a key
+    ordering it against the others (by default the number of previous
+    adds), so shards that give the keys of a single process run merge into
+    the same order.
+    '''
+
+    def __init__(self, score_names=('score', 'gs'), flush_size=1 << 16):
+        self.score_names = list(score_names)
+        self.flush_size = flush_size
+        self.words = []
+        self.vocab = dict()
+        self.first = []
+        self.count = np.zeros(0, dtype=np.int64)
+        self.sum = np.zeros((0, len(self.score_names)))
+        self.mean = np.zeros((0, len(self.score_names)))
+        self.m2 = np.zeros((0, len(self.score_names)))
+        self._ids = []
+        self._scores = []
+        self._pending = 0
+        self._adds = 0
+
+    def _word_id(self, word, first):
+        _id = self.vocab.get(word)
+        if _id is None:
+            _id = self.vocab[word] = len(self.words)
+            self.words.append(word)
+            self.first.append(first)
+        return _id
+
+    def add(self, words, scores, key=None):
+        '''
+        Adds the occurrences of words with their scores (one sequence per
+        score name), truncated to the shortest of them as zip would.
+        '''
+        key = self._adds if key is None else key
+        self._adds += 1
+        n = min([len(words)] + [len(s) for s in scores])
+        if n == 0:
+            return
+        self._ids.append(np.array([self._word_id(w, (key, i)) for i, w in enumerate(words[:n])],
+                                  dtype=np.int64))
+        self._scores.append(np.stack([np.asarray(s[:n], dtype=np.float64) for s in scores],
+                                     axis=1))
+        self._pending += n
+        if self._pending >= self.flush_size:
+            self.flush()
+
+    def _combine(self, ids, count, sums, mean, m2):
+        size = len(self.words)
+        self.count = _grow(self.count, size)
+        self.sum, self.mean, self.m2 = [_grow(a, size) for a in (self.sum, self.mean, self.m2)]
+        count_a = self.count[ids][:, None].astype(np.float64)
+        count_b = count[:, None].astype(np.float64)
+        total = count_a + count_b
+        delta = mean - self.mean[ids]
+        self.mean[ids] += delta * count_b / total
+        self.m2[ids] += m2 + delta ** 2 * count_a * count_b / total
+        self.sum[ids] += sums
+        self.count[ids] += count
+
+    def flush(self):
+        """Reduces the buffered occurrences into the statistics."""
+        if not self._pending:
+            return
+        ids = np.concatenate(self._ids)
+        scores = np.concatenate(self._scores)
+        self._ids, self._scores, self._pending = [], [], 0
+        uniq, inverse = np.unique(ids, return_inverse=True)
+        count = np.bincount(inverse)
+        sums = np.stack([np.bincount(inverse, weights=scores[:, k])
+                         for k in range(scores.shape[1])], axis=1)
+        mean = sums / count[:, None]
+        m2 = np.stack([np.bincount(inverse, weights=(scores[:, k] - mean[inverse, k]) ** 2)
+                       for k in range(scores.shape[1])], axis=1)
+        self._combine(uniq, count, sums, mean, m2)
+
+    def merge(self, other):
+        """Adds the statistics of other, e.g. another shard, to these ones."""
+        if other.score_names != self.score_names:
+            raise ValueError('cannot merge the scores {} into {}'.format(
+                other.score_names, self.score_names))
+        self.flush()
+        other.flush()
+        ids = np.array([self._word_id(w, first) for w, first in zip(other.words, other.first)],
+                       dtype=np.int64)
+        for _id, first in zip(ids, other.first):
+            self.first[_id] = min(self.first[_id], first)
+        n = len(other.words)
+        self._combine(ids, other.count[:n], other.sum[:n], other.mean[:n], other.m2[:n])
+        return self
+
+    def rows(self):
+        '''
+        (word, count, [sum, mean, sample std] of every score) in order of
+        first appearance; the std of a word seen once is 0.
+        '''
+        self.flush()
+        for _id in sorted(range(len(self.words)), key=lambda i: self.first[i]):
+            count = int(self.count[_id])
+            stats = []
+            for k in range(len(self.score_names)):
+                std = (np.sqrt(max(self.m2[_id, k], 0.0) / (count - 1)) if count > 1 else 0.0)
+                stats.extend([float(self.sum[_id, k]), float(self.sum[_id, k]) / count,
+                              float(std)])
+            yield [self.words[_id], count] + stats
+
+    def write_csv(self, output_file):
+        '''
+        Writes the statistics with the columns of attn_analyze.py, word,
+        count, then sum, avg and std of every score, suffixed by its name
+        after the first one.
+        '''
+        header = ["word", "count"]
+        for k, name in enumerate(self.score_names):
+            suffix = "" if k == 0 else "_" + name
+            header.extend(["sum" + suffix, "avg" + suffix, "std" + suffix])
+        with open(output_file, mode='w') as csv_file:
+            file_writer = csv.writer(csv_file, delimiter=',')
+            file_writer.writerow(header)
+            for row in self.rows():
+                file_writer.writerow(row)
+
+    def __getstate__(self):
+        # pickle (e.g. a shard) without the buffer
+        self.flush()
+        return self.__dict__